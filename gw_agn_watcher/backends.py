@@ -0,0 +1,300 @@
+"""
+backends.py
+
+Pluggable data backends for the ALeRCE query modules.
+
+``mainquery``, ``classifiers`` and ``detections`` send SQL to a live
+PostgreSQL/q3c server through a psycopg2 connection. Any ``Backend``
+instance can be passed in place of that connection; the modules then call
+its methods instead of running SQL.
+
+``LocalBackend`` is an offline stand-in holding the ``object``,
+``probability``, ``detection`` and ``ps1_ztf`` tables in an SQLite file.
+Polygon and cone searches are emulated with a k-d tree over the object
+unit vectors followed by an exact great-circle polygon test, so the
+whole pipeline can be run, profiled and regression-tested without
+network access.
+"""
+
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+from .planner import enclosing_cone
+from .polygons import to_tangent_plane
+from .sphere import gnomonic, radec_to_xyz
+
+TABLES = {
+    'object': {
+        'oid': 'TEXT PRIMARY KEY', 'meanra': 'REAL', 'meandec': 'REAL',
+        'firstmjd': 'REAL', 'stellar': 'INTEGER', 'ndet': 'INTEGER',
+    },
+    'probability': {
+        'oid': 'TEXT', 'classifier_name': 'TEXT', 'class_name': 'TEXT',
+        'probability': 'REAL', 'ranking': 'INTEGER',
+    },
+    'detection': {
+        'oid': 'TEXT', 'candid': 'INTEGER', 'mjd': 'REAL', 'fid': 'INTEGER',
+        'magpsf': 'REAL', 'sigmapsf': 'REAL', 'drb': 'REAL', 'has_stamp': 'INTEGER',
+    },
+    'ps1_ztf': {
+        'oid': 'TEXT', 'candid': 'INTEGER', 'sgscore1': 'REAL', 'distpsnr1': 'REAL',
+    },
+}
+
+OBJECT_COLUMNS = ['oid', 'meanra', 'meandec', 'firstmjd', 'stellar', 'ndet']
+STAMP_CLASSES = ('SN', 'AGN')
+LC_CLASSES = ('AGN', 'QSO', 'Blazar', 'SLSN', 'SNII', 'SNIbc', 'SNIa')
+
+
+class Backend(ABC):
+    """
+    Interface of a data source for the ALeRCE query modules.
+
+    Each method returns the same columns as the corresponding SQL query.
+    """
+
+    @abstractmethod
+    def objects(self, plan, mjd_first, mjd_last, near=None, exclude=()):
+        """Objects inside a planned region (``planner.plan_queries`` entry)
+        with first detection in [mjd_first, mjd_last]; with ``near`` =
+        (ra, dec, radius), only those within radius deg of a position,
+        and none inside the plan entries of ``exclude``."""
+
+    @abstractmethod
+    def classifiers(self, oids, classifier=None):
+        """
+        Classifier rows for ``oids``.
+
+        With ``classifier=None``, at most one row per oid: the stamp row
+        (SN/AGN, probability > 0.5) if any, else the top-ranked lc row
+        above 0.5. With 'stamp_classifier' or 'lc_classifier', the rows of
+        the per-classifier queries of ``classifiers.query_classifiers``.
+        """
+
+    @abstractmethod
+    def detections(self, oids):
+        """One row per oid: its earliest detection passing the DRB and PS1 cuts."""
+
+
+def write_tables(path, **tables):
+    """
+    Create (or replace) the stand-in tables in an SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file to write.
+    **tables : pandas.DataFrame
+        Frames named after ``TABLES`` ('object', 'probability',
+        'detection', 'ps1_ztf'); missing tables are created empty.
+    """
+    with sqlite3.connect(path) as db:
+        for name, columns in TABLES.items():
+            db.execute(f"DROP TABLE IF EXISTS {name}")
+            db.execute(f"CREATE TABLE {name} ("
+                       + ", ".join(f"{col} {kind}" for col, kind in columns.items()) + ")")
+            frame = tables.get(name)
+            if frame is not None and len(frame):
+                frame[list(columns)].to_sql(name, db, if_exists='append', index=False,
+                                            chunksize=100000)
+            # Index after the bulk insert
+            if name != 'object':
+                db.execute(f"CREATE INDEX {name}_oid ON {name} (oid)")
+
+
+def synthetic_tables(n_objects=100000, mjd_start=60000.0, mjd_stop=60400.0, n_detections=5,
+                     seed=0):
+    """
+    Random ALeRCE-like tables for benchmarking the offline backend.
+
+    Objects are uniform on the sky and in first-detection time; every
+    object gets stamp and lc classifier rows, ``n_detections`` detections
+    on average and one PS1 match.
+
+    Returns
+    -------
+    dict of pandas.DataFrame
+        Keyword arguments for ``write_tables``.
+    """
+    rng = np.random.default_rng(seed)
+    oid = np.array([f"ZTF{i:09d}" for i in range(n_objects)])
+    objects = pd.DataFrame({
+        'oid': oid,
+        'meanra': rng.uniform(0, 360, n_objects),
+        'meandec': np.rad2deg(np.arcsin(rng.uniform(-1, 1, n_objects))),
+        'firstmjd': rng.uniform(mjd_start, mjd_stop, n_objects),
+        'stellar': rng.random(n_objects) < 0.2,
+        'ndet': rng.poisson(n_detections, n_objects) + 1,
+    })
+
+    stamp = rng.dirichlet(np.ones(len(STAMP_CLASSES) + 1), n_objects)
+    lc = rng.dirichlet(np.ones(len(LC_CLASSES)), n_objects)
+    lc_rank = np.argsort(np.argsort(-lc, axis=1), axis=1) + 1
+    probability = pd.concat([
+        pd.DataFrame({
+            'oid': np.repeat(oid, len(STAMP_CLASSES)),
+            'classifier_name': 'stamp_classifier',
+            'class_name': np.tile(STAMP_CLASSES, n_objects),
+            'probability': stamp[:, :len(STAMP_CLASSES)].ravel(),
+            'ranking': 0,
+        }),
+        pd.DataFrame({
+            'oid': np.repeat(oid, len(LC_CLASSES)),
+            'classifier_name': 'lc_classifier',
+            'class_name': np.tile(LC_CLASSES, n_objects),
+            'probability': lc.ravel(),
+            'ranking': lc_rank.ravel(),
+        }),
+    ], ignore_index=True)
+
+    owner = np.repeat(np.arange(n_objects), objects['ndet'].to_numpy())
+    detection = pd.DataFrame({
+        'oid': oid[owner],
+        'candid': np.arange(len(owner)),
+        'mjd': objects['firstmjd'].to_numpy()[owner] + rng.exponential(20, len(owner)),
+        'fid': rng.integers(1, 3, len(owner)),
+        'magpsf': rng.uniform(17, 21, len(owner)),
+        'sigmapsf': rng.uniform(0.02, 0.2, len(owner)),
+        'drb': rng.random(len(owner)),
+        'has_stamp': True,
+    })
+    ps1_ztf = pd.DataFrame({
+        'oid': oid, 'candid': np.arange(n_objects),
+        'sgscore1': rng.random(n_objects), 'distpsnr1': rng.exponential(2, n_objects),
+    })
+    return {'object': objects, 'probability': probability,
+            'detection': detection, 'ps1_ztf': ps1_ztf}
+
+
+class LocalBackend(Backend):
+    """
+    Offline stand-in for the ALeRCE database on an SQLite file.
+
+    The object table is loaded once and indexed with a k-d tree on unit
+    vectors; cone searches are ball queries, and polygon searches take the
+    objects in the polygon's enclosing cone and keep those inside the
+    polygon in its gnomonic projection, where q3c's great-circle edges are
+    straight lines. Thread-safe, so it also works with ``workers > 1``.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file written by ``write_tables``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._objects = None
+        self._tree = None
+
+    def __repr__(self):
+        return f"LocalBackend({self.path!r})"
+
+    def close(self):
+        self._db.close()
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return pd.read_sql_query(sql, self._db, params=params)
+
+    def _index(self):
+        with self._build_lock:
+            if self._tree is None:
+                objects = self._read(f"SELECT {', '.join(OBJECT_COLUMNS)} FROM object")
+                self._xyz = radec_to_xyz(objects['meanra'].to_numpy(), objects['meandec'].to_numpy())
+                self._objects = objects
+                self._tree = cKDTree(self._xyz)
+        return self._objects, self._tree
+
+    def _cone(self, ra, dec, radius):
+        """Row indices of the objects within ``radius`` deg of (ra, dec)."""
+        _, tree = self._index()
+        chord = 2 * np.sin(np.deg2rad(min(radius, 180.0)) / 2)
+        return np.asarray(tree.query_ball_point(radec_to_xyz(ra, dec), chord), dtype=int)
+
+    def _region(self, plan):
+        """Row indices of the objects inside a planned region."""
+        if plan['kind'] == 'cones':
+            return np.unique(np.concatenate([self._cone(*cone) for cone in plan['cones']]))
+        rows = self._cone(*enclosing_cone(plan['polygon']))
+        region, center = to_tangent_plane(plan['polygon'])
+        xyz = self._xyz[rows]
+        front = xyz @ center > 0
+        rows, xyz = rows[front], xyz[front]
+        xy = gnomonic(xyz, center)
+        return rows[shapely.intersects_xy(region, xy[:, 0], xy[:, 1])]
+
+    def objects(self, plan, mjd_first, mjd_last, near=None, exclude=()):
+        objects, _ = self._index()
+        rows = self._region(plan)
+        for done in exclude:
+            # Equivalent of the NOT region conditions of the SQL query
+            rows = np.setdiff1d(rows, self._region(done))
+        if near is not None:
+            # Equivalent of the q3c_join against the uploaded positions
+            ra, dec, radius = near
+            if len(ra) == 0:
+                rows = rows[:0]
+            else:
+                chord = 2 * np.sin(np.deg2rad(radius) / 2)
+                counts = cKDTree(radec_to_xyz(ra, dec)).query_ball_point(
+                    self._xyz[rows], chord, return_length=True)
+                rows = rows[np.asarray(counts) > 0]
+        found = objects.iloc[np.sort(rows)]
+        first = found['firstmjd']
+        return found[(first >= mjd_first) & (first <= mjd_last)].reset_index(drop=True)
+
+    def _with_oids(self, oids, sql):
+        """Run ``sql`` with the oids loaded into the temporary table ``oids``."""
+        with self._lock:
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS oids (oid TEXT PRIMARY KEY)")
+            self._db.execute("DELETE FROM oids")
+            self._db.executemany("INSERT OR IGNORE INTO oids VALUES (?)", [(str(o),) for o in oids])
+            return pd.read_sql_query(sql, self._db)
+
+    def classifiers(self, oids, classifier=None):
+        rows = self._with_oids(oids, """
+            SELECT object.oid, object.meanra, object.meandec, object.firstmjd,
+                   object.ndet, probability.probability, probability.class_name,
+                   probability.classifier_name, probability.ranking
+            FROM oids
+            JOIN object ON object.oid = oids.oid
+            JOIN probability ON probability.oid = oids.oid
+        """)
+        stamp = ((rows['classifier_name'] == 'stamp_classifier')
+                 & rows['class_name'].isin(STAMP_CLASSES))
+        lc = ((rows['classifier_name'] == 'lc_classifier')
+              & rows['class_name'].isin(LC_CLASSES) & (rows['ranking'] == 1))
+        if classifier == 'stamp_classifier':
+            rows = rows[stamp & (rows['probability'] > 0.5)]
+        elif classifier == 'lc_classifier':
+            rows = rows[lc]
+        else:
+            rows = rows[(stamp | lc) & (rows['probability'] > 0.5)]
+            rows = rows.assign(is_stamp=rows['classifier_name'] == 'stamp_classifier')
+            rows = rows.sort_values(['oid', 'is_stamp', 'probability'],
+                                    ascending=[True, False, False], kind='stable')
+            rows = rows.drop_duplicates('oid').drop(columns='is_stamp')
+        return rows.drop(columns='ranking').reset_index(drop=True)
+
+    def detections(self, oids):
+        rows = self._with_oids(oids, """
+            SELECT det.oid, det.drb, det.fid, det.mjd, det.magpsf, det.sigmapsf,
+                   det.has_stamp, ps1.sgscore1, ps1.distpsnr1
+            FROM oids
+            JOIN detection AS det ON det.oid = oids.oid
+            JOIN ps1_ztf AS ps1 ON ps1.oid = oids.oid
+            WHERE (ps1.sgscore1 < 0.5 OR ps1.distpsnr1 > 1)
+              AND det.drb > 0.5
+            ORDER BY det.oid, det.mjd, det.candid, ps1.candid
+        """)
+        return rows.drop_duplicates('oid').reset_index(drop=True)
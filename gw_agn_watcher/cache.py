@@ -0,0 +1,286 @@
+"""
+cache.py
+
+Persistent on-disk cache of ALeRCE query results.
+
+Results are stored in a single SQLite file, keyed by a fingerprint of the
+normalized query (SQL text, which already encodes the polygon or cones
+and the MJD window, plus the sorted oid set for the classifier and
+detection queries). The cache is bounded in size with least-recently-used
+eviction and can expire entries after a time-to-live. Classifier and
+detection results always expire after ``OID_QUERY_TTL``, since they change
+as new alerts of the same objects arrive.
+
+Results are stored as JSON (DataFrames in the pandas table schema, which
+keeps the column dtypes), never as pickles, so reading a cache file can
+not run code.
+
+The query modules consult the cache transparently through ``cached``; it
+is off until ``enable_cache`` is called, or ``enable_cache_from_env`` finds
+the ``GW_AGN_WATCHER_CACHE`` environment variable set (to a file path, or
+to ``1`` for the default location).
+"""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gw_agn_watcher",
+                                  "queries.sqlite")
+# Maximum age (s) of cached classifier and detection results
+OID_QUERY_TTL = 86400.0
+
+
+def _normalize(part):
+    """Turn a fingerprint part into plain, order-stable JSON types."""
+    if isinstance(part, dict):
+        return {str(k): _normalize(v) for k, v in sorted(part.items())}
+    if isinstance(part, (set, frozenset)):
+        return sorted(str(p) for p in part)
+    if isinstance(part, (list, tuple, np.ndarray)):
+        return [_normalize(p) for p in part]
+    if isinstance(part, np.generic):
+        return part.item()
+    return part
+
+
+def _encode(value):
+    """Serialize a result to JSON bytes (DataFrames in the table schema)."""
+    if isinstance(value, pd.DataFrame):
+        value = {'frame': value.to_json(orient='table', index=False, double_precision=15)}
+    else:
+        value = {'value': value}
+    return json.dumps(value).encode()
+
+
+def _decode(data):
+    """Inverse of ``_encode``."""
+    value = json.loads(bytes(data).decode())
+    if 'frame' in value:
+        return pd.read_json(io.StringIO(value['frame']), orient='table')
+    return value['value']
+
+
+def fingerprint(*parts):
+    """
+    Stable hash of the parts describing a query.
+
+    Parameters
+    ----------
+    *parts
+        Strings, numbers, sequences, sets (order-insensitive) or dicts.
+
+    Returns
+    -------
+    str
+        Hex SHA-256 digest.
+    """
+    text = json.dumps([_normalize(p) for p in parts], default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class QueryCache:
+    """
+    Size-bounded, optionally expiring store of query results on disk.
+
+    Parameters
+    ----------
+    path : str, optional
+        SQLite file (default ``DEFAULT_CACHE_PATH``); parent directories
+        are created.
+    max_bytes : int, optional
+        Total size of the stored results; the least recently used entries
+        are evicted beyond it (default 1 GiB).
+    ttl : float, optional
+        Entries older than this many seconds are ignored and removed
+        (default None, never expire).
+    """
+
+    def __init__(self, path=None, max_bytes=2**30, ttl=None):
+        self.path = path or DEFAULT_CACHE_PATH
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def __repr__(self):
+        return f"QueryCache({self.path!r}, entries={len(self)}, hits={self.hits}, misses={self.misses})"
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, created REAL, accessed REAL,
+                    nbytes INTEGER, data BLOB)
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key, ttl=None):
+        """Return the stored result for ``key``, or None on a miss.
+
+        ``ttl`` further limits the age of the entry for this lookup."""
+        ttl = min((t for t in (self.ttl, ttl) if t is not None), default=None)
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT created, data FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and ttl is not None and time.time() - row[0] > ttl:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                db.commit()
+                row = None
+            value = None
+            if row is not None:
+                try:
+                    value = _decode(row[1])
+                except (ValueError, KeyError, TypeError):
+                    # Written in another format (e.g. by an older version)
+                    db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    db.commit()
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store ``value`` under ``key``, evicting old entries if needed."""
+        data = _encode(value)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                       (key, now, now, len(data), sqlite3.Binary(data)))
+            total = db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                evict = []
+                for old_key, nbytes in db.execute(
+                        "SELECT key, nbytes FROM entries ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    total -= nbytes
+                db.executemany("DELETE FROM entries WHERE key = ?", evict)
+            db.commit()
+
+    def fetch(self, key, query, ttl=None):
+        """Return the stored result for ``key``, running ``query()`` on a miss."""
+        value = self.get(key, ttl=ttl)
+        if value is None:
+            value = query()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._connect().execute("DELETE FROM entries")
+            self._db.commit()
+
+    @property
+    def nbytes(self):
+        """Total size of the stored results (bytes)."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+            self._db = None
+
+
+_cache = None
+
+
+def enable_cache(path=None, max_bytes=2**30, ttl=None):
+    """
+    Turn on the shared query cache used by the query modules.
+
+    Parameters are those of ``QueryCache``.
+
+    Returns
+    -------
+    QueryCache
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = QueryCache(path, max_bytes=max_bytes, ttl=ttl)
+    return _cache
+
+
+def enable_cache_from_env(max_bytes=2**30, ttl=None):
+    """
+    Turn on the shared cache if ``GW_AGN_WATCHER_CACHE`` is set.
+
+    The variable holds the cache file path, or ``1`` for the default
+    location; a cache enabled explicitly is kept. Called by
+    ``main_pipeline.run_pipeline``.
+
+    Returns
+    -------
+    QueryCache or None
+        The active cache (None when caching stays off).
+    """
+    path = os.environ.get("GW_AGN_WATCHER_CACHE")
+    if path and _cache is None:
+        enable_cache(None if path == "1" else path, max_bytes=max_bytes, ttl=ttl)
+    return _cache
+
+
+def disable_cache():
+    """Turn off the shared query cache (the file is kept)."""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def get_cache():
+    """Return the shared ``QueryCache``, or None when caching is off."""
+    return _cache
+
+
+def cached(parts, query, enabled=True, ttl=None):
+    """
+    Run ``query()`` through the shared cache.
+
+    Parameters
+    ----------
+    parts : sequence
+        Fingerprint parts identifying the query (see ``fingerprint``).
+    query : callable
+        Function returning the result on a cache miss.
+    enabled : bool, optional
+        If False, bypass the cache for this call (e.g. for an MJD window
+        that is still open).
+    ttl : float, optional
+        Maximum age (s) of a stored result for this query, on top of the
+        cache's own ``ttl``; older results are fetched again.
+    """
+    if _cache is None or not enabled:
+        return query()
+    return _cache.fetch(fingerprint(*parts), query, ttl=ttl)
@@ -1,93 +1,255 @@
 # query_classifiers.py
 import pandas as pd
-import math
+import numpy as np
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 
-def query_classifiers(conn, new_df, batch_size=10000):
+from .backends import Backend
+from .cache import OID_QUERY_TTL, cached
+from .db import BULK_OIDS, alerce_connection, get_pool, read_prepared
+
+# The oids of a batch are sent as one text[] parameter ($1)
+QUERY_STAMP = """
+    SELECT object.oid, object.meanra, object.meandec, object.firstmjd,
+           object.ndet, probability.probability, probability.class_name,
+           probability.classifier_name
+    FROM object
+    INNER JOIN probability ON object.oid = probability.oid
+    WHERE object.oid = ANY($1)
+      AND probability.classifier_name = 'stamp_classifier'
+      AND probability.class_name IN ('SN','AGN')
+    GROUP BY object.oid, object.meanra, object.meandec, object.firstmjd,
+             object.ndet, probability.classifier_name,
+             probability.probability, probability.class_name
+    HAVING SUM(
+        CASE WHEN probability.class_name = 'SN' THEN probability.probability ELSE 0 END +
+        CASE WHEN probability.class_name = 'AGN' THEN probability.probability ELSE 0 END
+    ) > 0.5
+"""
+
+QUERY_LC = """
+    SELECT object.oid, object.meanra, object.meandec, object.firstmjd,
+           object.ndet, probability.probability, probability.class_name,
+           probability.classifier_name
+    FROM object
+    INNER JOIN probability ON object.oid = probability.oid
+    WHERE object.oid = ANY($1)
+      AND probability.classifier_name = 'lc_classifier'
+      AND probability.class_name IN ('AGN','QSO','Blazar','SLSN','SNII','SNIbc','SNIa')
+      AND probability.ranking = 1
+"""
+
+# Both classifiers in one round trip: rows are thresholded on the server
+# and DISTINCT ON keeps, per oid, the stamp row if there is one (the
+# stamp-over-lc precedence of the two-query path), else the lc row.
+QUERY_COMBINED = """
+    SELECT DISTINCT ON (object.oid)
+           object.oid, object.meanra, object.meandec, object.firstmjd,
+           object.ndet, probability.probability, probability.class_name,
+           probability.classifier_name
+    FROM object
+    INNER JOIN probability ON object.oid = probability.oid
+    WHERE object.oid = ANY($1)
+      AND probability.probability > 0.5
+      AND ((probability.classifier_name = 'stamp_classifier'
+            AND probability.class_name IN ('SN','AGN'))
+        OR (probability.classifier_name = 'lc_classifier'
+            AND probability.class_name IN ('AGN','QSO','Blazar','SLSN','SNII','SNIbc','SNIa')
+            AND probability.ranking = 1))
+    ORDER BY object.oid,
+             probability.classifier_name = 'stamp_classifier' DESC,
+             probability.probability DESC
+"""
+
+CLASSIFIER_COLUMNS = {
+    'oid': object, 'meanra': float, 'meandec': float, 'firstmjd': float,
+    'ndet': np.int64, 'probability': float, 'class_name': object, 'classifier_name': object,
+}
+
+def query_classifiers(conn, new_df, batch_size=10000, combined=True, workers=1,
+                      target_latency=None, min_batch=500, max_batch=50000, pool=None):
     """
     Query ALeRCE for both stamp_classifier and lc_classifier results,
     filter high-probability sources, and merge them into one DataFrame.
 
     Parameters
     ----------
-    conn : psycopg2 connection
-        Active connection to the ALeRCE database.
+    conn : psycopg2 connection, backends.Backend or None
+        Active connection to the ALeRCE database, an offline backend, or
+        None to borrow a connection from the shared pool.
     new_df : pd.DataFrame
         DataFrame with 'oid' (or index = 'oid') to query.
     batch_size : int, optional
-        Number of OIDs per batch (default 10,000).
+        Number of OIDs per batch (default 10,000); the starting size when
+        ``target_latency`` is set.
+    combined : bool, optional
+        If True (default), fetch both classifiers with a single query per
+        batch, thresholded and de-duplicated on the server, into a result
+        table allocated up front. If False, run the two per-classifier
+        queries and combine them client-side.
+    workers : int, optional
+        Number of batches run concurrently (default 1). With a database
+        connection, each concurrent batch borrows a connection from ``pool``
+        (default the shared ``db.get_pool()``).
+    target_latency : float, optional
+        If given (seconds), the size of each new batch is tuned from the
+        measured per-oid latency of the finished ones, within
+        [``min_batch``, ``max_batch``] and by at most a factor of two per
+        step. Batch boundaries then vary between runs, so the query cache
+        is less effective.
+    min_batch, max_batch : int, optional
+        Limits of the tuned batch size (default 500 and 50,000).
 
     Returns
     -------
     candidates : pd.DataFrame
-        Combined SN/AGN/QSO/Blazar/SLSN sources with probabilities.
+        Combined SN/AGN/QSO/Blazar/SLSN sources with probabilities. The
+        per-batch timings (oids, rows, seconds) are in
+        ``candidates.attrs['batch_timings']``.
     """
 
+    if conn is None and workers <= 1:
+        with alerce_connection() as conn:
+            return query_classifiers(conn, new_df, batch_size, combined, workers,
+                                     target_latency, min_batch, max_batch, pool)
+
     if 'oid' in new_df.columns:
         n = new_df.set_index('oid')
     else:
         n = new_df
 
-    total_oids = n.shape[0]
+    # Sorted unique oids give the same batches (and cache keys) on re-runs
+    oids = sorted(set(n.index))
+    total_oids = len(oids)
     if total_oids == 0:
         print("⚠️ No OIDs to query. Returning empty DataFrame.")
         return pd.DataFrame()
 
-    n_batches = math.ceil(total_oids / batch_size)
-    stamp_class = pd.DataFrame()
-    lc_class = pd.DataFrame()
-
-    print(f"🔍 Running {n_batches} batch(es) for {total_oids} OIDs (batch_size={batch_size})...")
-
-    for i in range(n_batches):
-        batch_oids = n.index[i*batch_size:(i+1)*batch_size]
-        oids_str = ",".join(f"'{oid}'" for oid in batch_oids)
-
-        # --- Stamp classifier query ---
-        query_stamp = f"""
-            SELECT object.oid, object.meanra, object.meandec, object.firstmjd,
-                   object.ndet, probability.probability, probability.class_name,
-                   probability.classifier_name
-            FROM object
-            INNER JOIN probability ON object.oid = probability.oid
-            WHERE object.oid IN ({oids_str})
-              AND probability.classifier_name = 'stamp_classifier'
-              AND probability.class_name IN ('SN','AGN')
-            GROUP BY object.oid, object.meanra, object.meandec, object.firstmjd,
-                     object.ndet, probability.classifier_name,
-                     probability.probability, probability.class_name
-            HAVING SUM(
-                CASE WHEN probability.class_name = 'SN' THEN probability.probability ELSE 0 END +
-                CASE WHEN probability.class_name = 'AGN' THEN probability.probability ELSE 0 END
-            ) > 0.5;
-        """
-        sn = pd.read_sql_query(query_stamp, conn)
-        stamp_class = pd.concat([stamp_class, sn], ignore_index=True)
-
-        # --- Light-curve classifier query ---
-        query_lc = f"""
-            SELECT object.oid, object.meanra, object.meandec, object.firstmjd,
-                   object.ndet, probability.probability, probability.class_name,
-                   probability.classifier_name
-            FROM object
-            INNER JOIN probability ON object.oid = probability.oid
-            WHERE object.oid IN ({oids_str})
-              AND probability.classifier_name = 'lc_classifier'
-              AND probability.class_name IN ('AGN','QSO','Blazar','SLSN','SNII','SNIbc','SNIa')
-              AND probability.ranking = 1;
-        """
-        sn1 = pd.read_sql_query(query_lc, conn)
-        lc_class = pd.concat([lc_class, sn1], ignore_index=True)
-
-        print(f"✅ Batch {i+1}/{n_batches}: stamp={sn.shape[0]}, lc={sn1.shape[0]}")
-
-    # Drop duplicates and filter high-probability
-    stamp_class.drop_duplicates(subset='oid', inplace=True)
-    lc_class.drop_duplicates(subset='oid', inplace=True)
-    lc_class = lc_class.groupby('oid').filter(lambda g: g['probability'].sum() > 0.5)
+    mode = f"adaptive, target {target_latency}s" if target_latency else f"batch_size={batch_size}"
+    print(f"🔍 Querying classifiers for {total_oids} OIDs ({mode}, workers={workers})...")
+
+    # Each batch runs on ``conn`` or, when concurrent, on a pooled connection
+    if isinstance(conn, Backend) or workers <= 1:
+        borrow = lambda: nullcontext(conn)
+    else:
+        borrow = (pool or get_pool()).connection
+
+    def fetch(batch_oids):
+        with borrow() as batch_conn:
+            if combined:
+                return _read_batch(batch_conn, "gw_agn_classifiers", QUERY_COMBINED, batch_oids)
+            # --- Stamp and light-curve classifier queries ---
+            sn = _read_batch(batch_conn, "gw_agn_stamp_classifier", QUERY_STAMP, batch_oids,
+                             classifier='stamp_classifier')
+            sn1 = _read_batch(batch_conn, "gw_agn_lc_classifier", QUERY_LC, batch_oids,
+                              classifier='lc_classifier')
+            return sn, sn1
+
+    batches = _run_batches(oids, fetch, batch_size, workers, target_latency, min_batch, max_batch)
+    if combined:
+        candidates, timings = _collect_combined(batches, total_oids)
+    else:
+        candidates, timings = _collect_separate(batches)
+
+    seconds = np.array([t['seconds'] for t in timings])
+    sizes = [t['oids'] for t in timings]
+    print(f"⏱️ {len(timings)} batch(es): {seconds.sum():.2f}s of queries, "
+          f"{seconds.mean():.2f}s mean, sizes {min(sizes)}-{max(sizes)}.")
+    candidates.attrs['batch_timings'] = timings
+    print(f"\n🏁 Final combined sample: {candidates.shape[0]} objects.")
+    return candidates
+
+
+def _run_batches(oids, fetch, batch_size, workers=1, target_latency=None,
+                 min_batch=500, max_batch=50000):
+    """
+    Run ``fetch`` over consecutive slices of ``oids`` on up to ``workers`` threads.
+
+    Yields (batch_oids, result, seconds) as batches finish. With
+    ``target_latency``, each new batch is sized from the per-oid latency
+    of the last finished one.
+    """
+    def timed(batch_oids):
+        start = time.perf_counter()
+        result = fetch(batch_oids)
+        return result, time.perf_counter() - start
+
+    size, start = batch_size, 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        running = {}
+        while start < len(oids) or running:
+            while start < len(oids) and len(running) < max(1, workers):
+                batch_oids = oids[start:start + size]
+                start += len(batch_oids)
+                running[executor.submit(timed, batch_oids)] = batch_oids
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch_oids = running.pop(future)
+                result, seconds = future.result()
+                yield batch_oids, result, seconds
+                if target_latency is not None and seconds > 0:
+                    ideal = len(batch_oids) * target_latency / seconds
+                    size = int(min(max(ideal, size / 2, min_batch), size * 2, max_batch))
+
+
+def _timing(i, batch_oids, n_rows, seconds, detail):
+    print(f"✅ Batch {i}: {len(batch_oids)} OIDs in {seconds:.2f}s, {detail}")
+    return {'batch': i, 'oids': len(batch_oids), 'rows': n_rows, 'seconds': seconds}
+
+
+def _collect_separate(batches):
+    """Combine the results of the two-query path, stamp rows taking precedence."""
+    stamp_class, lc_class, timings = [], [], []
+    for i, (batch_oids, (sn, sn1), seconds) in enumerate(batches, 1):
+        stamp_class.append(sn)
+        lc_class.append(sn1)
+        timings.append(_timing(i, batch_oids, len(sn) + len(sn1), seconds,
+                               f"stamp={sn.shape[0]}, lc={sn1.shape[0]}"))
+
+    # Drop duplicates and filter high-probability (one row per oid is left,
+    # so the per-oid probability sum is the row's own probability)
+    stamp_class = pd.concat(stamp_class, ignore_index=True).drop_duplicates(subset='oid')
+    lc_class = pd.concat(lc_class, ignore_index=True).drop_duplicates(subset='oid')
+    lc_class = lc_class[lc_class['probability'] > 0.5]
 
     # Combine results
     unique_to_lc = lc_class[~lc_class['oid'].isin(stamp_class['oid'])]
     candidates = pd.concat([stamp_class, unique_to_lc], ignore_index=True)
+    return _stamp_first(candidates), timings
 
-    print(f"\n🏁 Final combined sample: {candidates.shape[0]} objects.")
-    return candidates
+
+def _read_batch(conn, name, sql, batch_oids, classifier=None):
+    """Run one prepared batch query through the shared query cache."""
+    if isinstance(conn, Backend):
+        return conn.classifiers(batch_oids, classifier=classifier)
+    return cached(('classifiers', sql, batch_oids),
+                  lambda: read_prepared(conn, name, sql, [batch_oids],
+                                        bulk=len(batch_oids) >= BULK_OIDS),
+                  ttl=OID_QUERY_TTL)
+
+
+def _collect_combined(batches, total_oids):
+    """Fill the single-query results into a table sized for one row per oid."""
+    # At most one row per oid comes back, so the table can be sized up front
+    columns = {name: np.empty(total_oids, dtype=dtype) for name, dtype in CLASSIFIER_COLUMNS.items()}
+    filled, timings = 0, []
+    for i, (batch_oids, rows, seconds) in enumerate(batches, 1):
+        for name in columns:
+            columns[name][filled:filled + len(rows)] = rows[name].to_numpy()
+        filled += len(rows)
+        n_stamp = int((rows['classifier_name'] == 'stamp_classifier').sum())
+        timings.append(_timing(i, batch_oids, len(rows), seconds,
+                               f"stamp={n_stamp}, lc={len(rows) - n_stamp}"))
+
+    candidates = pd.DataFrame({name: values[:filled] for name, values in columns.items()})
+    return _stamp_first(candidates), timings
+
+
+def _stamp_first(candidates):
+    """Order rows stamp classifier first, then by oid, whatever the batch completion order."""
+    if candidates.empty:
+        return candidates.reset_index(drop=True)
+    is_lc = (candidates['classifier_name'] != 'stamp_classifier').to_numpy()
+    order = np.lexsort((candidates['oid'].to_numpy(dtype=str), is_lc))
+    return candidates.iloc[order].reset_index(drop=True)
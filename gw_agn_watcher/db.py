@@ -1,42 +1,484 @@
 # gw_agn_watcher/db.py
+"""
+db.py
+
+Connections to the ALeRCE PostgreSQL database.
+
+The read-only credentials are fetched from GitHub once per process and
+cached. Connections are handed out by a bounded, thread-safe pool shared
+by all query modules, so a batch run over many events reuses the same few
+connections instead of fetching credentials and reconnecting each time.
+"""
+
+import functools
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
 import requests
 import psycopg2
 
+CREDENTIALS_URL = "https://raw.githubusercontent.com/alercebroker/usecases/master/alercereaduser_v4.json"
+
+# Local parameters used when the remote credentials or database are unavailable
+DEFAULT_FALLBACK_PARAMS = {
+    "dbname": "alerce_local",
+    "user": "alerceuser",
+    "host": "localhost",
+    "password": "your_fallback_password"
+}
+_fallback_params = dict(DEFAULT_FALLBACK_PARAMS)
+
+
+def set_fallback_params(params=None, **kwargs):
+    """
+    Configure the local database used when the remote connection fails.
+
+    Parameters
+    ----------
+    params : dict or None, optional
+        psycopg2 connection parameters; None disables the fallback.
+    **kwargs
+        Individual parameters updated on top of the current ones
+        (e.g. ``host='db.example.org'``).
+    """
+    global _fallback_params
+    if params is None and not kwargs:
+        _fallback_params = None
+        return
+    base = dict(params if params is not None else (_fallback_params or DEFAULT_FALLBACK_PARAMS))
+    base.update(kwargs)
+    _fallback_params = base
+
+
+@functools.lru_cache(maxsize=4)
+def alerce_params(url=CREDENTIALS_URL):
+    """
+    Fetch the ALeRCE read-only connection parameters (cached per URL).
+
+    Failed fetches raise and are not cached, so the next call retries.
+    """
+    params = requests.get(url, timeout=10).json()["params"]
+    return {key: params[key] for key in ("dbname", "user", "host", "password")}
+
 
 def get_alerce_connection():
     """
     Try connecting to ALeRCE DB using remote credentials.
     If that fails (fetch or connect), fall back to local parameters.
-    """
-    url = "https://raw.githubusercontent.com/alercebroker/usecases/master/alercereaduser_v4.json"
-
-    # Define fallback parameters
-    fallback_params = {
-        "dbname": "alerce_local",
-        "user": "alerceuser",
-        "host": "localhost",
-        "password": "your_fallback_password"
-    }
 
+    This always opens a new connection; prefer ``alerce_connection()`` to
+    borrow one from the shared pool.
+    """
     try:
         # --- Attempt remote fetch + connection ---
-        params = requests.get(url, timeout=10).json()["params"]
-        conn = psycopg2.connect(
-            dbname=params["dbname"],
-            user=params["user"],
-            host=params["host"],
-            password=params["password"]
-        )
+        conn = psycopg2.connect(**alerce_params())
         print("✅ Connected to ALeRCE remote database.")
     except Exception as e:
+        if _fallback_params is None:
+            raise
         print(f"⚠️ Remote connection failed: {e}")
         print("🔁 Falling back to local database parameters...")
-        conn = psycopg2.connect(
-            dbname=fallback_params["dbname"],
-            user=fallback_params["user"],
-            host=fallback_params["host"],
-            password=fallback_params["password"]
-        )
+        conn = psycopg2.connect(**_fallback_params)
         print("✅ Connected to local fallback database.")
 
     return conn
+
+
+def _healthy(conn):
+    """Return True if ``conn`` is open and answers a trivial query."""
+    try:
+        if getattr(conn, "closed", 0):
+            return False
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+            cur.fetchone()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections.
+
+    At most ``maxsize`` connections exist at a time; ``acquire`` blocks
+    when all of them are in use. Idle connections are checked with a
+    ``SELECT 1`` before reuse when they have been idle for more than
+    ``ping_after`` seconds, and broken ones are replaced transparently.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of open connections (default 4).
+    connect : callable, optional
+        Factory returning a new connection (default ``get_alerce_connection``).
+    ping_after : float, optional
+        Idle time (s) after which a connection is health-checked (default 30).
+    """
+
+    def __init__(self, maxsize=4, connect=None, ping_after=30.0):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.connect = connect or get_alerce_connection
+        self.ping_after = ping_after
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return f"ConnectionPool(maxsize={self.maxsize}, open={self._size}, idle={len(self._idle)})"
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a healthy connection, opening one if needed.
+
+        Raises
+        ------
+        TimeoutError
+            If no connection becomes available within ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.maxsize:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No database connection available")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, since = self._idle.pop()
+                else:
+                    conn, since = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            if time.monotonic() - since < self.ping_after or _healthy(conn):
+                return conn
+            # Stale connection: drop it and try again
+            print("🔁 Replacing a broken database connection...")
+            self._discard(conn)
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool (or close it if ``discard``)."""
+        if not discard:
+            try:
+                # End the transaction left open by read-only queries
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or getattr(conn, "closed", 0):
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn):
+        _close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager borrowing a connection from the pool.
+
+        Connections that fail with a database or interface error are
+        discarded instead of being returned, so the next caller gets a
+        fresh one.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        """Close all idle connections; borrowed ones come back to the pool as usual."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+
+# Names of the statements already prepared on each open connection
+_prepared = weakref.WeakKeyDictionary()
+
+# Expected result size (rows) from which COPY ... TO STDOUT is used
+BULK_ROWS = 50000
+# Oid batches from this size on are fetched with COPY; the classifier and
+# detection queries return about one row per oid
+BULK_OIDS = 5000
+
+
+def copy_query(conn, sql, params=None, dtypes=None):
+    """
+    Fetch a query result in bulk with ``COPY (query) TO STDOUT``.
+
+    The server streams the rows as CSV through a pipe, which the pandas C
+    parser decodes as it arrives straight into typed NumPy columns; neither
+    the CSV text nor a Python tuple per row is held in memory, which saves
+    client CPU time and peak memory on large results.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        Open connection.
+    sql : str
+        SELECT statement (a trailing semicolon is allowed), with optional
+        psycopg2 ``%s`` / ``%(name)s`` placeholders.
+    params : sequence or dict, optional
+        Values bound client-side into the statement.
+    dtypes : dict, optional
+        Column dtypes passed to ``pandas.read_csv`` (default: 'oid' as str).
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    sql = sql.strip().rstrip(";").strip()
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        # Write the COPY output into the pipe while it is being parsed
+        with open(write_fd, "wb") as writer:
+            try:
+                with conn.cursor() as cur:
+                    copy_sql = cur.mogrify(sql, params).decode() if params is not None else sql
+                    cur.copy_expert(f"COPY ({copy_sql}) TO STDOUT WITH (FORMAT csv, HEADER true)",
+                                    writer)
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=produce, daemon=True)
+    writer.start()
+    try:
+        # Closing the reader on a parse error unblocks the writer
+        with open(read_fd, "rb") as reader:
+            frame = pd.read_csv(reader, dtype=dtypes or {"oid": str},
+                                true_values=["t"], false_values=["f"])
+    except Exception as e:
+        writer.join()
+        # The writer's BrokenPipeError only follows from the closed reader;
+        # a COPY that failed on its own is kept as the cause
+        if errors and not isinstance(errors[0], BrokenPipeError):
+            raise e from errors[0]
+        raise
+    writer.join()
+    if errors:
+        raise errors[0]
+    return frame
+
+
+def read_query(conn, sql, params=None, expected_rows=None):
+    """
+    Run a query, switching to the bulk COPY path for large results.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        Open connection.
+    sql : str
+        SELECT statement.
+    params : sequence or dict, optional
+        Query parameters.
+    expected_rows : float, optional
+        Estimated result size; from ``BULK_ROWS`` rows on, ``copy_query``
+        is tried first and ``pandas.read_sql_query`` is the fallback.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if expected_rows is not None and expected_rows >= BULK_ROWS:
+        try:
+            return copy_query(conn, sql, params)
+        except Exception as e:
+            print(f"⚠️ Bulk COPY fetch failed ({e}); falling back to row fetch.")
+            rollback_quietly(conn)
+    if params is None:
+        return pd.read_sql_query(sql, conn)
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+def rollback_quietly(conn):
+    """
+    Roll back ``conn`` after a failed statement, ignoring any error.
+
+    A failed statement aborts the transaction; this makes the connection
+    usable for the next query (e.g. a fallback) without masking the
+    original failure if the rollback itself fails.
+    """
+    try:
+        conn.rollback()
+    except Exception:
+        pass
+
+
+def read_prepared(conn, name, sql, params, types=("text[]",), bulk=False):
+    """
+    Run a server-side prepared statement and return its rows as a DataFrame.
+
+    The statement is prepared once per connection and reused for every
+    later call, so the server parses and plans it only once. Parameters
+    are sent separately from the SQL text: a Python list is passed as a
+    single array (use ``= ANY($1)`` in ``sql``), however many values it
+    holds.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        Open connection.
+    name : str
+        Statement name (a valid SQL identifier).
+    sql : str
+        Statement body with ``$1``, ``$2``, ... placeholders.
+    params : sequence
+        Parameter values, one per placeholder.
+    types : sequence of str, optional
+        SQL types of the parameters (default one ``text[]``).
+    bulk : bool, optional
+        Fetch with ``copy_query`` instead (COPY cannot run a prepared
+        statement, so the parameters are bound client-side); falls back
+        to the prepared statement on failure.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if bulk:
+        try:
+            return copy_query(conn, re.sub(r"\$(\d+)", r"%(p\1)s", sql),
+                              {f"p{i + 1}": value for i, value in enumerate(params)})
+        except Exception as e:
+            print(f"⚠️ Bulk COPY fetch failed ({e}); falling back to row fetch.")
+            rollback_quietly(conn)
+    done = _prepared.setdefault(conn, set())
+    with conn.cursor() as cur:
+        if name not in done:
+            cur.execute(f"PREPARE {name}({', '.join(types)}) AS {sql}")
+            done.add(name)
+        cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", tuple(params))
+        columns = [col[0] for col in cur.description]
+        return pd.DataFrame(cur.fetchall(), columns=columns)
+
+
+# Temporary table holding the positions uploaded by ``upload_positions``
+POSITIONS_TABLE = "gw_agn_positions"
+
+# Key of the positions last uploaded to each open connection, per table
+_uploaded = weakref.WeakKeyDictionary()
+
+
+def positions_key(ra, dec):
+    """Hash identifying a set of positions (as uploaded by ``upload_positions``)."""
+    data = np.stack([np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)])
+    return hashlib.sha256(np.ascontiguousarray(data).tobytes()).hexdigest()
+
+
+def upload_positions(conn, ra, dec, table=POSITIONS_TABLE, key=None):
+    """
+    Load positions into a temporary table indexed for ``q3c_join``.
+
+    The table lives as long as the connection (it is committed, so it
+    survives the rollback done when a pooled connection is released) and
+    is only re-uploaded when different positions are requested on that
+    connection.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection
+        Open connection.
+    ra, dec : array-like
+        Positions in degrees.
+    table : str, optional
+        Temporary table name (default ``POSITIONS_TABLE``), with columns
+        'ra' and 'dec' and a ``q3c_ang2ipix(ra, dec)`` index.
+    key : str, optional
+        Precomputed ``positions_key(ra, dec)``.
+
+    Returns
+    -------
+    str
+        The table name.
+    """
+    key = key or positions_key(ra, dec)
+    done = _uploaded.setdefault(conn, {})
+    if done.get(table) == key:
+        return table
+    buffer = io.StringIO()
+    pd.DataFrame({"ra": ra, "dec": dec}).to_csv(buffer, index=False, header=False,
+                                                float_format="%.8f")
+    buffer.seek(0)
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(f"CREATE TEMP TABLE {table} (ra double precision, dec double precision)")
+        cur.copy_expert(f"COPY {table} (ra, dec) FROM STDIN WITH (FORMAT csv)", buffer)
+        cur.execute(f"CREATE INDEX ON {table} (q3c_ang2ipix(ra, dec))")
+        cur.execute(f"ANALYZE {table}")
+    conn.commit()
+    done[table] = key
+    return table
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(maxsize=4):
+    """
+    Return the process-wide ALeRCE connection pool, creating it on first use.
+
+    ``maxsize`` only applies when the pool is created.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(maxsize=maxsize)
+        return _pool
+
+
+def alerce_connection(timeout=None):
+    """
+    Borrow a connection from the shared pool.
+
+    Example
+    -------
+    >>> with alerce_connection() as conn:
+    ...     df = pd.read_sql_query(query, conn)
+    """
+    return get_pool().connection(timeout)
@@ -7,7 +7,32 @@ Purpose: Query ALeRCE detection and PS1 data for a given list of oids,
 
 import pandas as pd
 
-def query_detections(stamplc, conn):
+from .backends import Backend
+from .cache import OID_QUERY_TTL, cached
+from .db import BULK_OIDS, alerce_connection, read_prepared
+
+# The oids of a batch are sent once, as one text[] parameter ($1).
+# DISTINCT ON keeps a single row per oid on the server: its earliest
+# passing detection (ties broken by candid, then by the PS1 match).
+QUERY_DETECTIONS = """
+    SELECT DISTINCT ON (det.oid)
+        det.oid, det.drb, det.fid,
+        det.mjd, det.magpsf, det.sigmapsf,
+        det.has_stamp,
+        ps1.sgscore1, ps1.distpsnr1
+    FROM detection AS det
+    INNER JOIN ps1_ztf AS ps1
+        ON det.oid = ps1.oid
+    WHERE
+        det.oid = ANY($1)
+        AND ps1.oid = ANY($1)
+        AND (ps1.sgscore1 < 0.5 OR ps1.distpsnr1 > 1)
+        AND det.drb > 0.5
+    ORDER BY det.oid, det.mjd, det.candid, ps1.candid
+"""
+
+
+def query_detections(stamplc, conn, batch_size=5000):
     """
     Query detections and PS1 matches for a given set of object IDs (oids).
 
@@ -15,49 +40,43 @@ def query_detections(stamplc, conn):
     ----------
     stamplc : pandas.DataFrame
         DataFrame containing an 'oid' column with object IDs.
-    conn : psycopg2 connection
-        Active database connection to the ALeRCE PostgreSQL database.
+    conn : psycopg2 connection, backends.Backend or None
+        Active database connection to the ALeRCE PostgreSQL database, an
+        offline backend, or None to borrow a connection from the shared pool.
+    batch_size : int, optional
+        Number of oids per query (default 5,000).
 
     Returns
     -------
     detections : pandas.DataFrame
-        Filtered detections joined with PS1 metadata.
+        One row per oid: its earliest detection passing the DRB and PS1
+        cuts, joined with the PS1 metadata.
     """
 
+    if conn is None:
+        with alerce_connection() as conn:
+            return query_detections(stamplc, conn, batch_size)
+
     if stamplc.empty:
         print("⚠️ No oids provided — returning empty DataFrame.")
         return pd.DataFrame()
 
-    # Build comma-separated list of OIDs for the query
-    oid_list = ",".join([f"'{x}'" for x in stamplc["oid"].unique()])
-
-    query = f"""
-        SELECT
-            det.oid, det.drb, det.fid,
-            det.mjd, det.magpsf, det.sigmapsf,
-            det.has_stamp,
-            ps1.sgscore1, ps1.distpsnr1
-        FROM
-            (SELECT *
-             FROM detection
-             WHERE oid IN ({oid_list})
-            ) AS det
-        INNER JOIN
-            (SELECT *
-             FROM ps1_ztf
-             WHERE oid IN ({oid_list})
-            ) AS ps1
-        ON det.oid = ps1.oid
-        WHERE
-            (ps1.sgscore1 < 0.5 OR ps1.distpsnr1 > 1)
-            AND det.drb > 0.5;
-    """
-
-    # Execute SQL and return DataFrame
-    detections = pd.read_sql_query(query, conn)
-
-    # Drop duplicate OIDs to keep one per source
-    detections = detections.drop_duplicates(subset="oid", keep="first")
+    # Execute one prepared statement per batch of oids; sorted oids give
+    # the same batches (and cache keys) on re-runs
+    oids = sorted(stamplc["oid"].unique())
+    batches = []
+    for i in range(0, len(oids), batch_size):
+        batch_oids = oids[i:i + batch_size]
+        if isinstance(conn, Backend):
+            batches.append(conn.detections(batch_oids))
+            continue
+        batches.append(cached(
+            ('detections', QUERY_DETECTIONS, batch_oids),
+            lambda: read_prepared(conn, "gw_agn_detections", QUERY_DETECTIONS, [batch_oids],
+                                  bulk=len(batch_oids) >= BULK_OIDS),
+            ttl=OID_QUERY_TTL))
+    # Each oid is in one batch and comes back at most once
+    detections = pd.concat(batches, ignore_index=True)
 
     print(f"✅ Retrieved {len(detections)} detections after filtering.")
     return detections
@@ -4,12 +4,83 @@ dividemap.py
 Divide a GW skymap (RA, Dec positions) into spatial regions using K-Means clustering.
 """
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans
 
+from .sphere import gnomonic, mean_direction, radec_to_xyz
 
-def dividemap(num_regions, df, plot=True, random_state=42):
+CLUSTER_METHODS = ('planar', 'sphere', 'tangent')
+
+
+def cluster_features(df, method='planar'):
+    """
+    Build the feature matrix K-Means runs on.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame containing at least the columns 'meanra' and 'meandec'.
+    method : {'planar', 'sphere', 'tangent'}, optional
+        'planar' uses raw (meanra, meandec) as before. 'sphere' uses 3-D
+        unit vectors, so regions crossing RA=0/360 or a pole stay together.
+        'tangent' uses a gnomonic projection about the mean direction
+        (falls back to 'sphere' if the points span more than a hemisphere).
+
+    Returns
+    -------
+    ndarray
+        Features, one row per row of ``df``.
+    """
+    if method not in CLUSTER_METHODS:
+        raise ValueError(f"method must be one of {CLUSTER_METHODS}, got {method!r}")
+    if method == 'planar':
+        return df[['meanra', 'meandec']].to_numpy()
+
+    xyz = radec_to_xyz(df['meanra'].to_numpy(), df['meandec'].to_numpy())
+    if method == 'tangent':
+        center = mean_direction(xyz)
+        if center is not None and (xyz @ center).min() > 0.1:
+            return np.rad2deg(gnomonic(xyz, center))
+    return xyz
+
+
+def fit_kmeans(df, n_clusters, method='planar', weighted=False, random_state=42, n_init=10):
+    """
+    Fit K-Means on the features of ``cluster_features``.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame containing at least the columns 'meanra' and 'meandec'
+        (and 'prob' if ``weighted``).
+    n_clusters : int
+        Number of clusters.
+    method : {'planar', 'sphere', 'tangent'}, optional
+        Feature space, see ``cluster_features``.
+    weighted : bool, optional
+        If True, weight every pixel by its 'prob' column.
+    random_state : int, optional
+        Random seed for KMeans reproducibility.
+    n_init : int or 'auto', optional
+        Number of KMeans initialisations.
+
+    Returns
+    -------
+    kmeans : sklearn.cluster.KMeans
+        The fitted KMeans model.
+    labels : ndarray
+        Cluster label of every row of ``df``.
+    """
+    weights = df['prob'].to_numpy() if weighted else None
+    kmeans = KMeans(n_clusters=n_clusters, n_init=n_init, random_state=random_state)
+    labels = kmeans.fit_predict(cluster_features(df, method), sample_weight=weights)
+    return kmeans, labels
+
+
+def dividemap(num_regions, df, plot=True, random_state=42, labels=None,
+              method='planar', weighted=False):
     """
     Divide a LIGO/Virgo/KAGRA skymap DataFrame into clusters (spatial regions)
     using K-Means clustering on RA and Dec.
@@ -24,25 +95,35 @@ def dividemap(num_regions, df, plot=True, random_state=42):
         If True, shows a scatter plot of RA/Dec colored by cluster label.
     random_state : int, optional
         Random seed for KMeans reproducibility.
+    labels : array-like, optional
+        Cluster labels already validated by ``findminclust.find_min_clusters``
+        (with ``return_labels=True``). When given, no new fit is made.
+    method : {'planar', 'sphere', 'tangent'}, optional
+        Feature space for K-Means, see ``cluster_features``.
+    weighted : bool, optional
+        If True, weight every pixel by its 'prob' column.
 
     Returns
     -------
     df_out : pandas.DataFrame
         Input DataFrame with an additional column 'cluster_label' (int).
-    kmeans : sklearn.cluster.KMeans
-        The fitted KMeans model.
+    kmeans : sklearn.cluster.KMeans or None
+        The fitted KMeans model (None if ``labels`` was given).
     """
 
     if not {'meanra', 'meandec'}.issubset(df.columns):
         raise ValueError("DataFrame must contain columns 'meanra' and 'meandec'")
 
-    # Fit a K-Means model
-    kmeans = KMeans(n_clusters=num_regions, random_state=random_state)
-    kmeans.fit(df[['meanra', 'meandec']])
+    if labels is None:
+        # Fit a K-Means model
+        kmeans, labels = fit_kmeans(df, num_regions, method=method, weighted=weighted,
+                                    random_state=random_state, n_init='auto')
+    else:
+        kmeans = None
 
     # Add cluster labels to the DataFrame
     df_out = df.copy()
-    df_out['cluster_label'] = kmeans.labels_
+    df_out['cluster_label'] = labels
 
     # Optional plot
     if plot:
@@ -60,7 +141,6 @@ def dividemap(num_regions, df, plot=True, random_state=42):
 if __name__ == "__main__":
     # Example usage
     # Generate a mock dataset for testing
-    import numpy as np
     ra = np.random.uniform(0, 360, 5000)
     dec = np.random.uniform(-60, 60, 5000)
     df_mock = pd.DataFrame({'meanra': ra, 'meandec': dec})
@@ -1,24 +1,28 @@
 """
 findclusters.py
 
-Adaptive sky map segmentation using K-Means and alpha shapes.
+Adaptive sky map segmentation using K-Means and HEALPix-boundary
+(or alpha-shape) polygons.
 Finds the minimum number of clusters (regions) such that
 each region satisfies angular and geometric constraints.
 
 Dependencies:
-    pandas, numpy, matplotlib, scikit-learn, alphashape, astropy
+    pandas, numpy, scipy, matplotlib, scikit-learn, alphashape
 """
 
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
 import alphashape
-from astropy.coordinates import SkyCoord
-from astropy import units as u
+from shapely.geometry import Polygon
 
+from .divide import fit_kmeans
+from .polygons import healpix_polygon
+from .sphere import (great_circle_diameter, gnomonic, gnomonic_inverse,
+                     mean_direction, radec_to_xyz, xyz_to_radec)
 
-def polygon_diameter(polygon):
+
+def polygon_diameter(polygon, max_diameter=None):
     """
     Return maximum angular separation (deg) among polygon vertices.
 
@@ -26,6 +30,9 @@ def polygon_diameter(polygon):
     ----------
     polygon : shapely.geometry.Polygon
         Polygon describing the region boundary.
+    max_diameter : float, optional
+        If given, return as soon as two vertices farther apart than this
+        are found (the returned value then already exceeds it).
 
     Returns
     -------
@@ -33,19 +40,65 @@ def polygon_diameter(polygon):
         Maximum angular separation in degrees between any two vertices.
     """
     coords = np.array(polygon.exterior.coords)
-    sky = SkyCoord(coords[:, 0], coords[:, 1], unit="deg")
-    sep = sky[:, None].separation(sky[None, :])
-    return sep.max().deg
+    return great_circle_diameter(radec_to_xyz(coords[:, 0], coords[:, 1]),
+                                 max_diameter=max_diameter)
 
 
-def check_clusters(df, n_clusters, max_vertices=100, max_diameter=25, random_state=42):
+def cluster_polygon(points, alpha=0.01, method='planar'):
     """
-    Cluster points and check if all polygons satisfy vertex and diameter limits.
+    Alpha-shape polygon around the (ra, dec) points of one cluster.
+
+    ``fit_clusters`` falls back to this only when the pixels are unknown
+    (no 'pixel_no' column); otherwise it traces the HEALPix boundary with
+    ``polygons.healpix_polygon``.
+
+    Parameters
+    ----------
+    points : ndarray, shape (n, 2)
+        RA/Dec of the cluster members (deg).
+    alpha : float, optional
+        Alpha shape parameter (default 0.01).
+    method : {'planar', 'sphere', 'tangent'}, optional
+        With 'planar' the shape is built on raw (ra, dec). Otherwise it is
+        built in the tangent plane of the cluster centre and mapped back,
+        so clusters across RA=0/360 or around a pole are not torn apart;
+        vertex RAs are then unwrapped and may fall outside [0, 360).
+
+    Returns
+    -------
+    shapely geometry
+        Polygon (or degenerate geometry) returned by ``alphashape``.
+    """
+    if method == 'planar':
+        return alphashape.alphashape(points, alpha)
+
+    xyz = radec_to_xyz(points[:, 0], points[:, 1])
+    center = mean_direction(xyz)
+    if center is None or (xyz @ center).min() <= 0.1:
+        return alphashape.alphashape(points, alpha)
+
+    shape = alphashape.alphashape(np.rad2deg(gnomonic(xyz, center)), alpha)
+    if shape.geom_type != "Polygon":
+        return shape
+    ra, dec = xyz_to_radec(gnomonic_inverse(np.deg2rad(np.array(shape.exterior.coords)), center))
+    return Polygon(np.column_stack([np.rad2deg(np.unwrap(np.deg2rad(ra))), dec]))
+
+
+def fit_clusters(df, n_clusters, max_vertices=100, max_diameter=25, random_state=42,
+                 method='planar', weighted=False):
+    """
+    Cluster points and build the polygon of every cluster.
+
+    If ``df`` has a 'pixel_no' (UNIQ) column, each polygon is traced from
+    the boundary of the cluster's HEALPix pixels (``polygons.healpix_polygon``)
+    and always covers them; otherwise an alpha shape of the points is used.
+    Stops at the first cluster that violates the vertex or diameter limit.
 
     Parameters
     ----------
     df : pandas.DataFrame
-        Must contain 'meanra' and 'meandec' columns.
+        Must contain 'meanra' and 'meandec' columns, and preferably
+        'pixel_no'.
     n_clusters : int
         Number of clusters for K-Means.
     max_vertices : int
@@ -54,22 +107,46 @@ def check_clusters(df, n_clusters, max_vertices=100, max_diameter=25, random_sta
         Maximum allowed angular diameter (deg) per cluster.
     random_state : int
         Random seed for reproducibility.
+    method : {'planar', 'sphere', 'tangent'}
+        Clustering feature space, see ``divide.cluster_features``.
+    weighted : bool
+        If True, weight pixels by their 'prob' column.
 
     Returns
     -------
-    bool
+    valid : bool
         True if all clusters satisfy constraints, else False.
+    labels : ndarray
+        Cluster label of every row of ``df``.
+    polygons : dict
+        Polygon per cluster label (for alpha shapes, clusters with fewer
+        than three points or a non-Polygon shape are left out).
     """
-    kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=random_state)
-    df['cluster_label'] = kmeans.fit_predict(df[['meanra', 'meandec']])
+    _, labels = fit_kmeans(df, n_clusters, method=method, weighted=weighted,
+                           random_state=random_state)
+    points = df[['meanra', 'meandec']].to_numpy()
+    uniq = df['pixel_no'].to_numpy() if 'pixel_no' in df.columns else None
+
+    polygons = {}
+    for label in np.unique(labels):
+        if uniq is not None:
+            # Trace the cluster's HEALPix pixels: always one covering polygon,
+            # unless they do not fit in a hemisphere (then k is too small)
+            try:
+                alpha_shape = healpix_polygon(uniq[labels == label], max_vertices=max_vertices - 2)
+            except ValueError:
+                return False, labels, polygons
+            if polygon_diameter(alpha_shape, max_diameter) >= max_diameter:
+                return False, labels, polygons
+            polygons[label] = alpha_shape
+            continue
 
-    for label in df['cluster_label'].unique():
-        cluster_points = df[df['cluster_label'] == label][['meanra', 'meandec']].to_numpy()
+        cluster_points = points[labels == label]
         if len(cluster_points) < 3:
             continue
 
         try:
-            alpha_shape = alphashape.alphashape(cluster_points, 0.01)
+            alpha_shape = cluster_polygon(cluster_points, 0.01, method=method)
         except Exception:
             continue
 
@@ -77,24 +154,73 @@ def check_clusters(df, n_clusters, max_vertices=100, max_diameter=25, random_sta
             continue
 
         verts = len(alpha_shape.exterior.coords)
-        size = polygon_diameter(alpha_shape)
+        if verts >= max_vertices:
+            return False, labels, polygons
+        if polygon_diameter(alpha_shape, max_diameter) >= max_diameter:
+            return False, labels, polygons
+        polygons[label] = alpha_shape
+    return True, labels, polygons
 
-        if verts >= max_vertices or size >= max_diameter:
-            return False
-    return True
+
+def check_clusters(df, n_clusters, max_vertices=100, max_diameter=25, random_state=42,
+                   method='planar', weighted=False):
+    """
+    Cluster points and check if all polygons satisfy vertex and diameter limits.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Must contain 'meanra' and 'meandec' columns.
+    n_clusters : int
+        Number of clusters for K-Means.
+    max_vertices : int
+        Maximum allowed number of polygon vertices per cluster.
+    max_diameter : float
+        Maximum allowed angular diameter (deg) per cluster.
+    random_state : int
+        Random seed for reproducibility.
+    method : {'planar', 'sphere', 'tangent'}
+        Clustering feature space, see ``divide.cluster_features``.
+    weighted : bool
+        If True, weight pixels by their 'prob' column.
+
+    Returns
+    -------
+    bool
+        True if all clusters satisfy constraints, else False.
+    """
+    valid, labels, _ = fit_clusters(df, n_clusters, max_vertices, max_diameter,
+                                    random_state=random_state, method=method,
+                                    weighted=weighted)
+    df['cluster_label'] = labels
+    return valid
 
 
 def find_min_clusters(df, max_vertices=100, max_diameter=25, max_try=200,
-                      random_state=42, plot=False):
+                      random_state=42, plot=False, return_labels=False,
+                      method='planar', weighted=False):
     """
     Find minimum n_clusters that satisfies polygon vertex and diameter constraints.
 
+    Rather than trying every k in turn, k is doubled until a valid
+    clustering is found and the last gap is then bisected. Every fit is
+    cached, so each k is clustered at most once and the labels and polygons
+    of the chosen k can be handed back without refitting.
+
+    The bisection assumes validity is monotonic in k (every k above a valid
+    one is valid too), which K-Means does not guarantee: a different k gives
+    a different partition. The untried k in the last galloping gap, below
+    the bisected one, are therefore also checked, and the smallest valid k
+    found is returned. k below that gap (before the first invalid power of
+    two) are not searched.
+
     Parameters
     ----------
     df : pandas.DataFrame
-        Must contain 'meanra' and 'meandec' columns.
+        Must contain 'meanra' and 'meandec' columns, and preferably
+        'pixel_no' (see ``fit_clusters``).
     max_vertices : int
-        Maximum vertices allowed per alpha shape polygon.
+        Maximum vertices allowed per cluster polygon.
     max_diameter : float
         Maximum angular diameter allowed per region (deg).
     max_try : int
@@ -103,27 +229,74 @@ def find_min_clusters(df, max_vertices=100, max_diameter=25, max_try=200,
         Random seed for reproducibility.
     plot : bool
         If True, plots the final valid clustering.
+    return_labels : bool
+        If True, also return the labels and polygons of the valid clustering.
+    method : {'planar', 'sphere', 'tangent'}
+        Clustering feature space, see ``divide.cluster_features``. The
+        spherical modes keep regions across RA=0/360 and the poles compact.
+    weighted : bool
+        If True, weight pixels by their 'prob' column.
 
     Returns
     -------
     int
         Minimum valid number of clusters.
+    labels : ndarray
+        Cluster label of every row of ``df`` (only if ``return_labels``).
+    polygons : dict
+        Polygon per cluster label (only if ``return_labels``): traced from
+        the cluster's HEALPix pixels with ``polygons.healpix_polygon`` when
+        ``df`` has a 'pixel_no' column, an alpha shape of its points
+        otherwise.
     """
-    for n_clusters in range(1, max_try + 1):
-        if check_clusters(df.copy(), n_clusters, max_vertices, max_diameter,
-                          random_state=random_state):
-            if plot:
-                kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=random_state)
-                df['cluster_label'] = kmeans.fit_predict(df[['meanra', 'meandec']])
-                plt.scatter(df['meanra'], df['meandec'], c=df['cluster_label'],
-                            cmap='tab20', alpha=0.4, s=5)
-                plt.xlabel('RA [deg]')
-                plt.ylabel('Dec [deg]')
-                plt.title(f'Valid segmentation with n_clusters={n_clusters}')
-                plt.show()
-            return n_clusters
-
-    raise RuntimeError("No valid clustering found within max_try clusters")
+    max_try = min(max_try, len(df))
+    fits = {}
+
+    def is_valid(k):
+        if k not in fits:
+            fits[k] = fit_clusters(df, k, max_vertices, max_diameter,
+                                   random_state=random_state, method=method,
+                                   weighted=weighted)
+        return fits[k][0]
+
+    # Gallop: 1, 2, 4, 8, ... until a valid k is found
+    lo, hi, k = 0, None, 1
+    while k <= max_try:
+        if is_valid(k):
+            hi = k
+            break
+        lo = k
+        k = max_try if k < max_try < 2 * k else 2 * k
+    if hi is None:
+        raise RuntimeError("No valid clustering found within max_try clusters")
+
+    # Bisect between the last invalid and the first valid k
+    gap = lo
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if is_valid(mid):
+            hi = mid
+        else:
+            lo = mid
+
+    # Validity need not be monotonic: check the rest of the gap as well
+    for k in range(hi - 1, gap, -1):
+        if is_valid(k):
+            hi = k
+
+    n_clusters = hi
+    _, labels, polygons = fits[n_clusters]
+    if plot:
+        plt.scatter(df['meanra'], df['meandec'], c=labels,
+                    cmap='tab20', alpha=0.4, s=5)
+        plt.xlabel('RA [deg]')
+        plt.ylabel('Dec [deg]')
+        plt.title(f'Valid segmentation with n_clusters={n_clusters}')
+        plt.show()
+
+    if return_labels:
+        return n_clusters, labels, polygons
+    return n_clusters
 
 
 if __name__ == "__main__":
@@ -1,11 +1,8 @@
 import warnings
-import urllib.request
 
 from astropy.table import Table
-from astropy.utils.data import download_file
 from gracedb_sdk import Client
 from ligo.skymap import distance
-from ligo.skymap.io import read_sky_map
 from ligo.skymap.moc import uniq2pixarea
 from ligo.skymap.postprocess.crossmatch import crossmatch
 from ligo.skymap.util import progress_map
@@ -13,6 +10,8 @@ from lxml.etree import parse as parse_xml
 import numpy as np
 import requests.exceptions
 
+from .skymap import load_skymap
+
 client = Client(force_noauth=True)
 def get_params_for_group(voevent_xml, name):
     elems = voevent_xml.findall(f".//Group[@type='{name}']/Param") or {}
@@ -35,13 +34,8 @@ def get_params_for_param(voevent_xml, name):
 
 
 def get_skymap(url):
-    # Try to download the multiorder sky map, since it will be faster.
-    try:
-        new_url = url.replace('.fits.gz', '.multiorder.fits')
-        filename = download_file(new_url, cache=True)
-    except urllib.request.HTTPError:
-        filename = download_file(url, cache=True)
-    return read_sky_map(filename, moc=True)
+    # The shared handle prefers the multiorder sky map, since it will be faster.
+    return load_skymap(url).to_table()
 
 
 def get_skymap_stats(skymap):
@@ -3,50 +3,116 @@ warnings.filterwarnings("ignore")
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
-import importlib
+from contextlib import nullcontext
 
 from . import radecligo, findminclust, divide, mainquery, match_milliquas
-from . import redshift, classifiers, detections, extinction
-from .db import get_alerce_connection
+from . import redshift, classifiers, detections, extinction, cache
+from .db import alerce_connection
+from .skymap import load_skymap
+from .watch import load_state, new_objects, poll_window, record, save_state
 
 
-def run_pipeline(skymap_url, milliquas_csv, sigma_cut="2sigma"):
+def clear_skymap_cache():
+    """Release the sky map kept by ``skymap.load_skymap`` after a run."""
+    load_skymap.cache_clear()
+
+
+def run_pipeline(skymap_url, milliquas_csv, sigma_cut="2sigma", credible_levels=None,
+                 max_tile_level=7, cluster_method="sphere", backend=None, watch=False,
+                 state_dir=None, agn_join=False, on_ring=None, plan=True, workers=4):
+    """
+    Run the GW-AGN crossmatching pipeline for one sky map.
+
+    The sky map's credible region is clustered into query regions, ALeRCE
+    objects in those regions are matched with Milliquas, cut on the
+    event's redshift range, classified, and filtered on extinction.
+
+    Parameters
+    ----------
+    skymap_url : str
+        URL (or local path) of the GW skymap FITS file.
+    milliquas_csv : str
+        Milliquas CSV, or a directory written by ``match_milliquas.build_catalog``.
+    sigma_cut : {'1sigma', '2sigma', 'ksigma'}, optional
+        Redshift range used for the cut (default '2sigma').
+    credible_levels : sequence of float, optional
+        If given (e.g. ``(0.5, 0.9)``), query and process the credible
+        annuli one by one, innermost first (``mainquery.iter_query_rings``).
+    max_tile_level : int or None, optional
+        Finest HEALPix level of the tiles that are clustered (default 7).
+        None clusters the raw pixels.
+    cluster_method : {'planar', 'sphere', 'tangent'}, optional
+        Clustering feature space of ``findminclust.find_min_clusters``
+        (default 'sphere'). 'planar' clusters on raw (ra, dec), which
+        tears regions apart at RA=0/360 and the poles.
+    backend : backends.Backend, optional
+        Query this backend instead of the ALeRCE database.
+    watch : bool, optional
+        Only query the MJD slice and process the oids new since the last
+        run of this event (state kept in ``state_dir``, see ``watch``).
+    state_dir : str, optional
+        Directory of the watch state.
+    agn_join : bool, optional
+        Only query objects next to a Milliquas AGN in the redshift range.
+    on_ring : callable, optional
+        With ``credible_levels``, called as ``on_ring(level, candidates)``
+        as soon as each ring's candidates are ready.
+    plan : bool, optional
+        Let ``planner.plan_queries`` choose the query per region (default True).
+    workers : int, optional
+        Number of concurrent region queries (default 4).
+
+    Returns
+    -------
+    tuple
+        (candidates, ra_deg, dec_deg, url, mjd_obs), or (candidates, ra_deg,
+        dec_deg, None) when no candidate is left.
+
+    Notes
+    -----
+    The defaults ``max_tile_level=7`` and ``cluster_method='sphere'``
+    change the clusters and queries compared with earlier versions; pass
+    ``max_tile_level=None, cluster_method='planar'`` for the old behaviour.
+    """
     print("🚀 Starting GW–AGN crossmatching pipeline...")
     print(f"🔗 Skymap: {skymap_url}")
     print(f"📂 Milliquas catalog: {milliquas_csv}\n")
+    cache.enable_cache_from_env()
 
-    # --- Step 1: Download and process skymap ---
-    skymap, skymap1, ra_deg, dec_deg, mjd_obs, event_name = radecligo.radecligo(skymap_url)
+    # --- Step 1: Download and process skymap (parsed once, shared below) ---
+    gw_skymap = load_skymap(skymap_url)
+    skymap, skymap1, ra_deg, dec_deg, mjd_obs, event_name = radecligo.radecligo(gw_skymap)
     print(f"✅ Loaded skymap '{event_name}' with {len(skymap1)} pixels in 90% region.\n")
 
-    # --- Step 2: Find clusters in the skymap ---
-    num = findminclust.find_min_clusters(skymap1)
-    df_out, kmeans = divide.dividemap(num, skymap1)
-    print(f"✅ Divided into {len(df_out)} clusters (k={num}).\n")
-
-    # --- Step 3: Query ALeRCE clusters ---
-    conn = get_alerce_connection()
-    new_df = mainquery.query_alerce_clusters(conn, df_out, mjd_obs, ra_deg, dec_deg)
-    print(f"✅ Queried ALeRCE: {len(new_df)} sources retrieved from cluster regions.\n")
-
-    if new_df.empty:
-        print("⚠️ No ALeRCE sources found near GW localization — stopping early.")
-        return pd.DataFrame(), ra_deg, dec_deg, None
-
-    # --- Step 4: Match with Milliquas ---
-    agn = pd.read_csv(milliquas_csv)
-    nagn = match_milliquas.match_with_milliquas(new_df, agn, event_name=event_name)
-    print(f"✅ Matched with Milliquas: {len(nagn)} candidate AGNs after spatial crossmatch.\n")
-
-    if nagn.empty:
-        print("⚠️ No Milliquas matches found — stopping early.")
-        return nagn, ra_deg, dec_deg, None
-
-    # --- Step 5: Redshift filtering ---
-    res = redshift.compute_distance_redshift(skymap_url)
-    res1 = redshift.filter_agn_by_redshift(nagn, res)
-    res1["final_2sigma"].to_csv("redshift.csv", index=False)
-  
+    # --- Watch mode: only the time slice and oids new since the last run ---
+    state, window = None, (None, None)
+    if watch:
+        state = load_state(event_name, state_dir)
+        window = poll_window(state, mjd_obs)
+        if window is None:
+            print(f"⏸️ Nothing new to query for '{event_name}' since MJD {state['last_mjd']}.")
+            return pd.DataFrame(), ra_deg, dec_deg, None
+        print(f"👀 Watch mode: querying MJD {window[0]:.2f}–{window[1]:.2f} "
+              f"({len(state['seen'])} oids already processed).\n")
+
+    def finish(*result):
+        # Commit the watch state only once the run has completed
+        if state is not None:
+            save_state(record(state, queried, window[1]), state_dir)
+        return result
+
+    region_level = 0.9 if credible_levels is None else max(credible_levels)
+
+    # --- Optional: only query objects next to an AGN in the event's redshift range ---
+    agn, res, near_agn = None, None, None
+    if agn_join:
+        agn = match_milliquas.open_catalog(milliquas_csv).footprint(gw_skymap, credible_level=region_level)
+        res = redshift.compute_distance_redshift(gw_skymap)
+        # Widest of the redshift ranges used below, so no match is lost
+        near_agn = agn.redshift_range(min(res["z_min"], res["z_min1"], res["z_min2"]),
+                                      max(res["z_max"], res["z_max1"], res["z_max2"]))
+        print(f"✅ {len(near_agn)} AGNs in the redshift range will be joined in the queries.\n")
+
     valid_keys = {
         "1sigma": "final_1sigma",
         "2sigma": "final_2sigma",
@@ -60,51 +126,134 @@ def run_pipeline(skymap_url, milliquas_csv, sigma_cut="2sigma"):
 
     sigma_key = valid_keys[sigma_cut]  # e.g. "final_2sigma"
 
-    # --- Handle dictionary outputs properly ---
-    if isinstance(res1, dict) and sigma_key in res1:
-        df_final = pd.DataFrame(res1[sigma_key])
-    else:
-        print(f"⚠️ Redshift filtering returned no '{sigma_key}' data.")
-        return pd.DataFrame(), ra_deg, dec_deg, None
+    def select(new_df, suffix=""):
+        # Steps 4-7 for a set of queried sources; returns the final candidates.
+        # Intermediate CSVs get ``suffix`` so that each ring keeps its own files
+        nonlocal agn, res
+        new_df = radecligo.credible_membership(new_df, gw_skymap, credible_level=region_level)
+        print(f"✅ {len(new_df)} sources lie inside the {region_level:.0%} credible region.\n")
 
-    if df_final.empty:
-        print(f"⚠️ No AGNs passed the {sigma_cut} redshift cut — stopping early.")
-        return df_final, ra_deg, dec_deg, None
+        if new_df.empty:
+            print("⚠️ No ALeRCE sources found near GW localization — stopping early.")
+            return pd.DataFrame()
 
-    df_final.to_csv(f"redshift_{sigma_cut}.csv", index=False)
-    print(f"✅ Redshift filtering complete: {len(df_final)} objects remain within {sigma_cut} distance.\n")
-    # --- Step 6: Query classifiers and detections ---
-    conn = get_alerce_connection()
-    cand = classifiers.query_classifiers(conn, res1["final_2sigma"])
-    print(f"✅ Classifiers queried: {len(cand)} objects classified (stamp/lc).\n")
+        # --- Step 4: Match with Milliquas ---
+        # Only the catalog tiles around the credible region are read
+        if agn is None:
+            agn = match_milliquas.open_catalog(milliquas_csv).footprint(gw_skymap, credible_level=region_level)
+        nagn = match_milliquas.match_with_milliquas(
+            new_df, agn, event_name=event_name,
+            output_csv=f"{event_name}_matched_milliquas{suffix}.csv")
+        print(f"✅ Matched with Milliquas: {len(nagn)} candidate AGNs after spatial crossmatch.\n")
 
-    cand.to_csv("classifiers.csv", index=False)
+        if nagn.empty:
+            print("⚠️ No Milliquas matches found — stopping early.")
+            return nagn
 
-    det = detections.query_detections(cand, conn)
-    print(f"✅ Detections queried: {len(det)} rows retrieved from database.\n")
+        # --- Step 5: Redshift filtering ---
+        if res is None:
+            res = redshift.compute_distance_redshift(gw_skymap)
+        res1 = redshift.filter_agn_by_redshift(nagn, res)
+        res1["final_2sigma"].to_csv(f"redshift{suffix}.csv", index=False)
 
-    # --- Step 7: Merge and compute extinction ---
-    final1 = pd.merge(cand, det, on=["oid"], how="inner")
-    final1["event_id"] = event_name
-    final1.to_csv("final1.csv", index=False)
-    print(f"✅ Merged classifiers + detections: {len(final1)} objects.\n")
+        # --- Handle dictionary outputs properly ---
+        if isinstance(res1, dict) and sigma_key in res1:
+            df_final = pd.DataFrame(res1[sigma_key])
+        else:
+            print(f"⚠️ Redshift filtering returned no '{sigma_key}' data.")
+            return pd.DataFrame()
 
-    if final1.empty:
-        print("⚠️ No valid objects for extinction step — stopping early.")
-        return final1, ra_deg, dec_deg, None
+        if df_final.empty:
+            print(f"⚠️ No AGNs passed the {sigma_cut} redshift cut — stopping early.")
+            return df_final
 
-    importlib.reload(extinction)
-    dust, candidates = extinction.compute_lat_extinction(final1, apply_cuts=True)
-    print(f"✅ Extinction computed for {len(dust)} sources.")
-    print(f"✅ {len(candidates)} sources remain after sky-plane & dust cuts.\n")
+        df_final.to_csv(f"redshift_{sigma_cut}{suffix}.csv", index=False)
+        print(f"✅ Redshift filtering complete: {len(df_final)} objects remain within {sigma_cut} distance.\n")
+        # --- Step 6: Query classifiers and detections ---
+        with (nullcontext(backend) if backend is not None else alerce_connection()) as conn:
+            cand = classifiers.query_classifiers(conn, res1["final_2sigma"])
+            print(f"✅ Classifiers queried: {len(cand)} objects classified (stamp/lc).\n")
 
-    if candidates.empty:
-        print("⚠️ No candidates remain after extinction filtering. Returning empty set.")
-        return candidates, ra_deg, dec_deg, None
+            cand.to_csv(f"classifiers{suffix}.csv", index=False)
+
+            det = detections.query_detections(cand, conn)
+            print(f"✅ Detections queried: {len(det)} rows retrieved from database.\n")
+
+        # --- Step 7: Merge and compute extinction ---
+        final1 = pd.merge(cand, det, on=["oid"], how="inner")
+        final1["event_id"] = event_name
+        final1.to_csv(f"final1{suffix}.csv", index=False)
+        print(f"✅ Merged classifiers + detections: {len(final1)} objects.\n")
+
+        if final1.empty:
+            print("⚠️ No valid objects for extinction step — stopping early.")
+            return final1
+
+        dust, candidates = extinction.compute_lat_extinction(final1, apply_cuts=True)
+        print(f"✅ Extinction computed for {len(dust)} sources.")
+        print(f"✅ {len(candidates)} sources remain after sky-plane & dust cuts.\n")
+
+        if candidates.empty:
+            print("⚠️ No candidates remain after extinction filtering. Returning empty set.")
+            return candidates
+
+        candidates = candidates.rename(columns={"oid_x": "oid"})
+        final_cand = pd.merge(candidates, nagn, on='oid', suffixes=('', '_drop'))
+        return final_cand[[c for c in final_cand.columns if not c.endswith('_drop')]]
+
+    def only_new(found):
+        if state is None:
+            return found
+        fresh = new_objects(state, found)
+        print(f"👀 {len(fresh)} of {len(found)} sources are new since the last run.\n")
+        return fresh
+
+    queried = pd.DataFrame()
+    if credible_levels is None:
+        # --- Step 2: Find clusters in the skymap (on coarsened tiles) ---
+        tiles = skymap1
+        if max_tile_level is not None:
+            tiles = radecligo.coarsen_pixels(skymap1, max_level=max_tile_level)
+            print(f"✅ Coarsened {len(skymap1)} pixels into {len(tiles)} tiles.\n")
+        if tiles.empty:
+            print("⚠️ No pixels left in the credible region — stopping early.")
+            return finish(pd.DataFrame(), ra_deg, dec_deg, None)
+        num, labels, polygons = findminclust.find_min_clusters(tiles, return_labels=True,
+                                                               method=cluster_method)
+        df_out, kmeans = divide.dividemap(num, tiles, labels=labels)
+        print(f"✅ Divided into {len(df_out)} clusters (k={num}).\n")
+
+        # --- Step 3: Query ALeRCE clusters ---
+        queried = mainquery.query_alerce_clusters(backend, df_out, mjd_obs, ra_deg, dec_deg,
+                                                  polygons=polygons, plan=plan, workers=workers,
+                                                  mjd_first=window[0], mjd_last=window[1],
+                                                  agn=near_agn)
+        print(f"✅ Queried ALeRCE: {len(queried)} sources retrieved from cluster regions.\n")
+        final_cand = select(only_new(queried))
+    else:
+        # --- Steps 2-7 ring by ring, innermost credible region first ---
+        rings = radecligo.credible_regions(gw_skymap, levels=credible_levels)
+        ra_deg, dec_deg = rings['meanra'].to_numpy(), rings['meandec'].to_numpy()
+        found, selected = [], []
+        for level, ring_df in mainquery.iter_query_rings(backend, rings, mjd_obs, ra_deg, dec_deg,
+                                                         max_level=max_tile_level, plan=plan,
+                                                         workers=workers, mjd_first=window[0],
+                                                         mjd_last=window[1], agn=near_agn,
+                                                         method=cluster_method):
+            found.append(ring_df)
+            print(f"✅ {level:.0%} ring: {len(ring_df)} new sources ({sum(map(len, found))} so far).\n")
+            ring_cand = (select(only_new(ring_df), suffix=f"_ring{level * 100:g}")
+                         if not ring_df.empty else pd.DataFrame())
+            print(f"✅ {level:.0%} ring: {len(ring_cand)} candidates.\n")
+            if on_ring is not None:
+                on_ring(level, ring_cand)
+            selected.append(ring_cand)
+        queried = pd.concat(found, ignore_index=True) if found else pd.DataFrame()
+        selected = [df for df in selected if not df.empty]
+        final_cand = pd.concat(selected, ignore_index=True) if selected else pd.DataFrame()
 
-    candidates = candidates.rename(columns={"oid_x": "oid"})
-    final_cand = pd.merge(candidates, nagn, on='oid', suffixes=('', '_drop'))
-    final_cand = final_cand[[c for c in final_cand.columns if not c.endswith('_drop')]]
+    if final_cand.empty:
+        return finish(final_cand, ra_deg, dec_deg, None)
 
     # --- Step 8: Generate ALeRCE viewer URL ---
     suffix = "&count=true&page=1&perPage=1000&sortDesc=true&selectedClassifier=stamp_classifier"
@@ -112,4 +261,4 @@ def run_pipeline(skymap_url, milliquas_csv, sigma_cut="2sigma"):
     print(f"🔗 Final ALeRCE viewer link generated.\n")
 
     print("🏁 Pipeline completed successfully.")
-    return final_cand, ra_deg, dec_deg, url, mjd_obs
+    return finish(final_cand, ra_deg, dec_deg, url, mjd_obs)
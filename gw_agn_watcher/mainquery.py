@@ -6,83 +6,332 @@ import alphashape
 import psycopg2
 import requests
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from astropy.time import Time
 
+from . import cache, db, findminclust, divide, planner, radecligo
+from .backends import Backend
+from .match_milliquas import MATCH_RADIUS_DEG, Catalog
+from .polygons import healpix_polygons, simplify_polygon
+
 warnings.simplefilter(action='ignore', category=UserWarning)
 
+# Alerts can reach the database up to this many days after detection, so
+# a window is only considered closed (and cacheable) this long after its end
+LATE_ALERT_DAYS = 1.0
+
 
 
 
-def query_alerce_clusters(conn,skymap_df, time,ra,dec, ndays=200, alpha=0.01):
+def object_query(plan, mjd_first, mjd_last, near=None, exclude=()):
     """
-    Divide the sky map into alpha-shape polygons by cluster label,
-    query ALeRCE for objects inside each polygon and within [time, time+ndays].
+    SQL selecting the ALeRCE objects of one planned region and MJD window.
+
+    Parameters
+    ----------
+    plan : dict
+        Entry of ``planner.plan_queries`` (or an equivalent polygon entry).
+    mjd_first, mjd_last : int
+        First-detection MJD window.
+    near : tuple, optional
+        (table, radius): keep only objects within ``radius`` deg of a
+        position in ``table`` (see ``db.upload_positions``), with ``q3c_join``.
+    exclude : sequence of dict, optional
+        Plan entries already queried; objects inside any of them are left out.
+
+    Returns
+    -------
+    str
     """
-    new_df = pd.DataFrame()
-    n_clusters = len(skymap_df['cluster_label'].unique())
+    join = ""
+    if near is not None:
+        table, radius = near
+        join = f"""
+            AND EXISTS (
+                SELECT 1 FROM {table} AS agn
+                WHERE q3c_join(object.meanra, object.meandec, agn.ra, agn.dec, {radius:.8f}))"""
+    for done in exclude:
+        join += f"""
+            AND NOT {planner.region_condition(done)}"""
+    return f"""
+        SELECT
+            object.oid, object.meanra, object.meandec, object.firstmjd, object.stellar,
+            object.ndet
+        FROM 
+            object 
+        WHERE {planner.region_condition(plan)}
+            AND object.firstMJD >= %s
+            AND object.firstMJD <= %s{join};;
+        """%(mjd_first,mjd_last)
 
-    fig = plt.figure()
 
-    ax = fig.add_subplot(111, projection='astro hours mollweide')
+class _UploadFailed(Exception):
+    """The AGN positions could not be uploaded for the join."""
+
+
+def _merge_new(frames, seen, results):
+    """Append the rows of ``results`` whose oid has not been seen yet."""
+    results = results.drop_duplicates(subset='oid')
+    results = results[~results['oid'].isin(seen)]
+    seen.update(results['oid'])
+    frames.append(results)
+
+
+def query_alerce_clusters(conn,skymap_df, time,ra,dec, ndays=200, alpha=0.01, close=False,
+                          polygons=None, max_vertices=None, plan=False, plan_kwargs=None,
+                          workers=1, pool=None, plot=True, mjd_first=None, mjd_last=None,
+                          agn=None, agn_radius=MATCH_RADIUS_DEG, exclude=()):
+    """
+    Divide the sky map into polygons by cluster label, query ALeRCE for
+    objects inside each polygon and within [time, time+ndays].
+
+    ``mjd_first`` and ``mjd_last`` override the two ends of that window,
+    e.g. to fetch only the slice new since a previous poll.
+
+    Polygons are traced from the clusters' HEALPix pixels when
+    ``skymap_df`` has a 'pixel_no' column, and are alpha shapes otherwise.
+    A cluster whose pixels do not fit in a hemisphere, or whose alpha
+    shape has several parts, is queried as several polygons.
+
+    ``conn`` is left open unless ``close`` is True. If ``conn`` is None a
+    connection is borrowed from the shared pool (``db.get_pool()``); if it
+    is a ``backends.Backend``, its ``objects`` method runs the searches.
+    ``polygons`` maps cluster labels to polygons already built by
+    ``findminclust.find_min_clusters``; those clusters are not rebuilt.
+    If ``max_vertices`` is given, every polygon is first simplified to at
+    most that many vertices with ``polygons.simplify_polygon`` (the result
+    still contains the original), which makes each ``q3c_poly_query`` cheaper.
+    If ``plan`` is True, ``planner.plan_queries`` (with ``plan_kwargs``)
+    decides per region between one polygon, a few cones or a split, and
+    merges tiny regions; otherwise every cluster is one polygon query.
+
+    With ``workers > 1`` the region queries run concurrently on a bounded
+    thread pool, each query on a connection borrowed from ``pool`` (default
+    the shared ``db.get_pool()``); ``conn`` is then not used.
+    Results are merged as they arrive, keeping one row per oid, and the
+    sky plot (if ``plot``) is drawn once at the end.
+
+    When the shared query cache is enabled (``cache.enable_cache``),
+    queries whose MJD window closed more than ``LATE_ALERT_DAYS`` ago are
+    served from disk.
+
+    If ``agn`` is given (a DataFrame with 'ra' and 'dec' columns or a
+    ``match_milliquas.Catalog``, e.g. already cut to the event's redshift
+    range), only objects within ``agn_radius`` deg of one of its sources
+    are returned. The positions are uploaded once per connection to a
+    temporary table (``db.upload_positions``) that each region query joins
+    with ``q3c_join``; a backend filters the same way. If the upload
+    fails, the query runs without the join.
+
+    Objects inside the regions of ``exclude`` (plan entries of an earlier
+    call, e.g. an inner credible ring) are not returned. The plan entries
+    whose query succeeded are stored in ``new_df.attrs['plans']``.
+    """
+    polygons = polygons or {}
+    n_clusters = len(skymap_df['cluster_label'].unique())
 
+    # --- Build the polygons of every cluster ---
+    shapes = {}
     for i in range(n_clusters):
         cluster_data = skymap_df[skymap_df['cluster_label'] == i]
-    #plt.scatter(cluster_data['meanra'],cluster_data['meandec'])
-        alt = cluster_data
-        alt=alt.reset_index(drop=True)
-        rag=alt['meanra'].to_numpy()
-        decg=alt['meandec'].to_numpy()
-        combined_array3= np.concatenate([rag[:, np.newaxis], decg[:, np.newaxis]], axis=1).ravel()
-
-        dd = combined_array3.reshape(int(combined_array3.shape[0]/2),2)
-        points_2d = [(x, y) for x, y in zip(dd[:, 0], dd[:, 1])]
-        alpha_shape = alphashape.alphashape(points_2d,0.01)
-        
-        if alpha_shape.geom_type == 'Polygon':
-        # Process the single Polygon
-            print("querying cluster:", i)
-            x = np.array(alpha_shape.exterior.coords.xy[0])
-            y = np.array(alpha_shape.exterior.coords.xy[1])
-            ax.plot(x, y,linewidth=1,transform=ax.get_transform('world'),color='green')
-            result = []
-            for l in range(len(x)):
-                result.append(x[l])
-                result.append(y[l])
+        if i in polygons:
+            pieces = [polygons[i]]
+        elif 'pixel_no' in cluster_data.columns:
+            # Split clusters that do not fit in a hemisphere (e.g. antipodal lobes)
+            pieces = healpix_polygons(cluster_data['pixel_no'].to_numpy())
+        else:
+            alt = cluster_data
+            alt=alt.reset_index(drop=True)
+            rag=alt['meanra'].to_numpy()
+            decg=alt['meandec'].to_numpy()
+            combined_array3= np.concatenate([rag[:, np.newaxis], decg[:, np.newaxis]], axis=1).ravel()
+
+            dd = combined_array3.reshape(int(combined_array3.shape[0]/2),2)
+            points_2d = [(x, y) for x, y in zip(dd[:, 0], dd[:, 1])]
+            alpha_shape = alphashape.alphashape(points_2d,0.01)
+            # Multi-part shapes are queried part by part, not dropped
+            pieces = [g for g in getattr(alpha_shape, 'geoms', [alpha_shape])
+                      if g.geom_type == 'Polygon']
+
+        for j, alpha_shape in enumerate(pieces):
+            if max_vertices is not None:
+                alpha_shape = simplify_polygon(alpha_shape, max_vertices=max_vertices)
+            shapes[i if len(pieces) == 1 else f"{i}.{j}"] = alpha_shape
+
+    mjd_first = int(time) if mjd_first is None else mjd_first
+    mjd_last = int(time) + ndays if mjd_last is None else mjd_last
+
+    # --- Plan the queries ---
+    if plan:
+        plans = planner.plan_queries(shapes, ndays=max(mjd_last - mjd_first, 0),
+                                     **(plan_kwargs or {}))
+        print(f"🗺️ Planned {len(plans)} queries for {len(shapes)} clusters "
+              f"({sum(p['kind'] == 'cones' for p in plans)} cone covers).")
+    else:
+        plans = [{'kind': 'polygon', 'polygon': shape, 'cones': [], 'labels': [i]}
+                 for i, shape in shapes.items()]
 
-            ndays = 200
-            #mjd_last = Time(datetime.utcnow(), scale='utc').mjd - ndays
-            mjd_last = int(time) + ndays
-            mjd_first= int(time)
+    # --- Run the queries, merging unique oids as results arrive ---
+    frames, seen, done = [], set(), []
+    backend = conn if isinstance(conn, Backend) else None
+    if pool is None and backend is None and (conn is None or workers > 1):
+        pool = db.get_pool()
+    # Results are only cached once the MJD window has closed; a watch poll
+    # slicing up to now stays uncached
+    window_closed = mjd_last + LATE_ALERT_DAYS < Time.now().mjd
 
+    near, agn_key = None, None
+    if agn is not None:
+        agn_ra, agn_dec = agn.radec if isinstance(agn, Catalog) else (agn['ra'], agn['dec'])
+        agn_ra, agn_dec = np.asarray(agn_ra, dtype=float), np.asarray(agn_dec, dtype=float)
+        near, agn_key = (agn_ra, agn_dec, agn_radius), db.positions_key(agn_ra, agn_dec)
+        print(f"🎯 Keeping only objects within {agn_radius * 3600:.1f} arcsec of "
+              f"{len(agn_ra)} AGN.")
 
-            query = f"""
-            SELECT
-                object.oid, object.meanra, object.meandec, object.firstmjd, object.stellar,
-                object.ndet
-            FROM 
-                object 
-            WHERE q3c_poly_query(meanra, meandec,ARRAY[{','.join([str(coord) for coord in result])}])
-                AND object.firstMJD >= %s
-                AND object.firstMJD <= %s;;
-            """%(mjd_first,mjd_last)
+    def run(entry, use_conn=None):
+        if backend is not None:
+            return backend.objects(entry, mjd_first, mjd_last, near=near, exclude=exclude)
+        expected = entry.get('rows')
+        if expected is None:
+            expected = planner.expected_rows(planner.spherical_area(entry['polygon']),
+                                             ndays=mjd_last - mjd_first)
 
+        def query(sql, expected, join=False):
+            with (nullcontext(use_conn) if use_conn is not None else pool.connection()) as query_conn:
+                if join:
+                    try:
+                        db.upload_positions(query_conn, near[0], near[1], key=agn_key)
+                    except Exception as e:
+                        print(f"⚠️ AGN upload failed ({e}); querying without the AGN join.")
+                        db.rollback_quietly(query_conn)
+                        raise _UploadFailed from e
+                # Large regions are fetched in bulk with COPY
+                return db.read_query(query_conn, sql, expected_rows=expected)
 
+        sql = object_query(entry, mjd_first, mjd_last, exclude=exclude)
+        if near is not None:
+            joined = object_query(entry, mjd_first, mjd_last, near=(db.POSITIONS_TABLE, agn_radius),
+                                  exclude=exclude)
             try:
-                results = pd.read_sql_query(query, conn)
-                new_df = pd.concat([new_df, results], ignore_index=True)
-                ax.scatter(new_df['meanra'], new_df['meandec'], s=1, alpha=0.1,color='y',
-                transform=ax.get_transform('world'))
+                return cache.cached(('objects', joined, agn_key),
+                                    lambda: query(joined, min(expected, 2 * len(near[0])), join=True),
+                                    enabled=window_closed)
+            except _UploadFailed:
+                pass
+        # Unjoined results (including the fallback) are cached under their own SQL
+        return cache.cached(('objects', sql), lambda: query(sql, expected), enabled=window_closed)
+
+    if workers <= 1:
+        for entry in plans:
+            print("querying cluster:", ','.join(str(l) for l in entry['labels']))
+            try:
+                _merge_new(frames, seen, run(entry, conn))
+                done.append(entry)
             except Exception as e:
-                print(f"⚠️ Query failed for cluster {i}: {e}")
+                print(f"⚠️ Query failed for cluster {entry['labels']}: {e}")
+    else:
+        print(f"⚡ Running {len(plans)} cluster queries on {workers} workers...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run, entry): entry for entry in plans}
+            for future in as_completed(futures):
+                labels = futures[future]['labels']
+                try:
+                    _merge_new(frames, seen, future.result())
+                    done.append(futures[future])
+                    print("queried cluster:", ','.join(str(l) for l in labels))
+                except Exception as e:
+                    print(f"⚠️ Query failed for cluster {labels}: {e}")
 
-        #ax.scatter(ra,dec,s=10,transform=ax.get_transform('world'))
+    new_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
-    conn.close()
-    plt.show()
-    plt.close()
+    if close and conn is not None and backend is None:
+        conn.close()
+
+    # --- Plot once, after all queries ---
+    if plot:
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='astro hours mollweide')
+        for entry in plans:
+            x = np.array(entry['polygon'].exterior.coords.xy[0])
+            y = np.array(entry['polygon'].exterior.coords.xy[1])
+            ax.plot(x, y,linewidth=1,transform=ax.get_transform('world'),color='green')
+        if not new_df.empty:
+            ax.scatter(new_df['meanra'], new_df['meandec'], s=1, alpha=0.1,color='y',
+                       transform=ax.get_transform('world'))
+        plt.show()
+        plt.close()
+    new_df.attrs['plans'] = done
     return new_df
 
 
+def iter_query_rings(conn, rings_df, time, ra, dec, ndays=200, max_level=None, plan=False,
+                     workers=1, mjd_first=None, mjd_last=None, agn=None,
+                     agn_radius=MATCH_RADIUS_DEG, **cluster_kwargs):
+    """
+    Query ALeRCE ring by ring, innermost credible region first.
+
+    Each annulus of ``rings_df`` (as returned by
+    ``radecligo.credible_regions``) is clustered and queried on its own,
+    and its candidates are yielded as soon as the ring finishes, so the
+    most probable part of the sky comes back first. The regions queried
+    for the inner rings are excluded from each outer ring's queries
+    (``exclude`` of ``query_alerce_clusters``), so no part of the sky is
+    fetched twice, and objects already returned are not yielded again.
+
+    Parameters
+    ----------
+    conn : psycopg2 connection or None
+        Active connection to the ALeRCE database (left open), or None to
+        borrow from the shared pool.
+    rings_df : pandas.DataFrame
+        Pixels with 'meanra', 'meandec' and 'credible_level' columns.
+    time : float
+        Reference time (MJD).
+    ra, dec : ndarray
+        RA/Dec of the skymap pixels (passed through to the query).
+    ndays : int, optional
+        Time window in days (default 200).
+    max_level : int, optional
+        If given, each ring is coarsened with ``radecligo.coarsen_pixels``
+        to tiles no finer than this HEALPix level before clustering.
+    plan, workers, mjd_first, mjd_last, agn, agn_radius : optional
+        Passed to ``query_alerce_clusters`` (query planner, concurrency,
+        MJD window overrides, AGN join).
+    **cluster_kwargs
+        Passed to ``findminclust.find_min_clusters``.
+
+    Yields
+    ------
+    level : float
+        Credible level of the ring just queried.
+    ring_df : pandas.DataFrame
+        Objects found in that ring and not in any inner ring.
+    """
+    seen, queried = set(), []
+    for level in np.sort(rings_df['credible_level'].unique()):
+        ring = rings_df[rings_df['credible_level'] == level].reset_index(drop=True)
+        if ring.empty:
+            continue
+        if max_level is not None:
+            ring = radecligo.coarsen_pixels(ring, max_level=max_level)
+
+        num, labels, polygons = findminclust.find_min_clusters(ring, return_labels=True,
+                                                               **cluster_kwargs)
+        ring_out, _ = divide.dividemap(num, ring, plot=False, labels=labels)
+        print(f"🔭 Querying {level:.0%} ring: {len(ring)} pixels in {num} clusters")
+
+        found = query_alerce_clusters(conn, ring_out, time, ra, dec, ndays=ndays,
+                                      polygons=polygons, plan=plan, workers=workers,
+                                      mjd_first=mjd_first, mjd_last=mjd_last, agn=agn,
+                                      agn_radius=agn_radius, exclude=list(queried))
+        queried.extend(found.attrs.get('plans', []))
+        if not found.empty:
+            found = found[~found['oid'].isin(seen)].reset_index(drop=True)
+            seen.update(found['oid'])
+        yield level, found
+
+
 if __name__ == "__main__":
     # Example usage
     # Load your sky map DataFrame first (must include 'meanra', 'meandec', 'cluster_label')
@@ -2,72 +2,526 @@
 Crossmatch candidates with the Milliquas AGN catalog.
 Author: Hemanth Kumar
 Date: 2025-11-11
+
+The catalog CSV can be converted once with ``build_catalog`` into a
+directory of typed NumPy columns (unit vectors, name, redshift, type).
+``load_catalog`` memory-maps the columns, so repeated runs skip the CSV
+parse; the k-d tree is rebuilt from the unit vectors on first use (well
+under a second for Milliquas), so no pickle is ever loaded.
 """
 
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-from astropy.coordinates import SkyCoord
 import astropy.units as u
+import astropy_healpix as ah
+from scipy.spatial import cKDTree
+
+from .radecligo import credible_regions
+from .sphere import radec_to_xyz, xyz_to_radec
+
+# Maximum candidate-AGN separation (deg, about 2.9 arcsec)
+MATCH_RADIUS_DEG = 0.0008
 
+# Coarse HEALPix level of the catalog partitions (nside 32, ~3.4 deg^2 tiles)
+TILE_LEVEL = 5
 
-def match_with_milliquas(cr, df1, event_name="unknown", output_csv=None):
+CATALOG_VERSION = 2
+
+
+def match_with_milliquas(cr, df1, event_name="unknown", output_csv=None,
+                         radius=MATCH_RADIUS_DEG, all_matches=False):
     """
     Crossmatch candidate sources with the Milliquas catalog.
 
     Parameters
     ----------
-   cr : dataframe
+    cr : dataframe
         Dataframe containing candidate objects (must include 'meanra' and 'meandec' columns).
-    milliquas_csv : dataframe
-        Dataframe of Milliquas catalog file (must include 'ra' and 'dec' columns).
+        It is not modified.
+    df1 : dataframe or Catalog
+        Dataframe of Milliquas catalog file (must include 'ra' and 'dec'
+        columns, name/type/redshift in columns 2/3/4), or a prebuilt
+        catalog from ``load_catalog``/``open_catalog``.
     output_csv : str, optional
-        File to save the crossmatched results. Default is 'matched_milliquas.csv'.
+        File to save the crossmatched results. Default is '<event_name>_matched_milliquas.csv'.
+    radius : float, optional
+        Maximum separation in degrees (default 0.0008 ≈ 2.9 arcsec).
+    all_matches : bool, optional
+        If True, return one row per catalog source within ``radius`` of a
+        candidate (closest first) instead of only the nearest one.
 
     Returns
     -------
     pd.DataFrame
-        DataFrame of matched sources with AGN name, redshift, and separation.
+        DataFrame of matched sources with AGN name ('agn'), redshift ('z'),
+        separation ('agnsep', deg), number of catalog sources within the
+        radius ('n_agn') and 'ambiguous' (more than one of them).
     """
 
-    # === Load Data ===
-   # cr = pd.read_csv(candidates_csv)
-   # df1 = pd.read_csv(milliquas_csv)
+    if output_csv is None:
+        output_csv = f"{event_name}_matched_milliquas.csv"
+
+    catalog = df1 if isinstance(df1, Catalog) else Catalog.from_frame(df1)
+    nagn = _match_catalog(cr, catalog, radius, all_matches)
 
-    # === Extract coordinates ===
-    ra1 = np.array(cr['meanra'])
-    dec1 = np.array(cr['meandec'])
-    ra2 = np.array(df1['ra'])
-    dec2 = np.array(df1['dec'])
+    # === Save and report ===
+    nagn.to_csv(output_csv, index=False)
+    n_ambiguous = int(nagn.loc[~nagn.index.duplicated(), 'ambiguous'].sum())
+    print(f"Matched {nagn.index.nunique()} candidates to Milliquas within "
+          f"{radius * 3600:.1f} arcsec ({n_ambiguous} ambiguous).")
+    print(f"Results saved to {output_csv}")
 
-    # === Build SkyCoord objects ===
-    candidates = SkyCoord(ra=ra1 * u.deg, dec=dec1 * u.deg)
-    milliquas = SkyCoord(ra=ra2 * u.deg, dec=dec2 * u.deg)
+    return nagn
 
-    # === Match to nearest source ===
-    idx, d2d, d3d = candidates.match_to_catalog_sky(milliquas)
 
-    # === Extract AGN and redshift info ===
-    milliquas_name_col = df1.columns[2]  # or replace with 'Name' if known
-    milliquas_z_col = df1.columns[4]     # or replace with 'z' if known
+def _match_xyz(xyz, catalog, radius=MATCH_RADIUS_DEG, all_matches=False):
+    """
+    Catalog sources within ``radius`` deg of unit vectors ``xyz``.
 
-    cr['agn'] = [df1.iloc[i][milliquas_name_col] for i in idx]
-    cr['z'] = [df1.iloc[i][milliquas_z_col] for i in idx]
-    cr['agnsep'] = d2d.degree
+    Returns (rows, idx, sep, counts): the candidate row and catalog row of
+    every match with its separation (deg), sorted by candidate then
+    separation, and the number of sources within the radius per candidate.
+    """
+    chord = 2 * np.sin(np.deg2rad(radius) / 2) * (1 + 1e-9)
+    if len(catalog) == 0 or len(xyz) == 0:
+        rows, idx = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        counts = np.zeros(len(xyz), dtype=int)
+    elif all_matches:
+        found = catalog.tree.query_ball_point(xyz, chord)
+        counts = np.array([len(f) for f in found], dtype=int)
+        rows = np.repeat(np.arange(len(xyz)), counts)
+        idx = np.fromiter((i for f in found for i in f), dtype=int, count=counts.sum())
+    else:
+        counts = np.asarray(catalog.tree.query_ball_point(xyz, chord, return_length=True), dtype=int)
+        _, nearest = catalog.tree.query(xyz, k=1, distance_upper_bound=chord)
+        rows = np.flatnonzero(counts > 0)
+        idx = nearest[rows]
 
-    # === Filter by close match (<= 0.0008 deg ≈ 2.88 arcsec) ===
-    nagn = cr[cr['agnsep'] <= 0.0008]
+    # Exact separations, and closest source first for each candidate
+    sep = np.rad2deg(2 * np.arcsin(np.clip(
+        np.linalg.norm(xyz[rows] - catalog.xyz[idx], axis=1) / 2, 0.0, 1.0)))
+    keep = sep <= radius
+    rows, idx, sep = rows[keep], idx[keep], sep[keep]
+    order = np.lexsort((sep, rows))
+    return rows[order], idx[order], sep[order], counts
 
-    if output_csv is None:
-        output_csv = f"{event_name}_matched_milliquas.csv"
 
-    # === Save and report ===
-    nagn.to_csv(output_csv, index=False)
-    print(f"Matched {len(nagn)} candidates to Milliquas within 2.9 arcsec.")
-    print(f"Results saved to {output_csv}")
+def _match_catalog(cr, catalog, radius=MATCH_RADIUS_DEG, all_matches=False):
+    """Catalog sources within ``radius`` deg of each candidate, via the catalog tree."""
+    xyz = radec_to_xyz(cr['meanra'].to_numpy(dtype=float), cr['meandec'].to_numpy(dtype=float))
+    rows, idx, sep, counts = _match_xyz(xyz, catalog, radius, all_matches)
 
+    # One indexed take per column
+    nagn = cr.iloc[rows].copy()
+    nagn['agn'] = catalog.name[idx]
+    nagn['z'] = catalog.z[idx]
+    nagn['agnsep'] = sep
+    nagn['n_agn'] = counts[rows]
+    nagn['ambiguous'] = counts[rows] > 1
     return nagn
 
 
+class Catalog:
+    """
+    Prebuilt AGN catalog: memory-mapped columns and a k-d tree on unit vectors.
+
+    Rows are sorted by coarse HEALPix tile (nested, level ``TILE_LEVEL``),
+    so the sources of any set of tiles are a few contiguous slices of the
+    columns; ``footprint`` reads only those.
+
+    Attributes
+    ----------
+    xyz : ndarray, shape (n, 3)
+        Unit vectors of the sources.
+    name, type : ndarray of str
+        Source names and types.
+    z : ndarray of float
+        Redshifts (NaN when unknown).
+    offsets : ndarray of int
+        First row of every tile (length ``12 * 4**tile_level + 1``).
+    tree : scipy.spatial.cKDTree
+        Tree over ``xyz``, built on first use.
+    meta : dict
+        Build information (source file, columns, number of rows, tile level).
+    """
+
+    def __init__(self, xyz, name, z, type, offsets=None, tree=None, meta=None):
+        self.xyz = xyz
+        self.name = name
+        self.z = z
+        self.type = type
+        self.offsets = offsets
+        self.meta = meta or {}
+        self._tree = tree
+        self._tree_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.z)
+
+    def __repr__(self):
+        return f"Catalog({len(self)} sources, source={self.meta.get('source')!r})"
+
+    @property
+    def tree(self):
+        with self._tree_lock:
+            if self._tree is None:
+                self._tree = cKDTree(self.xyz)
+        return self._tree
+
+    @property
+    def tile_level(self):
+        return self.meta.get('tile_level', TILE_LEVEL)
+
+    @property
+    def radec(self):
+        """RA and Dec (deg) of the sources."""
+        return xyz_to_radec(self.xyz)
+
+    @classmethod
+    def from_frame(cls, df, name_col=None, z_col=None, type_col=None, meta=None,
+                   tile_level=TILE_LEVEL):
+        """
+        Build an in-memory catalog from a Milliquas-like DataFrame.
+
+        Columns default to the positions used by ``match_with_milliquas``:
+        name = column 2, type = column 3 and redshift = column 4, with
+        'ra' and 'dec' required.
+        """
+        name_col = name_col or df.columns[2]
+        type_col = type_col or df.columns[3]
+        z_col = z_col or df.columns[4]
+        ra, dec = df['ra'].to_numpy(dtype=float), df['dec'].to_numpy(dtype=float)
+        tile = np.asarray(ah.lonlat_to_healpix(ra * u.deg, dec * u.deg,
+                                               ah.level_to_nside(tile_level), order='nested'))
+        order = np.argsort(tile, kind='stable')
+        offsets = np.searchsorted(tile[order], np.arange(12 * 4**tile_level + 1))
+        meta = dict(meta or {}, columns={'name': str(name_col), 'type': str(type_col),
+                                         'z': str(z_col)}, rows=len(df), tile_level=tile_level)
+        return cls(radec_to_xyz(ra[order], dec[order]),
+                   df[name_col].fillna('').astype(str).to_numpy(dtype=str)[order],
+                   pd.to_numeric(df[z_col], errors='coerce').to_numpy(dtype=float)[order],
+                   df[type_col].fillna('').astype(str).to_numpy(dtype=str)[order],
+                   offsets=offsets, meta=meta)
+
+    def tiles(self, tiles):
+        """
+        Sub-catalog of the sources in the given tiles.
+
+        Only the matching row ranges are read from the memory-mapped
+        columns, and the sub-catalog builds its own (small) tree when used.
+        """
+        tiles = np.unique(np.asarray(tiles, dtype=np.int64))
+        starts, stops = self.offsets[tiles], self.offsets[tiles + 1]
+        keep = starts < stops
+        rows = np.concatenate([np.arange(0)]
+                              + [np.arange(a, b) for a, b in zip(starts[keep], stops[keep])])
+        sub = self.take(rows)
+        sub.meta['tiles'] = len(tiles)
+        return sub
+
+    def take(self, rows):
+        """Sub-catalog of the given rows (indices or boolean mask)."""
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        sub = {column: np.asarray(getattr(self, column)[rows]) for column in ('xyz', 'name', 'z', 'type')}
+        return Catalog(meta=dict(self.meta, rows=len(rows)), **sub)
+
+    def redshift_range(self, z_min, z_max):
+        """Sub-catalog of the sources with ``z_min <= z < z_max``."""
+        return self.take((self.z >= z_min) & (self.z < z_max))
+
+    def footprint(self, skymap, credible_level=0.9, margin=MATCH_RADIUS_DEG):
+        """
+        Sub-catalog covering the credible region of a skymap.
+
+        Parameters
+        ----------
+        skymap : str or SkyMap
+            GW skymap URL, or an already loaded ``SkyMap``.
+        credible_level : float, optional
+            Credible region to cover (default 0.9).
+        margin : float, optional
+            Extra distance (deg) around the region, at least the match
+            radius (default ``MATCH_RADIUS_DEG``).
+
+        Returns
+        -------
+        Catalog
+        """
+        tiles = footprint_tiles(skymap, credible_level, margin, self.tile_level)
+        sub = self.tiles(tiles)
+        print(f"🗺️ Loaded {len(sub)} of {len(self)} catalog sources from {len(tiles)} tiles "
+              f"covering the {credible_level:.0%} credible region.")
+        return sub
+
+
+def footprint_tiles(skymap, credible_level=0.9, margin=MATCH_RADIUS_DEG, tile_level=TILE_LEVEL):
+    """
+    Nested HEALPix tiles at ``tile_level`` touching the credible region of a skymap.
+
+    The tiles of the credible multiorder pixels are grown by rings of
+    neighbours until they cover ``margin`` deg beyond the region.
+
+    Returns
+    -------
+    ndarray of int
+        Sorted tile indices.
+    """
+    region = credible_regions(skymap, levels=[credible_level])
+    level, ipix = ah.uniq_to_level_ipix(region['pixel_no'].to_numpy())
+    level, ipix = np.asarray(level, dtype=np.int64), np.asarray(ipix, dtype=np.int64)
+
+    # Finer pixels map to their ancestor tile, coarser ones to all their descendants
+    fine = level >= tile_level
+    tiles = [ipix[fine] >> (2 * (level[fine] - tile_level))]
+    for lev, pix in zip(level[~fine], ipix[~fine]):
+        n = 4 ** (tile_level - lev)
+        tiles.append(np.arange(pix * n, (pix + 1) * n))
+    tiles = np.unique(np.concatenate(tiles))
+
+    # Each ring of neighbours extends the cover by at least half a tile width
+    nside = ah.level_to_nside(tile_level)
+    width = ah.nside_to_pixel_resolution(nside).to_value(u.deg)
+    for _ in range(int(np.ceil(margin / (0.5 * width)))):
+        neighbours = np.asarray(ah.neighbours(tiles, nside, order='nested')).ravel()
+        tiles = np.union1d(tiles, neighbours[neighbours >= 0])
+    return tiles
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_catalog(milliquas_csv, directory=None, name_col=None, z_col=None, type_col=None):
+    """
+    Convert a Milliquas CSV into a prebuilt catalog directory (one-time step).
+
+    Parameters
+    ----------
+    milliquas_csv : str
+        Catalog CSV with 'ra' and 'dec' columns.
+    directory : str, optional
+        Output directory (default: ``<milliquas_csv>.catalog``).
+    name_col, z_col, type_col : str, optional
+        Name, redshift and type columns (default: columns 2, 4 and 3).
+
+    Returns
+    -------
+    str
+        The catalog directory, to pass to ``load_catalog``.
+    """
+    directory = directory or milliquas_csv + ".catalog"
+    os.makedirs(directory, exist_ok=True)
+    print(f"🛠️ Building catalog from {milliquas_csv}...")
+    catalog = Catalog.from_frame(pd.read_csv(milliquas_csv), name_col, z_col, type_col,
+                                 meta=dict(_source_stamp(milliquas_csv), version=CATALOG_VERSION))
+    for column in ('xyz', 'name', 'z', 'type', 'offsets'):
+        np.save(os.path.join(directory, f"{column}.npy"), getattr(catalog, column))
+    # Trees pickled by earlier builds are no longer used
+    stale_tree = os.path.join(directory, "tree.pkl")
+    if os.path.exists(stale_tree):
+        os.remove(stale_tree)
+    # Written last: a directory without meta.json is an incomplete build
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(catalog.meta, f)
+    print(f"✅ Catalog of {len(catalog)} sources written to {directory}")
+    return directory
+
+
+_loaded = {}
+
+
+def load_catalog(directory):
+    """
+    Load a catalog written by ``build_catalog``.
+
+    Columns are memory-mapped read-only, so no CSV parsing happens; the
+    k-d tree is built from ``xyz`` on first use, and a ``footprint`` of the
+    catalog never builds the full-sky tree. Loaded
+    catalogs are kept per process, so later calls for the same build
+    return at once.
+
+    Returns
+    -------
+    Catalog
+    """
+    meta_path = os.path.join(directory, "meta.json")
+    key = (os.path.abspath(directory), os.stat(meta_path).st_mtime_ns)
+    if key not in _loaded:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        columns = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode='r')
+                   for column in ('xyz', 'name', 'z', 'type', 'offsets')}
+        _loaded[key] = Catalog(meta=meta, **columns)
+    return _loaded[key]
+
+
+def open_catalog(path, directory=None, name_col=None, z_col=None, type_col=None):
+    """
+    Return the prebuilt catalog for a Milliquas CSV, building it if needed.
+
+    Parameters
+    ----------
+    path : str
+        Catalog CSV, or a directory written by ``build_catalog``.
+    directory : str, optional
+        Where the build of a CSV lives (default: ``<path>.catalog``).
+        It is rebuilt when the CSV (or a requested column) has changed since.
+    name_col, z_col, type_col : str, optional
+        Columns passed to ``build_catalog``.
+
+    Returns
+    -------
+    Catalog
+    """
+    if os.path.isdir(path):
+        return load_catalog(path)
+    directory = directory or path + ".catalog"
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        stamp = _source_stamp(path)
+        wanted = {'name': name_col, 'z': z_col, 'type': type_col}
+        columns = meta.get('columns', {})
+        if (meta.get('version') == CATALOG_VERSION
+                and all(meta.get(k) == v for k, v in stamp.items())
+                and all(v is None or columns.get(k) == v for k, v in wanted.items())):
+            return load_catalog(directory)
+    return load_catalog(build_catalog(path, directory, name_col, z_col, type_col))
+
+
+# Registered crossmatch catalogs, by name
+CATALOGS = {}
+_registry_lock = threading.Lock()
+
+
+def register_catalog(name, source, radius=MATCH_RADIUS_DEG, name_col=None, z_col=None,
+                     type_col=None, directory=None):
+    """
+    Add a catalog to the crossmatch registry used by ``crossmatch``.
+
+    Parameters
+    ----------
+    name : str
+        Label of the catalog in the match table; registering a name again
+        replaces it.
+    source : str, pandas.DataFrame or Catalog
+        Catalog CSV (prebuilt with ``open_catalog`` on first use), build
+        directory, DataFrame with 'ra' and 'dec' columns, or ``Catalog``.
+    radius : float, optional
+        Match radius in degrees (default ``MATCH_RADIUS_DEG``).
+    name_col, z_col, type_col : str, optional
+        Source name, redshift and type columns (default: columns 2, 4 and 3).
+    directory : str, optional
+        Build directory of a CSV source (default: ``<source>.catalog``).
+    """
+    with _registry_lock:
+        CATALOGS[name] = {
+            'source': source, 'radius': radius, 'directory': directory,
+            'columns': {'name_col': name_col, 'z_col': z_col, 'type_col': type_col},
+            'catalog': source if isinstance(source, Catalog) else None,
+        }
+
+
+def unregister_catalog(name):
+    """Remove a catalog from the crossmatch registry."""
+    with _registry_lock:
+        CATALOGS.pop(name, None)
+
+
+def get_catalog(name):
+    """Return the ``Catalog`` of a registered catalog, building its index on first use."""
+    with _registry_lock:
+        spec = CATALOGS[name]
+        if spec['catalog'] is None:
+            if isinstance(spec['source'], pd.DataFrame):
+                spec['catalog'] = Catalog.from_frame(spec['source'], **spec['columns'])
+            else:
+                spec['catalog'] = open_catalog(spec['source'], spec['directory'], **spec['columns'])
+        return spec['catalog']
+
+
+def crossmatch(cr, catalogs=None, all_matches=False, skymap=None, credible_level=0.9,
+               workers=None, output_csv=None):
+    """
+    Crossmatch candidates against several registered catalogs at once.
+
+    The candidate unit vectors are computed once and shared by every
+    catalog, and the catalogs are searched concurrently.
+
+    Parameters
+    ----------
+    cr : pandas.DataFrame
+        Candidates with 'meanra' and 'meandec' columns (not modified).
+    catalogs : sequence of str, optional
+        Registered catalog names (default: all of them).
+    all_matches : bool, optional
+        Return every source within each catalog's radius instead of the
+        nearest one (default False).
+    skymap : str or SkyMap, optional
+        If given, each catalog is restricted to its ``Catalog.footprint``
+        over the credible region at ``credible_level``.
+    workers : int, optional
+        Number of catalogs searched concurrently (default: all).
+    output_csv : str, optional
+        File to save the combined match table.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per candidate and match, ordered by candidate then catalog,
+        with the candidate columns plus 'catalog', 'agn' (source name), 'z',
+        'type', 'agnsep' (deg), 'n_agn' and 'ambiguous'.
+    """
+    names = list(CATALOGS) if catalogs is None else list(catalogs)
+    if not names:
+        raise ValueError("No catalogs registered; use register_catalog first")
+    # Indexes are built (or loaded) once, before the concurrent searches
+    radius = {name: CATALOGS[name]['radius'] for name in names}
+    loaded = {name: get_catalog(name) for name in names}
+    if skymap is not None:
+        loaded = {name: catalog.footprint(skymap, credible_level, margin=radius[name])
+                  for name, catalog in loaded.items()}
+
+    xyz = radec_to_xyz(cr['meanra'].to_numpy(dtype=float), cr['meandec'].to_numpy(dtype=float))
+    with ThreadPoolExecutor(max_workers=workers or len(names)) as executor:
+        futures = {name: executor.submit(_match_xyz, xyz, loaded[name], radius[name], all_matches)
+                   for name in names}
+        results = {name: future.result() for name, future in futures.items()}
+
+    tables = []
+    for rank, name in enumerate(names):
+        rows, idx, sep, counts = results[name]
+        catalog = loaded[name]
+        tables.append(pd.DataFrame({
+            '_row': rows, '_rank': rank, 'catalog': name,
+            'agn': catalog.name[idx], 'z': catalog.z[idx], 'type': catalog.type[idx],
+            'agnsep': sep, 'n_agn': counts[rows], 'ambiguous': counts[rows] > 1,
+        }))
+    matches = pd.concat(tables, ignore_index=True).sort_values(['_row', '_rank', 'agnsep'],
+                                                               kind='stable')
+    out = cr.iloc[matches['_row'].to_numpy()].copy()
+    for column in matches.columns.drop(['_row', '_rank']):
+        out[column] = matches[column].to_numpy()
+
+    for name in names:
+        found = out.loc[out['catalog'] == name]
+        print(f"✅ {name}: {found.index.nunique()} candidates matched within "
+              f"{radius[name] * 3600:.1f} arcsec.")
+    if output_csv is not None:
+        out.to_csv(output_csv, index=False)
+        print(f"Results saved to {output_csv}")
+    return out
+
+
 if __name__ == "__main__":
     # Example usage — modify paths below
     candidates_csv = '/path/to/your_candidates.csv'
@@ -0,0 +1,269 @@
+"""
+planner.py
+
+Per-region query planning for the ALeRCE cluster queries.
+
+For every cluster polygon the planner estimates the sky area and the
+expected number of returned rows, splits regions that are too large or
+too elongated, merges tiny neighbouring regions, and then picks the
+cheapest way to query each one: a single ``q3c_poly_query`` or a small set
+of ``q3c_radial_query`` disks. Cones may cover extra sky; the extra rows
+are removed downstream by the pixel-membership filter.
+"""
+
+import numpy as np
+from shapely.geometry import Polygon, box
+from shapely import affinity
+
+from .polygons import to_tangent_plane, from_tangent_plane
+from .sphere import mean_direction, radec_to_xyz
+
+SQDEG_PER_SR = np.rad2deg(1.0) ** 2
+
+# Rough ZTF rate of new objects per square degree per day, used to turn an
+# area and a time window into an expected row count.
+DENSITY_PER_DAY = 1.5
+
+# Cost model, in units of one query round trip
+QUERY_COST = 1.0
+VERTEX_COST = 0.01
+ROW_COST = 1e-4
+
+
+def spherical_area(polygon):
+    """
+    Area (deg^2) enclosed by a sky polygon with great-circle edges.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.Polygon
+        Polygon in (ra, dec) degrees (RA may be unwrapped).
+
+    Returns
+    -------
+    float
+    """
+    coords = np.array(polygon.exterior.coords)
+    v = radec_to_xyz(coords[:, 0], coords[:, 1])
+    a = mean_direction(v)
+    b, c = v[:-1], v[1:]
+    # Signed solid angle of the triangle fan (a, b_i, c_i)
+    num = np.einsum('ij,ij->i', b, np.cross(c, a))
+    den = 1.0 + b @ a + c @ a + np.einsum('ij,ij->i', b, c)
+    return abs(2.0 * np.arctan2(num, den).sum()) * SQDEG_PER_SR
+
+
+def enclosing_cone(polygon):
+    """
+    Disk (ra, dec, radius in deg) containing all vertices of a sky polygon.
+
+    The centre is the mean vertex direction, which is close to (but not
+    exactly) the minimal enclosing cone.
+    """
+    coords = np.array(polygon.exterior.coords)
+    v = radec_to_xyz(coords[:, 0], coords[:, 1])
+    center = mean_direction(v)
+    radius = np.rad2deg(np.arccos(np.clip((v @ center).min(), -1.0, 1.0)))
+    ra = np.rad2deg(np.arctan2(center[1], center[0])) % 360.0
+    dec = np.rad2deg(np.arcsin(np.clip(center[2], -1.0, 1.0)))
+    return ra, dec, radius
+
+
+def cone_area(radius):
+    """Area (deg^2) of a spherical cap of the given radius (deg)."""
+    return 2 * np.pi * (1 - np.cos(np.deg2rad(radius))) * SQDEG_PER_SR
+
+
+def elongation(polygon):
+    """Length-to-width ratio of the minimum rotated rectangle (tangent plane)."""
+    region, _ = to_tangent_plane(polygon)
+    rect = np.array(region.minimum_rotated_rectangle.exterior.coords)
+    sides = np.hypot(*np.diff(rect[:3], axis=0).T)
+    return sides.max() / max(sides.min(), 1e-12)
+
+
+def split_polygon(polygon, n=2):
+    """
+    Cut a sky polygon into ``n`` strips across its longest axis.
+
+    The cut is made in the tangent plane, so the pieces are exact and their
+    union is the original polygon.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.Polygon
+        Polygon in (ra, dec) degrees.
+    n : int, optional
+        Number of strips (default 2).
+
+    Returns
+    -------
+    list of shapely.geometry.Polygon
+        Pieces in (ra, dec) degrees.
+    """
+    region, center = to_tangent_plane(polygon)
+    rect = np.array(region.minimum_rotated_rectangle.exterior.coords)
+    edges = np.diff(rect[:3], axis=0)
+    major = edges[np.argmax(np.hypot(*edges.T))]
+    angle = np.degrees(np.arctan2(major[1], major[0]))
+
+    # Rotate so the major axis is along x, then cut into vertical strips
+    origin = region.centroid
+    rotated = affinity.rotate(region, -angle, origin=origin)
+    xmin, ymin, xmax, ymax = rotated.bounds
+    edges_x = np.linspace(xmin, xmax, n + 1)
+    pieces = []
+    for x0, x1 in zip(edges_x[:-1], edges_x[1:]):
+        strip = rotated.intersection(box(x0, ymin - 1, x1, ymax + 1))
+        for part in getattr(strip, 'geoms', [strip]):
+            if part.geom_type == 'Polygon' and part.area > 0:
+                pieces.append(from_tangent_plane(affinity.rotate(part, angle, origin=origin), center))
+    return pieces
+
+
+def expected_rows(area, ndays=200, density=DENSITY_PER_DAY):
+    """Expected number of objects returned for ``area`` deg^2 over ``ndays``."""
+    return area * density * ndays
+
+
+def plan_cost(n_queries, n_vertices, area, ndays=200, density=DENSITY_PER_DAY):
+    """Cost of a plan: round trips, polygon vertices and transferred rows."""
+    return (QUERY_COST * n_queries + VERTEX_COST * n_vertices
+            + ROW_COST * expected_rows(area, ndays, density))
+
+
+def _plan_region(polygon, labels, ndays, density, max_cones, max_cone_overhead):
+    """Choose between one polygon query and a few cone queries."""
+    area = spherical_area(polygon)
+    n_vertices = len(polygon.exterior.coords) - 1
+    best = {
+        'kind': 'polygon', 'polygon': polygon, 'cones': [], 'labels': labels,
+        'area': area, 'rows': expected_rows(area, ndays, density),
+        'cost': plan_cost(1, n_vertices, area, ndays, density),
+    }
+    for n in range(1, max_cones + 1):
+        pieces = [polygon] if n == 1 else split_polygon(polygon, n)
+        cones = [enclosing_cone(p) for p in pieces]
+        covered = sum(cone_area(r) for _, _, r in cones)
+        if covered > max_cone_overhead * area:
+            continue
+        cost = plan_cost(len(cones), 0, covered, ndays, density)
+        if cost < best['cost']:
+            best = {
+                'kind': 'cones', 'polygon': polygon, 'cones': cones, 'labels': labels,
+                'area': covered, 'rows': expected_rows(covered, ndays, density),
+                'cost': cost,
+            }
+    return best
+
+
+def _merge_tiny(regions, min_area, merge_slack):
+    """Greedily merge tiny regions whose joint convex hull stays compact."""
+    regions = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        tiny = [i for i, (poly, _) in enumerate(regions) if spherical_area(poly) < min_area]
+        for i in tiny:
+            for j in tiny:
+                if j <= i:
+                    continue
+                (p1, l1), (p2, l2) = regions[i], regions[j]
+                coords = np.vstack([p1.exterior.coords, p2.exterior.coords])
+                v = radec_to_xyz(coords[:, 0], coords[:, 1])
+                center = mean_direction(v)
+                if center is None or (v @ center).min() <= 0.5:
+                    continue
+                hull, hull_center = to_tangent_plane(Polygon(coords))
+                hull = from_tangent_plane(hull.convex_hull, hull_center)
+                joint = spherical_area(hull)
+                if joint <= merge_slack * (spherical_area(p1) + spherical_area(p2)):
+                    regions[i] = (hull, l1 + l2)
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def plan_queries(polygons, ndays=200, density=DENSITY_PER_DAY, max_area=300.0,
+                 max_rows=50000, max_elongation=4.0, min_area=0.5, merge_slack=2.0,
+                 max_cones=3, max_cone_overhead=1.6):
+    """
+    Plan the ALeRCE queries for a set of cluster polygons.
+
+    Parameters
+    ----------
+    polygons : dict
+        Polygon per cluster label, in (ra, dec) degrees.
+    ndays : int, optional
+        Length of the MJD window queried (default 200).
+    density : float, optional
+        Expected new objects per deg^2 per day (default ``DENSITY_PER_DAY``).
+    max_area : float, optional
+        Regions larger than this (deg^2) are split (default 300).
+    max_rows : int, optional
+        Regions expected to return more rows than this are split (default 50000).
+    max_elongation : float, optional
+        Regions more elongated than this are split (default 4).
+    min_area : float, optional
+        Regions smaller than this (deg^2) are merged with tiny neighbours
+        when the merged convex hull stays compact (default 0.5).
+    merge_slack : float, optional
+        Maximum ratio of merged hull area to the summed areas (default 2).
+    max_cones : int, optional
+        Maximum number of disks in a cone cover (default 3).
+    max_cone_overhead : float, optional
+        Maximum ratio of covered cone area to region area (default 1.6).
+
+    Returns
+    -------
+    list of dict
+        One entry per query with keys 'kind' ('polygon' or 'cones'),
+        'polygon', 'cones' (list of (ra, dec, radius) in deg), 'labels'
+        (cluster labels served), 'area' (deg^2 actually queried), 'rows'
+        (expected) and 'cost'.
+    """
+    # Split oversized or elongated regions until every piece is within limits
+    pending = [(polygon, [label]) for label, polygon in polygons.items()]
+    regions = []
+    while pending:
+        polygon, labels = pending.pop()
+        area = spherical_area(polygon)
+        too_big = area > max_area or expected_rows(area, ndays, density) > max_rows
+        if (too_big or elongation(polygon) > max_elongation) and area > min_area:
+            pieces = split_polygon(polygon, 2)
+            if len(pieces) > 1:
+                pending.extend((piece, labels) for piece in pieces)
+                continue
+        regions.append((polygon, labels))
+
+    regions = _merge_tiny(regions, min_area, merge_slack)
+    return [_plan_region(polygon, labels, ndays, density, max_cones, max_cone_overhead)
+            for polygon, labels in regions]
+
+
+def region_condition(plan, ra_col='meanra', dec_col='meandec'):
+    """
+    SQL condition selecting the objects of one planned query.
+
+    Parameters
+    ----------
+    plan : dict
+        Entry returned by ``plan_queries``.
+    ra_col, dec_col : str, optional
+        Coordinate column names.
+
+    Returns
+    -------
+    str
+        A ``q3c_poly_query`` or OR-ed ``q3c_radial_query`` condition.
+    """
+    if plan['kind'] == 'cones':
+        cones = [f"q3c_radial_query({ra_col}, {dec_col}, {ra:.6f}, {dec:.6f}, {radius:.6f})"
+                 for ra, dec, radius in plan['cones']]
+        return '(' + ' OR '.join(cones) + ')'
+    coords = np.array(plan['polygon'].exterior.coords)[:-1]
+    array = ','.join(f"{ra % 360:.6f},{dec:.6f}" for ra, dec in coords)
+    return f"q3c_poly_query({ra_col}, {dec_col}, ARRAY[{array}])"
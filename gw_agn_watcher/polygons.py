@@ -0,0 +1,233 @@
+"""
+polygons.py
+
+Query polygons traced from the boundaries of HEALPix pixel sets.
+
+Instead of triangulating pixel centres with an alpha shape, the polygon of
+a cluster is the outer boundary of the union of its (multiorder) pixels,
+computed in the gnomonic projection about the cluster centre, where the
+great-circle edges used by q3c are straight lines. The result always
+covers every pixel of the cluster.
+"""
+
+import numpy as np
+import astropy_healpix as ah
+import astropy.units as u
+import shapely
+from shapely.geometry import Polygon
+
+from .sphere import gnomonic, gnomonic_inverse, mean_direction, radec_to_xyz, xyz_to_radec
+
+# HEALPix pixel edges are not great circles. Edges of pixels coarser than
+# EDGE_LEVEL are sampled more densely, and the union is grown by a margin
+# larger than the remaining deviation (~0.5% of a level-7 pixel width).
+EDGE_LEVEL = 7
+EDGE_MARGIN = 0.01 * ah.nside_to_pixel_resolution(2**EDGE_LEVEL).to_value(u.rad)
+
+
+def pixel_boundaries(uniq):
+    """
+    Boundary vertices of multiorder HEALPix pixels as unit vectors.
+
+    Parameters
+    ----------
+    uniq : array-like
+        UNIQ indices of the pixels.
+
+    Returns
+    -------
+    list of ndarray
+        One (4 * step, 3) array per pixel, in counter-clockwise order.
+    """
+    uniq = np.asarray(uniq, dtype=np.int64)
+    level, ipix = ah.uniq_to_level_ipix(uniq)
+    level = np.asarray(level)
+    boundaries = [None] * len(uniq)
+    for lvl in np.unique(level):
+        idx = np.flatnonzero(level == lvl)
+        step = 2 ** max(0, EDGE_LEVEL - int(lvl))
+        lon, lat = ah.boundaries_lonlat(ipix[idx], step, ah.level_to_nside(lvl), order='nested')
+        xyz = radec_to_xyz(lon.to_value(u.deg), lat.to_value(u.deg))
+        for i, j in enumerate(idx):
+            boundaries[j] = xyz[i]
+    return boundaries
+
+
+def to_tangent_plane(polygon):
+    """
+    Project an (ra, dec) polygon to the tangent plane of its vertices' centre.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.Polygon
+        Exterior in (ra, dec) degrees.
+
+    Returns
+    -------
+    region : shapely.geometry.Polygon
+        The gnomonic projection, where great-circle edges are straight.
+    center : ndarray, shape (3,)
+        Unit vector of the tangent point.
+
+    Raises
+    ------
+    ValueError
+        If the vertices do not fit in a hemisphere around their centre.
+    """
+    coords = np.array(polygon.exterior.coords)
+    vertices = radec_to_xyz(coords[:, 0], coords[:, 1])
+    center = mean_direction(vertices)
+    if center is None or (vertices @ center).min() <= 0.05:
+        raise ValueError("Polygon does not fit in a hemisphere")
+    return Polygon(gnomonic(vertices, center)), center
+
+
+def from_tangent_plane(outline, center):
+    """
+    Map a tangent-plane polygon back to (ra, dec), inverse of ``to_tangent_plane``.
+
+    RA is unwrapped along the outline, so it may fall outside [0, 360).
+    """
+    ra, dec = xyz_to_radec(gnomonic_inverse(np.array(outline.exterior.coords), center))
+    return Polygon(np.column_stack([np.rad2deg(np.unwrap(np.deg2rad(ra))), dec]))
+
+
+def _simplify_plane(region, max_vertices, buffer):
+    """
+    Shrink the vertex count of a tangent-plane polygon without uncovering it.
+
+    The region is grown by ``buffer`` and then simplified with a tolerance
+    of at most ``buffer``; Douglas-Peucker moves the boundary by no more
+    than the tolerance, so the result cannot cut into the original. The
+    buffer is increased geometrically until the vertex target is met, and
+    every candidate is checked with ``covers``.
+    """
+    if max_vertices < 4:
+        raise ValueError("max_vertices must be at least 4")
+    region = Polygon(region.exterior)
+    if len(region.exterior.coords) - 1 <= max_vertices:
+        return region
+    for _ in range(40):
+        grown = region.buffer(buffer, join_style='mitre')
+        for tol in (buffer, buffer / 2):
+            candidate = grown.simplify(tol, preserve_topology=True)
+            if candidate.geom_type != 'Polygon':
+                continue
+            candidate = Polygon(candidate.exterior)
+            if (len(candidate.exterior.coords) - 1 <= max_vertices
+                    and candidate.covers(region)):
+                return candidate
+        buffer *= 1.5
+    # Four vertices always suffice
+    return region.minimum_rotated_rectangle
+
+
+def simplify_polygon(polygon, max_vertices=32, buffer_deg=0.01):
+    """
+    Simplify a sky polygon to a target vertex count while still containing it.
+
+    The cost of ``q3c_poly_query`` grows with the number of polygon
+    vertices, so large traced boundaries are worth trading for a slightly
+    larger area. Unlike a convex hull, the simplified shape keeps the
+    concavities the vertex budget allows.
+
+    Parameters
+    ----------
+    polygon : shapely.geometry.Polygon
+        Polygon in (ra, dec) degrees (RA may be unwrapped).
+    max_vertices : int, optional
+        Target number of distinct vertices (default 32).
+    buffer_deg : float, optional
+        Initial angular buffer (deg); it is grown as needed to meet the
+        vertex target (default 0.01).
+
+    Returns
+    -------
+    shapely.geometry.Polygon
+        Polygon in (ra, dec) degrees containing ``polygon``.
+    """
+    if len(polygon.exterior.coords) - 1 <= max_vertices:
+        return polygon
+    region, center = to_tangent_plane(polygon)
+    outline = _simplify_plane(region, max_vertices, np.deg2rad(buffer_deg))
+    return from_tangent_plane(outline, center)
+
+
+def healpix_polygon(uniq, max_vertices=98, buffer_deg=0.01):
+    """
+    Polygon covering a set of multiorder HEALPix pixels.
+
+    The pixel quadrilaterals are unioned in the tangent plane of the set's
+    centre; holes are dropped and disconnected pieces are replaced by their
+    convex hull, so the result is always a single polygon containing every
+    pixel. If it has more than ``max_vertices`` vertices, it is simplified
+    with the same coverage-preserving scheme as ``simplify_polygon``.
+
+    Parameters
+    ----------
+    uniq : array-like
+        UNIQ indices of the pixels (e.g. a cluster's 'pixel_no' column).
+    max_vertices : int, optional
+        Vertex budget (distinct vertices, default 98, which passes the
+        ``max_vertices=100`` check of ``findminclust``).
+    buffer_deg : float, optional
+        Initial angular buffer (deg) used when simplifying (default 0.01).
+
+    Returns
+    -------
+    shapely.geometry.Polygon
+        Polygon in (ra, dec) degrees. RAs are unwrapped around the centre,
+        so they may fall slightly outside [0, 360).
+    """
+    boundaries = pixel_boundaries(uniq)
+    corners = np.concatenate(boundaries)
+    center = mean_direction(corners)
+    if center is None or (corners @ center).min() <= 0.05:
+        raise ValueError("Pixel set does not fit in a hemisphere; split it first")
+
+    quads = [Polygon(gnomonic(b, center)) for b in boundaries]
+    union = shapely.union_all(quads).buffer(EDGE_MARGIN, join_style='mitre')
+    if union.geom_type != 'Polygon':
+        union = union.convex_hull
+    outline = _simplify_plane(Polygon(union.exterior), max_vertices, np.deg2rad(buffer_deg))
+    return from_tangent_plane(outline, center)
+
+
+def healpix_polygons(uniq, max_vertices=98, buffer_deg=0.01):
+    """
+    Polygons covering a set of multiorder HEALPix pixels, split as needed.
+
+    Like ``healpix_polygon``, but a pixel set that does not fit in a
+    hemisphere (e.g. the two lobes of a bimodal sky map) is split in two
+    along the principal axis of its pixel centres, recursively, instead
+    of raising.
+
+    Parameters
+    ----------
+    uniq : array-like
+        UNIQ indices of the pixels.
+    max_vertices, buffer_deg : optional
+        Passed to ``healpix_polygon``.
+
+    Returns
+    -------
+    list of shapely.geometry.Polygon
+        Polygons in (ra, dec) degrees that together cover every pixel.
+    """
+    uniq = np.asarray(uniq, dtype=np.int64)
+    try:
+        return [healpix_polygon(uniq, max_vertices=max_vertices, buffer_deg=buffer_deg)]
+    except ValueError:
+        if len(uniq) < 2:
+            raise
+    level, ipix = ah.uniq_to_level_ipix(uniq)
+    ra, dec = ah.healpix_to_lonlat(ipix, ah.level_to_nside(level), order='nested')
+    xyz = radec_to_xyz(ra.to_value(u.deg), dec.to_value(u.deg))
+    # Principal axis through the origin separates antipodal lobes
+    proj = xyz @ np.linalg.svd(xyz, full_matrices=False)[2][0]
+    side = proj > np.median(proj)
+    if side.all() or not side.any():
+        side = np.zeros(len(uniq), dtype=bool)
+        side[np.argsort(proj)[len(uniq) // 2:]] = True
+    return (healpix_polygons(uniq[~side], max_vertices, buffer_deg)
+            + healpix_polygons(uniq[side], max_vertices, buffer_deg))
@@ -9,19 +9,236 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from astropy.table import QTable
-from astropy.utils.data import download_file
-from astropy.io import fits
 import astropy_healpix as ah
 import astropy.units as u
 
+from .skymap import as_skymap
+
+def credible_regions(url, levels=(0.5, 0.9, 0.95)):
+    """
+    Extract nested credible regions from a skymap in a single pass.
+
+    The pixels are sorted once by probability density and the cumulative
+    probability is computed once; every requested level is then a prefix
+    of the same ordering, so the regions are nested.
+
+    Parameters
+    ----------
+    url : str or SkyMap
+        URL to the GW skymap FITS file, or an already loaded ``SkyMap``.
+    levels : sequence of float, optional
+        Cumulative probability cutoffs (default 50%, 90% and 95%).
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Pixels of the outermost region sorted by UNIQ, with columns
+        'meanra', 'meandec', 'pixel_no' (UNIQ), 'prob_contour' (cumulative
+        probability), 'prob' (pixel probability) and 'credible_level'
+        (innermost level whose region contains the pixel). Selecting
+        ``df['credible_level'] <= level`` gives the region for ``level``;
+        selecting ``df['credible_level'] == level`` gives its annulus.
+    """
+    gw_skymap = as_skymap(url)
+    levels = np.sort(np.atleast_1d(np.asarray(levels, dtype=float)))
+
+    # Single sort and cumulative sum shared by every level
+    order = np.argsort(gw_skymap.probdensity, kind='stable')[::-1]
+    cumprob = np.cumsum(gw_skymap.prob[order])
+    stops = cumprob.searchsorted(levels)
+    order, cumprob = order[:stops[-1]], cumprob[:stops[-1]]
+    ring = np.searchsorted(stops, np.arange(len(order)), side='right')
+
+    # Back to UNIQ order, as expected downstream
+    by_uniq = np.argsort(gw_skymap.uniq[order], kind='stable')
+    order, cumprob, ring = order[by_uniq], cumprob[by_uniq], ring[by_uniq]
+
+    uniq = gw_skymap.uniq[order]
+    level, ipix = ah.uniq_to_level_ipix(uniq)
+    ra, dec = ah.healpix_to_lonlat(ipix, ah.level_to_nside(level), order='nested')
+
+    return pd.DataFrame({
+        'meanra': np.rad2deg(ra.value),
+        'meandec': np.rad2deg(dec.value),
+        'pixel_no': uniq,
+        'prob_contour': cumprob,
+        'prob': gw_skymap.prob[order],
+        'credible_level': levels[ring],
+    })
+
+
+def skymap_pixel(url, ra, dec):
+    """
+    Index of the multiorder skymap pixel containing each position.
+
+    Every pixel is mapped to its range of nested indices at the finest
+    level of the map, so a single sorted search locates all positions
+    at once, whatever the mix of pixel sizes.
+
+    Parameters
+    ----------
+    url : str or SkyMap
+        URL to the GW skymap FITS file, or an already loaded ``SkyMap``.
+    ra, dec : array-like
+        Positions in degrees.
+
+    Returns
+    -------
+    ndarray of int
+        Row of the skymap holding each position, or -1 where the map has
+        no pixel (only possible for partial maps).
+    """
+    gw_skymap = as_skymap(url)
+    level, ipix = gw_skymap.level_ipix
+    level = np.asarray(level, dtype=np.int64)
+    max_level = int(level.max())
+    shift = 2 * (max_level - level)
+    starts = np.asarray(ipix, dtype=np.int64) << shift
+    order = np.argsort(starts)
+    starts = starts[order]
+    ends = starts + (np.int64(1) << shift[order])
+
+    nside = ah.level_to_nside(max_level)
+    fine = ah.lonlat_to_healpix(np.asarray(ra, dtype=float) * u.deg,
+                                np.asarray(dec, dtype=float) * u.deg, nside, order='nested')
+    i = np.searchsorted(starts, np.asarray(fine, dtype=np.int64), side='right') - 1
+    inside = (i >= 0) & (fine < ends[np.maximum(i, 0)])
+    return np.where(inside, order[np.maximum(i, 0)], -1)
+
+
+def credible_membership(df, url, credible_level=0.9, ra_col='meanra', dec_col='meandec'):
+    """
+    Keep only the objects that fall inside the credible region of a skymap.
+
+    The query polygons (and coarsened tiles or cone covers) are larger
+    than the credible region; this exact pixel test removes the extra
+    objects before the costly downstream stages.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Objects with RA/Dec columns, e.g. the output of
+        ``mainquery.query_alerce_clusters``.
+    url : str or SkyMap
+        URL to the GW skymap FITS file, or an already loaded ``SkyMap``.
+    credible_level : float, optional
+        Credible region to keep (default 0.9), defined as in
+        ``credible_regions``.
+    ra_col, dec_col : str, optional
+        Coordinate column names.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Copy of the objects inside the region, with extra columns
+        'probdensity' (2-D probability per steradian at the object) and
+        'prob_contour' (cumulative probability of its pixel).
+    """
+    gw_skymap = as_skymap(url)
+    if df.empty:
+        return df.assign(probdensity=pd.Series(dtype=float), prob_contour=pd.Series(dtype=float))
+
+    order = np.argsort(gw_skymap.probdensity, kind='stable')[::-1]
+    contour = np.empty(len(order))
+    contour[order] = np.cumsum(gw_skymap.prob[order])
+
+    pixel = skymap_pixel(gw_skymap, df[ra_col].to_numpy(), df[dec_col].to_numpy())
+    found = pixel >= 0
+    keep = found.copy()
+    keep[found] = contour[pixel[found]] < credible_level
+
+    out = df.loc[keep].copy()
+    out['probdensity'] = gw_skymap.probdensity[pixel[keep]]
+    out['prob_contour'] = contour[pixel[keep]]
+    return out
+
+
+def coarsen_pixels(df, max_level=7, min_level=3):
+    """
+    Merge fine multiorder pixels into coarser HEALPix tiles before clustering.
+
+    Pixels finer than ``max_level`` are replaced by their ancestor tile at
+    ``max_level`` (the tile covers all of them, so no sky is lost at the
+    boundary). Groups of four sibling tiles that are all present are then
+    merged into their parent, level by level, down to ``min_level``; this
+    step changes only the resolution, not the covered area. Probability is
+    summed over the merged pixels, so the total mass is unchanged.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Pixels with 'pixel_no' (UNIQ) and 'prob' columns, e.g. from
+        ``credible_regions`` or ``radecligo``. 'prob_contour' and
+        'credible_level' are carried over when present.
+    max_level : int, optional
+        Finest HEALPix level kept (default 7, ~0.2 deg^2 tiles).
+    min_level : int, optional
+        Coarsest level complete sibling groups are merged into (default 3).
+
+    Returns
+    -------
+    tiles : pandas.DataFrame
+        One row per tile with 'meanra', 'meandec' (tile centre), 'pixel_no'
+        (tile UNIQ), 'prob', 'npix' (number of merged input pixels) and the
+        carried-over columns, sorted by UNIQ.
+    """
+    carried = [c for c in ('prob_contour', 'credible_level') if c in df.columns]
+    if df.empty:
+        # Nothing left after the credible-region cut: no tiles
+        dtypes = {'meanra': float, 'meandec': float, 'pixel_no': np.int64, 'prob': float,
+                  'npix': np.int64, **{c: float for c in carried}}
+        return pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtypes.items()})
+
+    level, ipix = ah.uniq_to_level_ipix(df['pixel_no'].to_numpy(dtype=np.int64))
+    level = np.asarray(level, dtype=np.int64)
+    ipix = np.asarray(ipix, dtype=np.int64)
+
+    # Clip everything finer than max_level to its ancestor tile
+    shift = 2 * np.maximum(level - max_level, 0)
+    tiles = pd.DataFrame({
+        'level': np.minimum(level, max_level),
+        'ipix': ipix >> shift,
+        'prob': df['prob'].to_numpy(),
+        'npix': 1,
+    })
+    agg = {'prob': 'sum', 'npix': 'sum'}
+    if 'prob_contour' in df.columns:
+        tiles['prob_contour'] = df['prob_contour'].to_numpy()
+        agg['prob_contour'] = 'max'
+    if 'credible_level' in df.columns:
+        tiles['credible_level'] = df['credible_level'].to_numpy()
+        agg['credible_level'] = 'min'
+    tiles = tiles.groupby(['level', 'ipix'], as_index=False).agg(agg)
+
+    # Merge complete groups of four siblings, finest level first
+    for lvl in range(int(tiles['level'].max()), min_level, -1):
+        at_level = tiles['level'] == lvl
+        parent = tiles.loc[at_level, 'ipix'] // 4
+        complete = parent.map(parent.value_counts()) == 4
+        if not complete.any():
+            continue
+        merged = tiles.loc[complete.index[complete]].assign(level=lvl - 1, ipix=parent[complete])
+        merged = merged.groupby(['level', 'ipix'], as_index=False).agg(agg)
+        tiles = pd.concat([tiles.drop(complete.index[complete]), merged], ignore_index=True)
+
+    level = tiles['level'].to_numpy()
+    ipix = tiles['ipix'].to_numpy()
+    ra, dec = ah.healpix_to_lonlat(ipix, ah.level_to_nside(level), order='nested')
+    tiles.insert(0, 'meanra', np.rad2deg(ra.value))
+    tiles.insert(1, 'meandec', np.rad2deg(dec.value))
+    tiles.insert(2, 'pixel_no', ah.level_ipix_to_uniq(level, ipix))
+    tiles = tiles.drop(columns=['level', 'ipix'])
+    return tiles.sort_values('pixel_no', ignore_index=True)
+
+
 def radecligo(url, credible_level=0.9, plot=False):
     """
     Download and process a LIGO/Virgo/KAGRA skymap FITS file.
 
     Parameters
     ----------
-    url : str
-        URL to the GW skymap FITS file.
+    url : str or SkyMap
+        URL to the GW skymap FITS file, or an already loaded ``SkyMap``.
     credible_level : float, optional
         Cumulative probability cutoff (default 0.9 for 90% region).
     plot : bool, optional
@@ -41,52 +258,19 @@ def radecligo(url, credible_level=0.9, plot=False):
         Extracted event name from the URL (between 'superevents' and 'files').
     """
 
-    # --- Download and open skymap ---
-    gw_skymap = download_file(url, cache=True)
-    head=fits.open(gw_skymap)
-    time=head[1].header['MJD-OBS']
-    skymap = QTable.read(gw_skymap)
-
-    skymap2 = QTable.read(gw_skymap)
-    skymap.sort('PROBDENSITY', reverse=True)
-    #skymap.sort('PROB', reverse=True)
-    level, ipix = ah.uniq_to_level_ipix(skymap['UNIQ'])
-    nside = ah.level_to_nside(level)
-    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level))
-    prob = pixel_area * skymap['PROBDENSITY']
-    cumprob = np.cumsum(prob)
-    i = cumprob.searchsorted(0.9)
-    skymap['PROB']=cumprob
-    skymap = skymap[:i]
-
-    skymap.sort('UNIQ')
-    skymap = skymap['UNIQ','PROB']
-    level, ipix = ah.uniq_to_level_ipix(skymap['UNIQ'])
-    nside = ah.level_to_nside(level)
-
-    # Ensure little-endian for safety
-    def ensure_little_endian(data):
-        if data.dtype.byteorder == '>':
-            data = data.byteswap().newbyteorder('<')
-        return data
-
-    skymap= ensure_little_endian(np.array(skymap))
-
-    # RA/Dec conversion
-    ra, dec = ah.healpix_to_lonlat(ipix, nside, order='nested')
-    df = pd.DataFrame(skymap)
-    ra_deg = np.rad2deg(ra.value)
-    dec_deg = np.rad2deg(dec.value)
-    selected_elements=df['PROB']
-    arr=df['UNIQ']
-
-    # Build pandas DataFrame
-    skymap1 = pd.DataFrame({
-        'meanra': ra_deg.flatten(),
-        'meandec': dec_deg.flatten(),
-        'pixel_no': arr.values.flatten(),
-        'prob_contour': selected_elements.values.flatten()
+    # --- Load the shared skymap handle (downloaded and parsed once) ---
+    gw_skymap = as_skymap(url)
+    time = gw_skymap.mjd_obs
+
+    # --- Credible region (single cumulative-probability pass) ---
+    regions = credible_regions(gw_skymap, levels=(credible_level,))
+    skymap = QTable({
+        'UNIQ': regions['pixel_no'].to_numpy(),
+        'PROB': regions['prob_contour'].to_numpy(),
     })
+    ra_deg = regions['meanra'].to_numpy()
+    dec_deg = regions['meandec'].to_numpy()
+    skymap1 = regions.drop(columns='credible_level')
 
     # Optional plotting
     if plot:
@@ -97,18 +281,7 @@ def radecligo(url, credible_level=0.9, plot=False):
         plt.title('GW Skymap Pixels')
         plt.show()
 
-    # Extract event name from URL
-    strings_list = url.split('/')
-    start_index, end_index = -1, -1
-    for i, string in enumerate(strings_list):
-        if string == 'superevents':
-            start_index = i
-        elif string == 'files' and start_index != -1:
-            end_index = i
-            break
-    event_name = 'unknown'
-    if start_index != -1 and end_index != -1:
-        event_name = ' '.join(strings_list[start_index+1:end_index]).strip()
+    event_name = gw_skymap.event_name
 
     return skymap, skymap1, ra_deg, dec_deg, time, event_name
 
@@ -1,7 +1,5 @@
 import re
 import numpy as np
-from astropy.utils.data import download_file
-from ligo.skymap.io import fits
 from astropy.coordinates import Distance
 from ligo.skymap.distance import parameters_to_marginal_moments
 from astropy import units as u
@@ -9,6 +7,8 @@ import astropy.cosmology.units as cu
 from astropy.cosmology import WMAP9
 import pandas as pd
 
+from .skymap import as_skymap
+
 
 def compute_distance_redshift(url):
     """
@@ -16,8 +16,8 @@ def compute_distance_redshift(url):
 
     Parameters
     ----------
-    url : str
-        URL to the GW skymap FITS file.
+    url : str or SkyMap
+        URL to the GW skymap FITS file, or an already loaded ``SkyMap``.
 
     Returns
     -------
@@ -25,35 +25,14 @@ def compute_distance_redshift(url):
         Dictionary containing distance mean/std and redshift bounds.
     """
 
-    # Extract event name
-    strings_list = url.split('/')
-    start_index, end_index = -1, -1
-    for i, string in enumerate(strings_list):
-        if string == 'superevents':
-            start_index = i
-        elif string == 'files':
-            end_index = i
-            break
-
-    event_name = None
-    if start_index != -1 and end_index != -1:
-        event_name = ' '.join(strings_list[start_index + 1:end_index]).strip()
-
-    # Download and read FITS skymap
-    file = download_file(url, cache=True)
-    skymap, metadata = fits.read_sky_map(file, nest=False, distances=True)
-
-    map_struct = {
-        "prob": skymap[0],
-        "distmu": skymap[1],
-        "distsigma": skymap[2],
-        "distnorm": skymap[3],
-    }
+    # Shared multiorder skymap: no re-download, no flattening to full NSIDE
+    skymap = as_skymap(url)
+    event_name = skymap.event_name
 
     distmean, diststd = parameters_to_marginal_moments(
-        map_struct["prob"],
-        map_struct["distmu"],
-        map_struct["distsigma"]
+        skymap.prob,
+        skymap.distmu,
+        skymap.distsigma
     )
 
     sig = distmean / diststd
@@ -0,0 +1,290 @@
+"""
+skymap.py
+
+Shared handle on a LIGO/Virgo/KAGRA multiorder GW skymap.
+
+The FITS file is downloaded (and cached) once, opened lazily with
+memory mapping, and exposes the UNIQ/PROBDENSITY/DISTMU/DISTSIGMA columns
+together with the header metadata needed by the rest of the pipeline.
+All modules that need the skymap of an event should go through
+``load_skymap`` so that the file is only parsed once per event.
+"""
+
+import functools
+import os
+import urllib.error
+
+import numpy as np
+import astropy.units as u
+import astropy_healpix as ah
+from astropy.io import fits
+from astropy.table import Table
+from astropy.utils.data import download_file
+
+SKYMAP_COLUMNS = ('UNIQ', 'PROBDENSITY', 'DISTMU', 'DISTSIGMA', 'DISTNORM')
+
+
+def event_name_from_url(url, default='unknown'):
+    """
+    Extract the superevent name from a GraceDB skymap URL.
+
+    Parameters
+    ----------
+    url : str
+        URL of the form ``.../superevents/<name>/files/<file>``.
+    default : str, optional
+        Value returned when the URL does not follow that layout.
+
+    Returns
+    -------
+    str
+        Event name (the path components between 'superevents' and 'files').
+    """
+    strings_list = url.split('/')
+    start_index, end_index = -1, -1
+    for i, string in enumerate(strings_list):
+        if string == 'superevents':
+            start_index = i
+        elif string == 'files' and start_index != -1:
+            end_index = i
+            break
+    if start_index != -1 and end_index != -1:
+        return ' '.join(strings_list[start_index + 1:end_index]).strip()
+    return default
+
+
+def _native(data):
+    """Return ``data`` as a native-endian ndarray (FITS columns are big-endian)."""
+    data = np.asarray(data)
+    if data.dtype.byteorder not in ('=', '|'):
+        data = data.astype(data.dtype.newbyteorder('='))
+    return data
+
+
+class SkyMap:
+    """
+    Lazily loaded, memory-mapped multiorder GW skymap.
+
+    Nothing is downloaded or read until an attribute is first accessed.
+    Columns are converted to native-endian arrays on first use and cached,
+    so modules that only need the probability never pay for the distance
+    layers.
+
+    Parameters
+    ----------
+    url : str
+        URL (or local path) of the skymap FITS file. For ``*.fits.gz`` URLs
+        the ``*.multiorder.fits`` sibling is tried first, since it can be
+        memory-mapped and needs no conversion.
+    cache : bool, optional
+        Passed to ``astropy.utils.data.download_file`` (default True).
+    """
+
+    def __init__(self, url, cache=True):
+        self.url = url
+        self.cache = cache
+        self._filename = None
+        self._hdul = None
+        self._table = None
+        self._columns = {}
+
+    def __repr__(self):
+        return f"SkyMap({self.url!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- File access -----------------------------------------------------
+
+    @property
+    def filename(self):
+        """Local path of the downloaded FITS file."""
+        if self._filename is None:
+            if os.path.exists(self.url):
+                self._filename = self.url
+            elif self.url.endswith('.fits.gz'):
+                try:
+                    self._filename = download_file(
+                        self.url.replace('.fits.gz', '.multiorder.fits'), cache=self.cache)
+                except (urllib.error.URLError, OSError):
+                    self._filename = download_file(self.url, cache=self.cache)
+            else:
+                self._filename = download_file(self.url, cache=self.cache)
+        return self._filename
+
+    @property
+    def hdu(self):
+        """Binary table HDU holding the skymap (memory-mapped)."""
+        if self._hdul is None:
+            self._hdul = fits.open(self.filename, memmap=True)
+        return self._hdul[1]
+
+    @property
+    def header(self):
+        """FITS header of the skymap HDU."""
+        return self.hdu.header
+
+    @property
+    def is_multiorder(self):
+        """True if the file is stored as a NUNIQ multiorder map."""
+        return 'UNIQ' in self.hdu.columns.names
+
+    def _read_flat(self):
+        # Flat (single-resolution) maps cannot be used as-is; convert them
+        # to multiorder once and keep the result in memory.
+        from ligo.skymap.io import read_sky_map
+        if self._table is None:
+            self._table = read_sky_map(self.filename, moc=True)
+        return self._table
+
+    def column(self, name):
+        """
+        Return a skymap column as a native-endian ndarray.
+
+        Parameters
+        ----------
+        name : str
+            One of ``SKYMAP_COLUMNS``.
+
+        Returns
+        -------
+        ndarray
+            Column values (cached after the first call).
+        """
+        if name not in self._columns:
+            if self.is_multiorder:
+                data = self.hdu.data[name]
+            else:
+                data = self._read_flat()[name]
+            if name == 'UNIQ':
+                data = np.asarray(data).astype(np.int64)
+            self._columns[name] = _native(data)
+        return self._columns[name]
+
+    def close(self):
+        """Close the underlying FITS file and drop cached columns."""
+        if self._hdul is not None:
+            self._hdul.close()
+        self._hdul = None
+        self._table = None
+        self._columns = {}
+
+    # --- Metadata --------------------------------------------------------
+
+    @property
+    def mjd_obs(self):
+        """Observation time (MJD) from the 'MJD-OBS' header card."""
+        return float(self.header['MJD-OBS'])
+
+    @property
+    def event_name(self):
+        """Event name from the URL, falling back to the 'OBJECT' header card."""
+        name = event_name_from_url(self.url, default=None)
+        if name is None:
+            name = str(self.header.get('OBJECT', 'unknown'))
+        return name
+
+    # --- Columns ---------------------------------------------------------
+
+    @property
+    def uniq(self):
+        return self.column('UNIQ')
+
+    @property
+    def probdensity(self):
+        return self.column('PROBDENSITY')
+
+    @property
+    def distmu(self):
+        return self.column('DISTMU')
+
+    @property
+    def distsigma(self):
+        return self.column('DISTSIGMA')
+
+    @property
+    def distnorm(self):
+        return self.column('DISTNORM')
+
+    @property
+    def level_ipix(self):
+        """HEALPix (level, nested ipix) of every multiorder pixel."""
+        if 'level_ipix' not in self._columns:
+            self._columns['level_ipix'] = ah.uniq_to_level_ipix(self.uniq)
+        return self._columns['level_ipix']
+
+    @property
+    def pixel_area(self):
+        """Area of every multiorder pixel (sr)."""
+        if 'pixel_area' not in self._columns:
+            level, _ = self.level_ipix
+            area = ah.nside_to_pixel_area(ah.level_to_nside(level))
+            self._columns['pixel_area'] = u.Quantity(area, u.sr).value
+        return self._columns['pixel_area']
+
+    @property
+    def prob(self):
+        """Probability contained in every multiorder pixel."""
+        if 'prob' not in self._columns:
+            self._columns['prob'] = self.pixel_area * self.probdensity
+        return self._columns['prob']
+
+    def __len__(self):
+        return len(self.uniq)
+
+    def to_table(self, columns=SKYMAP_COLUMNS):
+        """
+        Build an astropy Table in the layout of ``ligo.skymap.io.read_sky_map(moc=True)``.
+
+        Parameters
+        ----------
+        columns : sequence of str, optional
+            Columns to include (missing ones are skipped).
+
+        Returns
+        -------
+        astropy.table.Table
+        """
+        if self.is_multiorder:
+            names = [c for c in columns if c in self.hdu.columns.names]
+        else:
+            names = [c for c in columns if c in self._read_flat().colnames]
+        table = Table({name: self.column(name) for name in names})
+        table.meta['objid'] = self.event_name
+        if 'MJD-OBS' in self.header:
+            table.meta['mjd_obs'] = self.mjd_obs
+        return table
+
+
+# Only the current event is kept; its parsed columns can be large
+@functools.lru_cache(maxsize=1)
+def load_skymap(url, cache=True):
+    """
+    Return the shared ``SkyMap`` handle for ``url``.
+
+    Repeated calls with the same URL return the same object, so the file is
+    downloaded, opened and parsed only once per event. Only the most recent
+    sky map is kept; ``load_skymap.cache_clear()`` releases it.
+
+    Parameters
+    ----------
+    url : str
+        URL (or local path) of the GW skymap FITS file.
+    cache : bool, optional
+        Passed to ``astropy.utils.data.download_file`` (default True).
+
+    Returns
+    -------
+    SkyMap
+    """
+    return SkyMap(url, cache=cache)
+
+
+def as_skymap(skymap):
+    """Return ``skymap`` unchanged if it is a ``SkyMap``, else load it by URL."""
+    if isinstance(skymap, SkyMap):
+        return skymap
+    return load_skymap(skymap)
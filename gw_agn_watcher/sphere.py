@@ -0,0 +1,195 @@
+"""
+sphere.py
+
+Vectorized spherical geometry on plain unit-vector arrays.
+
+These helpers avoid building astropy ``SkyCoord`` objects in the inner
+loops of the cluster search, where they are called hundreds of times per
+event.
+"""
+
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+
+
+def radec_to_xyz(ra, dec):
+    """
+    Convert RA/Dec (deg) to unit vectors.
+
+    Parameters
+    ----------
+    ra, dec : array-like
+        Coordinates in degrees.
+
+    Returns
+    -------
+    ndarray, shape (n, 3)
+        Cartesian unit vectors.
+    """
+    ra = np.deg2rad(np.asarray(ra, dtype=float))
+    dec = np.deg2rad(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def xyz_to_radec(xyz):
+    """
+    Convert vectors to RA/Dec (deg); the vectors need not be normalized.
+
+    Parameters
+    ----------
+    xyz : array-like, shape (n, 3)
+        Cartesian vectors.
+
+    Returns
+    -------
+    ra, dec : ndarray
+        RA in [0, 360) and Dec in [-90, 90] (deg).
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    ra = np.rad2deg(np.arctan2(y, x)) % 360.0
+    dec = np.rad2deg(np.arctan2(z, np.hypot(x, y)))
+    return ra, dec
+
+
+def tangent_basis(center):
+    """
+    Return an orthonormal basis (e_ra, e_dec) of the plane tangent at ``center``.
+
+    Parameters
+    ----------
+    center : array-like, shape (3,)
+        Unit vector of the tangent point.
+
+    Returns
+    -------
+    e1, e2 : ndarray, shape (3,)
+        Unit vectors pointing towards increasing RA and increasing Dec.
+    """
+    center = np.asarray(center, dtype=float)
+    e1 = np.cross([0.0, 0.0, 1.0], center)
+    if np.linalg.norm(e1) < 1e-12:
+        # Tangent point at a pole: any orientation will do
+        e1 = np.array([0.0, 1.0, 0.0])
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(center, e1)
+    return e1, e2
+
+
+def gnomonic(xyz, center):
+    """
+    Gnomonic (tangent-plane) projection of unit vectors about ``center``.
+
+    Great circles map to straight lines, so planar convex hulls and
+    polygons in this projection correspond to spherical ones. Only points
+    in the hemisphere centred on ``center`` can be projected.
+
+    Parameters
+    ----------
+    xyz : ndarray, shape (n, 3)
+        Unit vectors.
+    center : array-like, shape (3,)
+        Unit vector of the tangent point.
+
+    Returns
+    -------
+    ndarray, shape (n, 2)
+        Tangent-plane coordinates (radians at the tangent point).
+    """
+    center = np.asarray(center, dtype=float)
+    e1, e2 = tangent_basis(center)
+    w = xyz @ center
+    return np.stack([(xyz @ e1) / w, (xyz @ e2) / w], axis=-1)
+
+
+def gnomonic_inverse(xy, center):
+    """
+    Inverse of ``gnomonic``: tangent-plane coordinates back to unit vectors.
+
+    Parameters
+    ----------
+    xy : ndarray, shape (n, 2)
+        Tangent-plane coordinates.
+    center : array-like, shape (3,)
+        Unit vector of the tangent point.
+
+    Returns
+    -------
+    ndarray, shape (n, 3)
+        Unit vectors.
+    """
+    center = np.asarray(center, dtype=float)
+    e1, e2 = tangent_basis(center)
+    xy = np.asarray(xy, dtype=float)
+    v = center + xy[..., :1] * e1 + xy[..., 1:2] * e2
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def mean_direction(xyz, weights=None):
+    """
+    Normalized (optionally weighted) mean of unit vectors.
+
+    Returns None if the vectors cancel out (e.g. points spread over the
+    whole sky).
+    """
+    center = np.average(xyz, axis=0, weights=weights)
+    norm = np.linalg.norm(center)
+    if norm < 1e-9:
+        return None
+    return center / norm
+
+
+def great_circle_diameter(xyz, max_diameter=None, block_size=256):
+    """
+    Maximum great-circle separation (deg) among a set of unit vectors.
+
+    When all points lie within the hemisphere centred on their mean
+    direction, only the vertices of their convex hull in the gnomonic
+    projection can realise the diameter (exact for diameters up to 90 deg,
+    which covers every limit used in the cluster search), so the pairwise
+    search runs on the hull vertices only. Otherwise all points are used.
+
+    Parameters
+    ----------
+    xyz : array-like, shape (n, 3)
+        Unit vectors.
+    max_diameter : float, optional
+        If given, stop as soon as a pair farther apart than this (deg) is
+        found and return that separation; the result is then only a lower
+        bound on the diameter, but already exceeds ``max_diameter``.
+    block_size : int, optional
+        Number of rows of the pairwise dot-product matrix evaluated at once.
+
+    Returns
+    -------
+    float
+        Diameter in degrees.
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    if len(xyz) < 2:
+        return 0.0
+    min_cos = -1.0 if max_diameter is None else np.cos(np.deg2rad(max_diameter))
+
+    # Cheap lower bound: farthest point from an arbitrary vertex
+    dots = xyz @ xyz[0]
+    if dots.min() < min_cos:
+        return float(np.rad2deg(np.arccos(np.clip(dots.min(), -1.0, 1.0))))
+
+    # Hull-based pruning in the tangent plane of the mean direction
+    candidates = xyz
+    center = mean_direction(xyz)
+    if center is not None and len(xyz) > 3 and (xyz @ center).min() > 1e-6:
+        try:
+            hull = ConvexHull(gnomonic(xyz, center))
+            candidates = xyz[hull.vertices]
+        except QhullError:
+            # Degenerate (collinear) points: keep them all
+            pass
+
+    lowest = 1.0
+    for start in range(0, len(candidates), block_size):
+        lowest = min(lowest, (candidates[start:start + block_size] @ candidates.T).min())
+        if lowest < min_cos:
+            break
+    return float(np.rad2deg(np.arccos(np.clip(lowest, -1.0, 1.0))))
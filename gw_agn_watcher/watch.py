@@ -0,0 +1,119 @@
+"""
+watch.py
+
+Incremental follow-up of an event across repeated pipeline runs.
+
+A small JSON state file per event records the end of the last queried
+MJD window and the oids already processed. Each poll then queries only
+the time slice added since the previous run (with a small overlap for
+alerts ingested late) and sends only unseen oids through the downstream
+stages, so a daily rerun costs about one day of new alerts.
+"""
+
+import json
+import os
+import re
+
+from astropy.time import Time
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gw_agn_watcher", "watch")
+
+
+def state_path(event_name, directory=None):
+    """Path of the state file of ``event_name``."""
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(event_name)).strip("_") or "unknown"
+    return os.path.join(directory or DEFAULT_STATE_DIR, f"{safe}.json")
+
+
+def load_state(event_name, directory=None):
+    """
+    Load the watch state of an event (a fresh state if there is none).
+
+    Parameters
+    ----------
+    event_name : str
+        Superevent name, e.g. from ``radecligo``.
+    directory : str, optional
+        Directory holding the state files (default ``DEFAULT_STATE_DIR``).
+
+    Returns
+    -------
+    dict
+        Keys 'event_name', 'last_mjd' (end of the last queried window, or
+        None), 'seen' (set of processed oids) and 'runs'.
+    """
+    path = state_path(event_name, directory)
+    if not os.path.exists(path):
+        return {'event_name': event_name, 'last_mjd': None, 'seen': set(), 'runs': 0}
+    with open(path) as f:
+        state = json.load(f)
+    state['seen'] = set(state.get('seen', []))
+    return state
+
+
+def save_state(state, directory=None):
+    """Write the watch state atomically (temporary file + rename)."""
+    path = state_path(state['event_name'], directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = dict(state, seen=sorted(state['seen']))
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(payload, f)
+    os.replace(tmp, path)
+
+
+def reset_state(event_name, directory=None):
+    """Forget everything recorded for ``event_name``."""
+    path = state_path(event_name, directory)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def poll_window(state, mjd_obs, ndays=200, now=None, overlap=1.0):
+    """
+    MJD window to query on this poll.
+
+    Parameters
+    ----------
+    state : dict
+        Watch state from ``load_state``.
+    mjd_obs : float
+        Event time (MJD); the full window is [int(mjd_obs), int(mjd_obs) + ndays].
+    ndays : int, optional
+        Length of the full window (default 200).
+    now : float, optional
+        Current MJD (default: the current time).
+    overlap : float, optional
+        Days re-queried before the previous window end, to catch alerts
+        ingested late (default 1); repeated objects are removed by oid.
+
+    Returns
+    -------
+    tuple of float or None
+        (mjd_first, mjd_last), or None if nothing new can be queried.
+    """
+    now = Time.now().mjd if now is None else now
+    first, last = int(mjd_obs), min(int(mjd_obs) + ndays, now)
+    if state['last_mjd'] is not None:
+        if state['last_mjd'] >= int(mjd_obs) + ndays:
+            return None
+        first = max(first, state['last_mjd'] - overlap)
+    if last <= first:
+        return None
+    return first, last
+
+
+def new_objects(state, df):
+    """Rows of ``df`` whose oid has not been processed in a previous run."""
+    if df.empty:
+        return df
+    return df[~df['oid'].isin(state['seen'])].reset_index(drop=True)
+
+
+def record(state, df, mjd_last):
+    """Mark the oids of ``df`` as processed and the window as queried up to ``mjd_last``."""
+    if not df.empty:
+        state['seen'].update(df['oid'])
+    state['last_mjd'] = mjd_last
+    state['runs'] = state.get('runs', 0) + 1
+    return state
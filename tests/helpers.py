@@ -0,0 +1,65 @@
+"""Helpers and fakes shared by several test modules."""
+
+import astropy_healpix as ah
+import numpy as np
+from astropy.table import Table
+
+from gw_agn_watcher import classifiers
+from gw_agn_watcher.sphere import radec_to_xyz
+
+
+def disc_uniq(ra, dec, radius, level=8):
+    """UNIQ indices of the level-``level`` pixels whose centres lie in a disc."""
+    nside = 2**level
+    ipix = np.arange(12 * nside**2)
+    lon, lat = ah.healpix_to_lonlat(ipix, nside, order="nested")
+    xyz = radec_to_xyz(lon.deg, lat.deg)
+    inside = xyz @ radec_to_xyz(ra, dec) > np.cos(np.deg2rad(radius))
+    return ah.level_ipix_to_uniq(level, ipix[inside])
+
+
+def write_multiorder(path, mjd=60000.0, level=1):
+    """Write a small single-level (default NSIDE=2) multiorder skymap to ``path``."""
+    npix = 12 * 4**level
+    ipix = np.arange(npix)
+    uniq = 4 * 4**level + ipix
+    probdensity = np.exp(-0.5 * ipix)
+    pixel_area = 4 * np.pi / npix
+    probdensity /= (probdensity * pixel_area).sum()
+    table = Table({
+        "UNIQ": uniq.astype(np.int64),
+        "PROBDENSITY": probdensity,
+        "DISTMU": np.full(npix, 100.0),
+        "DISTSIGMA": np.full(npix, 10.0),
+        "DISTNORM": np.full(npix, 1e-4),
+    })
+    table.meta["ORDERING"] = "NUNIQ"
+    table.meta["MJD-OBS"] = mjd
+    table.write(path, overwrite=True)
+    return path
+
+
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = [(name,) for name in classifiers.CLASSIFIER_COLUMNS]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append((sql, params))
+
+    def fetchall(self):
+        return []
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return RecordingCursor(self)
@@ -0,0 +1,123 @@
+import matplotlib
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Polygon
+
+matplotlib.use("Agg")
+
+from gw_agn_watcher import backends, classifiers, detections, mainquery
+from gw_agn_watcher.sphere import radec_to_xyz
+
+
+@pytest.fixture(scope="module")
+def local(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("alerce") / "alerce.sqlite")
+    tables = backends.synthetic_tables(n_objects=5000, seed=3)
+    backends.write_tables(path, **tables)
+    backend = backends.LocalBackend(path)
+    yield backend, tables
+    backend.close()
+
+
+def test_polygon_and_cone_search(local):
+    backend, tables = local
+    objects = tables["object"]
+    xyz = radec_to_xyz(objects["meanra"], objects["meandec"])
+
+    # Convex quad straddling RA=0, vertices counter-clockwise on the sky
+    corners = [(350, -10), (20, -10), (20, 25), (350, 25)]
+    polygon = Polygon([(ra if ra < 180 else ra - 360, dec) for ra, dec in corners])
+    plan = {"kind": "polygon", "polygon": polygon, "cones": []}
+    found = backend.objects(plan, 0, 1e6)
+
+    # Inside a convex spherical polygon: on the left of every great-circle edge
+    v = radec_to_xyz(*np.array(corners).T)
+    inside = np.ones(len(objects), bool)
+    for a, b in zip(v, np.roll(v, -1, axis=0)):
+        inside &= xyz @ np.cross(a, b) > 0
+    assert set(found["oid"]) == set(objects["oid"][inside])
+
+    cone = {"kind": "cones", "polygon": polygon, "cones": [(10.0, 5.0, 8.0)]}
+    found = backend.objects(cone, 60100, 60200)
+    sep = np.rad2deg(np.arccos(np.clip(xyz @ radec_to_xyz(10.0, 5.0), -1, 1)))
+    first = objects["firstmjd"]
+    expected = (sep <= 8.0) & (first >= 60100) & (first <= 60200)
+    assert set(found["oid"]) == set(objects["oid"][expected])
+
+
+def test_query_modules_run_offline(local):
+    backend, tables = local
+    oids = pd.DataFrame({"oid": tables["object"]["oid"][:500]})
+
+    combined = classifiers.query_classifiers(backend, oids, batch_size=200)
+    legacy = classifiers.query_classifiers(backend, oids, batch_size=200, combined=False)
+    assert combined["oid"].is_unique
+    assert (combined["probability"] > 0.5).all()
+    assert set(combined["oid"]) == set(legacy["oid"])
+    stamp = combined.set_index("oid")["classifier_name"]
+    assert (stamp[legacy.loc[legacy["classifier_name"] == "stamp_classifier", "oid"]]
+            == "stamp_classifier").all()
+
+    det = detections.query_detections(combined, backend, batch_size=100)
+    assert det["oid"].is_unique and (det["drb"] > 0.5).all()
+    # The earliest passing detection is kept
+    passing = tables["detection"].merge(tables["ps1_ztf"], on="oid")
+    passing = passing[(passing["drb"] > 0.5)
+                      & ((passing["sgscore1"] < 0.5) | (passing["distpsnr1"] > 1))]
+    earliest = passing.groupby("oid")["mjd"].min()
+    assert np.allclose(det.set_index("oid")["mjd"], earliest[det["oid"]])
+
+
+def test_cluster_queries_on_backend(local):
+    backend, _ = local
+    df = pd.DataFrame({"meanra": [0.0, 0.0], "meandec": [0.0, 0.0], "cluster_label": [0, 1]})
+    polygons = {0: Polygon([(10, 0), (30, 0), (30, 20), (10, 20)]),
+                1: Polygon([(25, 10), (45, 10), (45, 30), (25, 30)])}
+    serial = mainquery.query_alerce_clusters(backend, df, 60000, 0, 0, polygons=polygons, plot=False)
+    parallel = mainquery.query_alerce_clusters(backend, df, 60000, 0, 0, polygons=polygons,
+                                               workers=2, plot=False)
+    assert len(serial) > 0 and serial["oid"].is_unique
+    assert set(serial["oid"]) == set(parallel["oid"])
+    assert serial["firstmjd"].between(60000, 60200).all()
+
+
+def test_agn_join_keeps_only_objects_near_agn(local):
+    backend, tables = local
+    objects = tables["object"]
+    # AGN next to every 10th object, plus some far from any object
+    near = objects.iloc[::10]
+    agn = pd.DataFrame({"ra": np.concatenate([near["meanra"] + 2e-4, [123.0]]),
+                        "dec": np.concatenate([near["meandec"], [-89.9]])})
+
+    sky = pd.DataFrame({"meanra": [5.0, 25.0, 25.0, 5.0], "meandec": [-5.0, -5.0, 20.0, 20.0],
+                        "cluster_label": 0})
+    polygon = {0: Polygon([(5, -5), (25, -5), (25, 20), (5, 20)])}
+    everything = mainquery.query_alerce_clusters(backend, sky, 0, None, None, polygons=polygon,
+                                                 plot=False, mjd_first=0, mjd_last=1e6)
+    joined = mainquery.query_alerce_clusters(backend, sky, 0, None, None, polygons=polygon,
+                                             plot=False, mjd_first=0, mjd_last=1e6, agn=agn)
+
+    assert 0 < len(joined) < len(everything)
+    assert set(joined["oid"]) == set(everything["oid"]) & set(near["oid"])
+
+
+def test_outer_query_excludes_inner_regions(local):
+    backend, _ = local
+    inner = {"kind": "cones", "polygon": None, "cones": [(15.0, 5.0, 6.0)]}
+    outer = {"kind": "polygon", "polygon": Polygon([(0, -10), (30, -10), (30, 20), (0, 20)]),
+             "cones": []}
+    everything = backend.objects(outer, 0, 1e6)
+    inside = backend.objects(inner, 0, 1e6)
+    ring = backend.objects(outer, 0, 1e6, exclude=[inner])
+
+    assert len(inside) > 0
+    assert set(ring["oid"]) == set(everything["oid"]) - set(inside["oid"])
+
+    # The plans queried are handed back for the next ring to exclude
+    sky = pd.DataFrame({"meanra": [0.0], "meandec": [0.0], "cluster_label": 0})
+    found = mainquery.query_alerce_clusters(backend, sky, 0, None, None, plot=False,
+                                            polygons={0: outer["polygon"]}, mjd_first=0,
+                                            mjd_last=1e6, exclude=[inner])
+    assert set(found["oid"]) == set(ring["oid"])
+    assert [plan["polygon"] for plan in found.attrs["plans"]] == [outer["polygon"]]
@@ -0,0 +1,104 @@
+import pickle
+import sqlite3
+import time
+
+import pandas as pd
+import pytest
+
+from gw_agn_watcher import cache, detections
+from helpers import RecordingConnection
+
+
+@pytest.fixture
+def shared_cache(tmp_path):
+    yield cache.enable_cache(str(tmp_path / "queries.sqlite"))
+    cache.disable_cache()
+
+
+def test_fingerprint_normalizes_oid_sets():
+    assert cache.fingerprint("q", {"b", "a"}) == cache.fingerprint("q", {"a", "b"})
+    assert cache.fingerprint("q", ["a", "b"]) != cache.fingerprint("q", ["a", "c"])
+
+
+def test_lru_eviction_and_ttl(tmp_path):
+    frame = pd.DataFrame({"oid": ["x"] * 100})
+    size = len(cache._encode(frame))
+    store = cache.QueryCache(str(tmp_path / "c.sqlite"), max_bytes=int(2.5 * size))
+
+    store.put("a", frame)
+    store.put("b", frame)
+    assert store.get("a") is not None  # 'b' is now the least recently used
+    store.put("c", frame)
+    assert store.get("b") is None
+    assert store.get("a") is not None and store.get("c") is not None
+
+    store.ttl = 0.01
+    time.sleep(0.02)
+    assert store.get("a") is None
+    assert len(store) == 1
+
+
+class Exploit:
+    def __reduce__(self):
+        return (exec, ("raise SystemExit('pickle was loaded')",))
+
+
+def test_results_stored_without_pickle(tmp_path):
+    store = cache.QueryCache(str(tmp_path / "c.sqlite"))
+    frame = pd.DataFrame({"oid": ["000123", "ZTF1"], "ndet": [3, 4], "drb": [0.5, None],
+                          "stellar": [True, False]})
+    store.put("frame", frame)
+    store.put("list", [1, "a"])
+    pd.testing.assert_frame_equal(store.get("frame"), frame, check_dtype=False)
+    assert store.get("frame")["oid"].tolist() == ["000123", "ZTF1"]
+    assert store.get("list") == [1, "a"]
+
+    # A pickle planted in the file is dropped, never loaded
+    store.close()
+    with sqlite3.connect(store.path) as db:
+        db.execute("UPDATE entries SET data = ? WHERE key = 'list'",
+                   (pickle.dumps(Exploit()),))
+    assert store.get("list") is None
+    assert len(store) == 1
+
+
+def test_cache_enabled_from_env_only_on_request(tmp_path, monkeypatch):
+    path = str(tmp_path / "env.sqlite")
+    monkeypatch.setenv("GW_AGN_WATCHER_CACHE", path)
+    assert cache.get_cache() is None
+    try:
+        assert cache.enable_cache_from_env().path == path
+    finally:
+        cache.disable_cache()
+    monkeypatch.delenv("GW_AGN_WATCHER_CACHE")
+    assert cache.enable_cache_from_env() is None
+
+
+def test_detections_served_from_cache(shared_cache):
+    oids = pd.DataFrame({"oid": [f"ZTF{i:08d}" for i in range(5)]})
+    first = RecordingConnection()
+    detections.query_detections(oids, first)
+    # Same oid set in a different order: no database round trip at all
+    second = RecordingConnection()
+    detections.query_detections(oids.iloc[::-1], second)
+
+    assert any(sql.startswith("EXECUTE") for sql, _ in first.statements)
+    assert second.statements == []
+    assert shared_cache.hits == 1
+
+
+def test_stale_detections_are_refetched(shared_cache, monkeypatch):
+    oids = pd.DataFrame({"oid": [f"ZTF{i:08d}" for i in range(5)]})
+    detections.query_detections(oids, RecordingConnection())
+
+    fresh = RecordingConnection()
+    detections.query_detections(oids, fresh)
+    assert fresh.statements == []
+
+    # Past OID_QUERY_TTL the entry is dropped and the query runs again
+    now = time.time() + cache.OID_QUERY_TTL + 1
+    monkeypatch.setattr(cache.time, "time", lambda: now)
+    stale = RecordingConnection()
+    detections.query_detections(oids, stale)
+    assert any(sql.startswith("EXECUTE") for sql, _ in stale.statements)
+    assert shared_cache.misses == 2
@@ -0,0 +1,218 @@
+import threading
+import time
+
+import pandas as pd
+import psycopg2
+import pytest
+
+from gw_agn_watcher import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def fetchone(self):
+        return (1,)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError("connection already closed")
+
+    def close(self):
+        self.closed = 1
+
+
+def test_pool_reuses_and_bounds_connections():
+    opened = []
+    pool = db.ConnectionPool(maxsize=2, connect=lambda: opened.append(FakeConnection()) or opened[-1])
+
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert len(opened) == 1
+
+    # A third borrower waits until one of the two connections is released
+    a, b = pool.acquire(), pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.05)
+    threading.Timer(0.05, pool.release, args=(a,)).start()
+    assert pool.acquire(timeout=1) is a
+    assert len(opened) == 2
+
+
+def test_pool_replaces_broken_connections():
+    opened = []
+    pool = db.ConnectionPool(maxsize=1, connect=lambda: opened.append(FakeConnection()) or opened[-1],
+                             ping_after=0)
+
+    # Errors raised by the database discard the connection
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            raise psycopg2.OperationalError("boom")
+    with pool.connection() as conn:
+        assert conn is opened[1]
+    assert opened[0].closed
+
+    # Idle connections that fail the health check are replaced
+    opened[1].broken = True
+    pool._idle = [(opened[1], time.monotonic() - 1)]
+    with pool.connection() as conn:
+        assert conn is opened[2]
+
+
+def test_credentials_fetched_once(monkeypatch):
+    calls = []
+
+    class Response:
+        def json(self):
+            return {"params": {"dbname": "d", "user": "u", "host": "h", "password": "p", "port": 1}}
+
+    monkeypatch.setattr(db.requests, "get", lambda url, timeout: calls.append(url) or Response())
+    db.alerce_params.cache_clear()
+    try:
+        assert db.alerce_params() == {"dbname": "d", "user": "u", "host": "h", "password": "p"}
+        db.alerce_params()
+        assert len(calls) == 1
+    finally:
+        db.alerce_params.cache_clear()
+
+
+class CopyCursor(FakeCursor):
+    def mogrify(self, sql, params):
+        return (sql % {k: "ARRAY[" + ",".join(f"'{v}'" for v in val) + "]"
+                       for k, val in params.items()}).encode()
+
+    def copy_expert(self, sql, buffer):
+        self.conn.statements.append(sql)
+        if self.conn.broken:
+            raise psycopg2.errors.FeatureNotSupported("COPY not allowed")
+        buffer.write(b"oid,ndet,stellar,meanra\n000123,3,t,10.5\nZTF1,4,f,\n")
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append(sql)
+        self.description = [("oid",), ("ndet",)]
+
+    def fetchall(self):
+        return [("row", 1)]
+
+
+class CopyConnection(FakeConnection):
+    def __init__(self):
+        super().__init__()
+        self.statements = []
+
+    def cursor(self):
+        return CopyCursor(self)
+
+
+def test_bulk_copy_fetch_and_fallback():
+    conn = CopyConnection()
+    df = db.read_prepared(conn, "bulk_test", "SELECT * FROM t WHERE oid = ANY($1);", [["a", "b"]],
+                          bulk=True)
+    assert conn.statements == [
+        "COPY (SELECT * FROM t WHERE oid = ANY(ARRAY['a','b'])) TO STDOUT WITH (FORMAT csv, HEADER true)"]
+    # Typed columns: oids stay strings, booleans and NULLs are decoded
+    assert list(df["oid"]) == ["000123", "ZTF1"]
+    assert df["ndet"].dtype == "int64" and df["stellar"].dtype == bool
+    assert df["meanra"].isna().tolist() == [False, True]
+
+    # Small results, and failed COPYs, use the row fetch path
+    broken = CopyConnection()
+    broken.broken = True
+    df = db.read_prepared(broken, "bulk_test", "SELECT 1 WHERE oid = ANY($1)", [["a"]], bulk=True)
+    assert list(df["oid"]) == ["row"]
+    assert broken.statements[-1].startswith("EXECUTE")
+
+
+class UploadCursor(CopyCursor):
+    def copy_expert(self, sql, buffer):
+        self.conn.statements.append(sql)
+        self.conn.uploaded = buffer.read()
+
+
+class UploadConnection(CopyConnection):
+    commits = 0
+
+    def cursor(self):
+        return UploadCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_positions_uploaded_once_per_connection():
+    conn = UploadConnection()
+    table = db.upload_positions(conn, [10.0, 20.5], [-5.0, 30.25])
+    assert table == db.POSITIONS_TABLE
+    assert conn.uploaded.splitlines() == ["10.00000000,-5.00000000", "20.50000000,30.25000000"]
+    assert any("q3c_ang2ipix(ra, dec)" in sql for sql in conn.statements)
+    # Committed, so the pool's rollback on release keeps the table
+    assert conn.commits == 1
+
+    # Same positions: nothing sent again; new positions replace the table
+    n_statements = len(conn.statements)
+    db.upload_positions(conn, [10.0, 20.5], [-5.0, 30.25])
+    assert len(conn.statements) == n_statements
+    db.upload_positions(conn, [1.0], [2.0])
+    assert conn.commits == 2 and conn.statements[n_statements].startswith("DROP TABLE")
+
+
+class StreamCursor(CopyCursor):
+    def copy_expert(self, sql, writer):
+        writer.write(b"oid,ndet\n")
+        # Far more than a pipe buffer: the parser must read while COPY writes
+        for start in range(0, 200000, 1000):
+            writer.write("".join(f"ZTF{i},{i % 7}\n" for i in range(start, start + 1000)).encode())
+            if self.conn.malformed:
+                writer.write(b"ZTF,1,2,3\n")
+        if self.conn.broken:
+            raise psycopg2.OperationalError("connection lost")
+
+
+class StreamConnection(CopyConnection):
+    malformed = False
+
+    def cursor(self):
+        return StreamCursor(self)
+
+
+def test_copy_query_streams_large_results():
+    df = db.copy_query(StreamConnection(), "SELECT oid, ndet FROM object")
+    assert len(df) == 200000 and df["oid"].iloc[-1] == "ZTF199999"
+
+    # An error after part of the rows were streamed is raised, not swallowed
+    broken = StreamConnection()
+    broken.broken = True
+    with pytest.raises(psycopg2.OperationalError):
+        db.copy_query(broken, "SELECT oid, ndet FROM object")
+
+
+def test_copy_query_reports_parse_errors():
+    # The parser fails early while COPY is still writing into the pipe
+    conn = StreamConnection()
+    conn.malformed = True
+    with pytest.raises(pd.errors.ParserError) as info:
+        db.copy_query(conn, "SELECT oid, ndet FROM object")
+    assert not isinstance(info.value, BrokenPipeError)
+    assert info.value.__cause__ is None
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from gw_agn_watcher import findminclust
+from gw_agn_watcher.divide import dividemap
+
+
+def mock_skymap(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "meanra": rng.uniform(100, 160, n),
+        "meandec": rng.uniform(-20, 20, n),
+    })
+
+
+def test_find_min_clusters_returns_validated_labels(monkeypatch):
+    df = mock_skymap()
+    calls = []
+    fit = findminclust.fit_clusters
+
+    def counting_fit(df, k, *args, **kwargs):
+        calls.append(k)
+        return fit(df, k, *args, **kwargs)
+
+    monkeypatch.setattr(findminclust, "fit_clusters", counting_fit)
+    n, labels, polygons = findminclust.find_min_clusters(df, return_labels=True)
+
+    # Each k is fitted at most once, and far fewer than a linear scan
+    assert len(calls) == len(set(calls))
+    assert len(calls) < n or n <= 2
+    assert n - 1 in calls or n == 1
+
+    # The returned labels are the ones that were validated
+    assert len(labels) == len(df)
+    assert len(np.unique(labels)) == n
+    assert all(findminclust.polygon_diameter(p) < 25 for p in polygons.values())
+
+    df_out, model = dividemap(n, df, plot=False, labels=labels)
+    assert model is None
+    assert np.array_equal(df_out["cluster_label"].to_numpy(), labels)
+
+
+def test_non_monotonic_validity_returns_smallest_valid_k(monkeypatch):
+    # K-Means fits need not get better with k: 5 is valid but 6 is not
+    valid = {5, 7, 8}
+    monkeypatch.setattr(findminclust, "fit_clusters",
+                        lambda df, k, *args, **kwargs: (k in valid, np.zeros(len(df)), {}))
+    assert findminclust.find_min_clusters(mock_skymap()) == 5
+
+
+def test_polygon_diameter_matches_skycoord():
+    from astropy.coordinates import SkyCoord
+    from shapely.geometry import MultiPoint
+
+    rng = np.random.default_rng(1)
+    for ra0, dec0 in [(0.0, 0.0), (359.0, 30.0), (120.0, 85.0)]:
+        ra = (ra0 + rng.normal(0, 5, 60)) % 360
+        dec = np.clip(dec0 + rng.normal(0, 3, 60), -90, 90)
+        polygon = MultiPoint(np.column_stack([ra, dec])).convex_hull
+        coords = np.array(polygon.exterior.coords)
+        sky = SkyCoord(coords[:, 0], coords[:, 1], unit="deg")
+        expected = sky[:, None].separation(sky[None, :]).max().deg
+
+        assert np.isclose(findminclust.polygon_diameter(polygon), expected)
+        # Early exit still reports a value beyond the limit
+        if expected > 1:
+            assert findminclust.polygon_diameter(polygon, max_diameter=1) > 1
+
+
+def test_sphere_method_keeps_ra_wraparound_region_together():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "meanra": rng.uniform(-6, 6, 500) % 360,
+        "meandec": rng.uniform(-5, 5, 500),
+    })
+    n, labels, polygons = findminclust.find_min_clusters(df, return_labels=True, method="sphere")
+
+    assert n == 1
+    assert len(polygons) == 1
+    polygon = polygons[0]
+    ra = np.array(polygon.exterior.coords)[:, 0]
+    # Unwrapped vertices span RA=0 continuously instead of 0..360
+    assert np.ptp(ra) < 20
+    assert findminclust.polygon_diameter(polygon) < 20
+
+
+def test_bimodal_skymap_is_split_into_valid_clusters():
+    import astropy_healpix as ah
+
+    level = 6
+    nside = 2**level
+    ipix = np.arange(12 * nside**2)
+    lon, lat = ah.healpix_to_lonlat(ipix, nside, order="nested")
+    ra, dec = lon.deg, lat.deg
+    # Two lobes on opposite sides of the sky
+    sep = [np.hypot((ra - c + 180) % 360 - 180, dec) for c in (10.0, 190.0)]
+    inside = (sep[0] < 3) | (sep[1] < 3)
+    df = pd.DataFrame({"meanra": ra[inside], "meandec": dec[inside],
+                       "pixel_no": ah.level_ipix_to_uniq(level, ipix[inside])})
+
+    num, labels, polygons = findminclust.find_min_clusters(df, return_labels=True,
+                                                           method="sphere")
+    assert num >= 2
+    assert set(polygons) == set(np.unique(labels))
@@ -1,86 +1,97 @@
-import warnings
-warnings.filterwarnings("ignore")
-import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import importlib
-
-from gw_agn_watcher import radecligo, findminclust, divide, mainquery, match_milliquas
-from gw_agn_watcher import redshift, classifiers, detections, extinction
-from gw_agn_watcher.db import get_alerce_connection
-import re
+import matplotlib
 import numpy as np
-from astropy.utils.data import download_file
-from ligo.skymap.io import fits
-from astropy.coordinates import Distance
-from ligo.skymap.distance import parameters_to_marginal_moments
-from astropy import units as u
-import astropy.cosmology.units as cu
-from astropy.cosmology import WMAP9
 import pandas as pd
-def test_run_pipeline(monkeypatch, tmp_path):
-
-    def mock_radecligo(url):
-        return (
-            "mock_skymap",
-            pd.DataFrame({
-                "meanra": [10, 20],
-                "meandec": [-5, 15],
-                "pixel_no": [1, 2],
-                "prob_contour": [0.6, 0.4]
-            }),
-            np.array([10, 20]),
-            np.array([-5, 15]),
-            60000.0,
-            "S000001"
-        )
-
-    # Patch correctly (IMPORTANT)
-    monkeypatch.setattr(main_pipeline, "radecligo", mock_radecligo)
-    monkeypatch.setattr(main_pipeline, "get_alerce_connection", lambda: "mock_conn")
-
-    monkeypatch.setattr(main_pipeline, "find_min_clusters", lambda df: 2)
-    monkeypatch.setattr(main_pipeline, "dividemap",
-                        lambda num, df: (pd.DataFrame({"meanra": [10, 20]}), "mock_kmeans"))
-
-    monkeypatch.setattr(main_pipeline, "query_alerce_clusters",
-                        lambda conn, df_out, mjd, ra, dec:
-                        pd.DataFrame({"oid": ["a1", "a2"], "meanra": [10, 20]}))
-
-    monkeypatch.setattr(main_pipeline, "match_with_milliquas",
-                        lambda df, agn: df.assign(matched=True))
-
-    monkeypatch.setattr(main_pipeline, "compute_distance_redshift",
-                        lambda url: pd.DataFrame({"dist": [1]}))
-
-    monkeypatch.setattr(main_pipeline, "filter_agn_by_redshift",
-                        lambda nagn, res: pd.DataFrame({"final_2sigma": ["a1", "a2"]}))
-
-    monkeypatch.setattr(main_pipeline, "query_classifiers",
-                        lambda conn, df:
-                        pd.DataFrame({"oid": ["a1", "a2"], "cls": ["AGN", "SN"]}))
-
-    monkeypatch.setattr(main_pipeline, "query_detections",
-                        lambda df, conn:
-                        pd.DataFrame({"oid": ["a1", "a2"], "ndet": [5, 10]}))
-
-    monkeypatch.setattr(main_pipeline, "compute_lat_extinction",
-                        lambda df, apply_cuts=True:
-                        (pd.DataFrame({"gal_A_g": [0.1, 0.2]}), df))
-
-    # Dummy file
-    path = tmp_path / "milliquas.csv"
-    pd.DataFrame({"ra": [10], "dec": [-5]}).to_csv(path, index=False)
-
-    candidates, ra, dec, url = main_pipeline.run_pipeline(
-        "https://mock_url", str(path)
-    )
-
-    # Strong assertions
-    assert len(candidates) == 2
-    assert set(candidates["oid"]) == {"a1", "a2"}
-    assert isinstance(ra, np.ndarray)
-    assert isinstance(dec, np.ndarray)
-
-    assert url.startswith("https://alerce.online/?")
-    assert "oid=" in url
+import pytest
+
+matplotlib.use("Agg")
+
+from gw_agn_watcher import backends, extinction, main_pipeline, redshift
+from gw_agn_watcher.radecligo import credible_membership
+from gw_agn_watcher.skymap import load_skymap
+from helpers import write_multiorder
+
+
+@pytest.fixture
+def offline(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    tables = backends.synthetic_tables(n_objects=20000, seed=5)
+    backends.write_tables(str(tmp_path / "alerce.sqlite"), **tables)
+    backend = backends.LocalBackend(str(tmp_path / "alerce.sqlite"))
+    skymap_path = str(write_multiorder(tmp_path / "S999999x.multiorder.fits", level=3))
+
+    # One AGN on every object, at the redshift of the event
+    objects = tables["object"]
+    z = redshift.compute_distance_redshift(skymap_path)
+    pd.DataFrame({"ra": objects["meanra"], "dec": objects["meandec"],
+                  "name": "QSO" + objects["oid"], "type": "Q",
+                  "z": (z["z_min1"] + z["z_max1"]) / 2}).to_csv("milliquas.csv", index=False)
+
+    # The dust maps need a download; keep every source
+    monkeypatch.setattr(extinction, "compute_lat_extinction",
+                        lambda df, apply_cuts=True: (df, df))
+
+    # Objects of the 90% region, first detected in the window, classified and detected
+    window = objects[objects["firstmjd"].between(60000, 60200)]
+    inside = credible_membership(window, load_skymap(skymap_path), credible_level=0.9)
+    classified = set(backend.classifiers(list(inside["oid"]))["oid"])
+    expected = set(backend.detections(list(classified))["oid"])
+    yield backend, skymap_path, expected
+    backend.close()
+    main_pipeline.clear_skymap_cache()
+
+
+def test_run_pipeline_offline(offline):
+    backend, skymap_path, expected = offline
+    candidates, ra, dec, url, mjd = main_pipeline.run_pipeline(skymap_path, "milliquas.csv",
+                                                               backend=backend)
+
+    assert len(candidates) > 0 and candidates["oid"].is_unique
+    assert set(candidates["oid"]) == expected
+    assert (candidates["agn"] == "QSO" + candidates["oid"]).all()
+    assert isinstance(ra, np.ndarray) and isinstance(dec, np.ndarray) and mjd == 60000.0
+    assert url.startswith("https://alerce.online/?") and f"oid={candidates['oid'].iloc[0]}" in url
+
+
+def test_run_pipeline_ring_by_ring(offline, tmp_path):
+    backend, skymap_path, expected = offline
+    rings = []
+    candidates, *_ = main_pipeline.run_pipeline(
+        skymap_path, "milliquas.csv", backend=backend, credible_levels=(0.5, 0.9),
+        on_ring=lambda level, found: rings.append((level, found)))
+
+    assert [level for level, _ in rings] == [0.5, 0.9]
+    assert set(candidates["oid"]) == expected
+    # Each ring keeps its own intermediate files, matching what it returned
+    for level, found in rings:
+        final1 = pd.read_csv(tmp_path / f"final1_ring{level * 100:g}.csv")
+        assert set(found["oid"]) <= set(final1["oid"])
+
+
+def test_run_pipeline_query_settings(offline, monkeypatch):
+    backend, skymap_path, expected = offline
+    calls = []
+    query = main_pipeline.mainquery.query_alerce_clusters
+
+    def recording_query(*args, **kwargs):
+        calls.append((kwargs["plan"], kwargs["workers"]))
+        return query(*args, **kwargs)
+
+    monkeypatch.setattr(main_pipeline.mainquery, "query_alerce_clusters", recording_query)
+    candidates, *_ = main_pipeline.run_pipeline(skymap_path, "milliquas.csv", backend=backend,
+                                                plan=False, workers=1)
+    assert calls == [(False, 1)]
+    assert set(candidates["oid"]) == expected
+
+
+def test_run_pipeline_stops_on_empty_region(offline, monkeypatch):
+    backend, skymap_path, _ = offline
+    radecligo = main_pipeline.radecligo.radecligo
+
+    def nothing_left(skymap):
+        skymap, region, *rest = radecligo(skymap)
+        return (skymap, region.iloc[:0], *rest)
+
+    monkeypatch.setattr(main_pipeline.radecligo, "radecligo", nothing_left)
+    candidates, ra, dec, url = main_pipeline.run_pipeline(skymap_path, "milliquas.csv",
+                                                          backend=backend)
+    assert candidates.empty and url is None
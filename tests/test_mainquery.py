@@ -0,0 +1,166 @@
+import threading
+import time
+
+import matplotlib
+import numpy as np
+import pandas as pd
+from shapely.geometry import MultiPolygon, box
+
+matplotlib.use("Agg")
+
+from gw_agn_watcher import cache, mainquery
+
+
+class FakeConnection:
+    opened = []
+
+    def __init__(self):
+        self.closed = False
+        FakeConnection.opened.append(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_concurrent_queries_deduplicate(monkeypatch):
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def fake_read_sql(query, conn):
+        assert isinstance(conn, FakeConnection)
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        # Every region returns the shared object 'a' and one of its own
+        return pd.DataFrame({"oid": ["a", f"q{hash(query)}"], "meanra": [10.0, 11.0], "meandec": [0.0, 1.0]})
+
+    monkeypatch.setattr(mainquery.pd, "read_sql_query", fake_read_sql)
+    FakeConnection.opened = []
+    polygons = {i: box(10 * i, 0, 10 * i + 5, 5) for i in range(6)}
+    df = pd.DataFrame({"meanra": np.zeros(6), "meandec": np.zeros(6), "cluster_label": range(6)})
+
+    caller_conn = FakeConnection()
+    pool = mainquery.db.ConnectionPool(maxsize=3, connect=FakeConnection)
+    result = mainquery.query_alerce_clusters(
+        caller_conn, df, 60000, 0, 0, polygons=polygons, workers=3, pool=pool, plot=False)
+
+    assert len(result) == 7
+    assert result["oid"].is_unique
+    assert 1 < peak[0] <= 3
+    # Workers borrow pooled connections; the caller's one is left open
+    assert not caller_conn.closed
+    assert len(FakeConnection.opened) <= 4
+    pool.close()
+    assert all(c.closed for c in FakeConnection.opened[1:])
+
+
+def test_object_query_joins_uploaded_agn():
+    plan = {"kind": "cones", "cones": [(10.0, 20.0, 1.5)]}
+    sql = mainquery.object_query(plan, 60000, 60200, near=("gw_agn_positions", 0.0008))
+    assert "q3c_radial_query(meanra, meandec, 10.000000, 20.000000, 1.500000)" in sql
+    assert ("q3c_join(object.meanra, object.meandec, agn.ra, agn.dec, 0.00080000)" in sql
+            and "FROM gw_agn_positions AS agn" in sql)
+    assert "q3c_join" not in mainquery.object_query(plan, 60000, 60200)
+
+
+def test_object_query_excludes_queried_regions():
+    inner = {"kind": "cones", "cones": [(10.0, 20.0, 1.5)]}
+    outer = {"kind": "polygon", "polygon": box(0, 10, 20, 30), "cones": []}
+    sql = mainquery.object_query(outer, 60000, 60200, exclude=[inner])
+    assert "q3c_poly_query" in sql
+    assert "AND NOT (q3c_radial_query(meanra, meandec, 10.000000, 20.000000, 1.500000))" in sql
+
+
+def test_join_fallback_not_cached_under_join_key(tmp_path, monkeypatch):
+    store = cache.enable_cache(str(tmp_path / "queries.sqlite"))
+    queries = []
+
+    def fake_read_query(conn, sql, expected_rows=None):
+        queries.append(sql)
+        return pd.DataFrame({"oid": ["a"], "meanra": [10.0], "meandec": [1.0]})
+
+    def failed_upload(conn, ra, dec, key=None):
+        raise RuntimeError("no temp tables")
+
+    monkeypatch.setattr(mainquery.db, "read_query", fake_read_query)
+    monkeypatch.setattr(mainquery.db, "upload_positions", failed_upload)
+    df = pd.DataFrame({"meanra": [0.0], "meandec": [0.0], "cluster_label": [0]})
+    agn = pd.DataFrame({"ra": [10.0], "dec": [1.0]})
+    kwargs = dict(polygons={0: box(5, 0, 15, 5)}, plot=False, mjd_first=50000, mjd_last=50100)
+    try:
+        mainquery.query_alerce_clusters(FakeConnection(), df, 0, 0, 0, agn=agn, **kwargs)
+        assert len(queries) == 1 and "q3c_join" not in queries[0]
+        assert len(store) == 1
+
+        # Once the upload works, the joined query runs instead of the cached fallback
+        monkeypatch.setattr(mainquery.db, "upload_positions", lambda *args, **kw: None)
+        mainquery.query_alerce_clusters(FakeConnection(), df, 0, 0, 0, agn=agn, **kwargs)
+        assert len(queries) == 2 and "q3c_join" in queries[1]
+    finally:
+        cache.disable_cache()
+
+
+def test_windows_ending_now_are_not_cached(tmp_path, monkeypatch):
+    store = cache.enable_cache(str(tmp_path / "queries.sqlite"))
+    monkeypatch.setattr(mainquery.db, "read_query",
+                        lambda conn, sql, expected_rows=None: pd.DataFrame({"oid": ["a"]}))
+    df = pd.DataFrame({"meanra": [0.0], "meandec": [0.0], "cluster_label": [0]})
+    now = mainquery.Time.now().mjd
+    try:
+        # A watch poll ends its slice at the current time
+        mainquery.query_alerce_clusters(FakeConnection(), df, 0, 0, 0, polygons={0: box(5, 0, 15, 5)},
+                                        plot=False, mjd_first=now - 3, mjd_last=now)
+        assert len(store) == 0
+        mainquery.query_alerce_clusters(FakeConnection(), df, 0, 0, 0, polygons={0: box(5, 0, 15, 5)},
+                                        plot=False, mjd_first=now - 30, mjd_last=now - 10)
+        assert len(store) == 1
+    finally:
+        cache.disable_cache()
+
+
+class PlanRecorder(mainquery.Backend):
+    def __init__(self):
+        self.plans = []
+
+    def objects(self, plan, mjd_first, mjd_last, near=None, exclude=()):
+        self.plans.append(plan)
+        return pd.DataFrame({"oid": [f"o{len(self.plans)}"], "meanra": [0.0], "meandec": [0.0]})
+
+    def classifiers(self, oids, classifier=None):
+        return pd.DataFrame()
+
+    def detections(self, oids):
+        return pd.DataFrame()
+
+
+def test_antipodal_and_multipart_clusters_are_all_queried(monkeypatch):
+    import astropy_healpix as ah
+
+    level = 6
+    nside = 2**level
+    ipix = np.arange(12 * nside**2)
+    lon, lat = ah.healpix_to_lonlat(ipix, nside, order="nested")
+    sep = [np.hypot((lon.deg - c + 180) % 360 - 180, lat.deg) for c in (10.0, 190.0)]
+    inside = (sep[0] < 3) | (sep[1] < 3)
+    # One cluster label over both lobes: traced as two polygons
+    traced = pd.DataFrame({"meanra": lon.deg[inside], "meandec": lat.deg[inside],
+                           "pixel_no": ah.level_ipix_to_uniq(level, ipix[inside]),
+                           "cluster_label": 0})
+    backend = PlanRecorder()
+    mainquery.query_alerce_clusters(backend, traced, 60000, 0, 0, plot=False)
+    assert len(backend.plans) == 2
+
+    # A multi-part alpha shape: every part is queried
+    parts = MultiPolygon([box(0, 0, 5, 5), box(100, 0, 105, 5)])
+    monkeypatch.setattr(mainquery.alphashape, "alphashape", lambda points, alpha: parts)
+    scattered = pd.DataFrame({"meanra": [1.0, 2.0, 101.0], "meandec": [1.0, 2.0, 1.0],
+                              "cluster_label": 0})
+    backend = PlanRecorder()
+    mainquery.query_alerce_clusters(backend, scattered, 60000, 0, 0, plot=False)
+    assert [plan["polygon"] for plan in backend.plans] == list(parts.geoms)
@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+import pandas as pd
+from astropy.coordinates import SkyCoord
+
+from gw_agn_watcher import match_milliquas
+from gw_agn_watcher.radecligo import credible_membership
+from gw_agn_watcher.skymap import SkyMap
+from helpers import write_multiorder
+
+
+def make_catalog(n=2000, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "ra": rng.uniform(0, 360, n),
+        "dec": np.rad2deg(np.arcsin(rng.uniform(-1, 1, n))),
+        "name": [f"QSO{i:05d}" for i in range(n)],
+        "type": rng.choice(["Q", "A", "B"], n),
+        "z": rng.uniform(0.01, 3, n),
+    })
+
+
+def make_candidates(agn, seed=2):
+    rng = np.random.default_rng(seed)
+    # Half the candidates within ~1 arcsec of an AGN, half far from any
+    near = agn.sample(40, random_state=0)
+    cand = pd.DataFrame({
+        "oid": [f"ZTF{i:03d}" for i in range(80)],
+        "meanra": np.concatenate([near["ra"] + rng.uniform(-2e-4, 2e-4, 40),
+                                  rng.uniform(0, 360, 40)]),
+        "meandec": np.concatenate([near["dec"] + rng.uniform(-2e-4, 2e-4, 40),
+                                   rng.uniform(-90, 90, 40)]),
+    })
+    return cand
+
+
+def test_prebuilt_catalog_matches_csv_path(tmp_path):
+    agn = make_catalog()
+    csv = tmp_path / "milliquas.csv"
+    agn.to_csv(csv, index=False)
+    cand = make_candidates(agn)
+
+    # Reference: nearest neighbour with astropy
+    idx, d2d, _ = SkyCoord(cand["meanra"], cand["meandec"], unit="deg").match_to_catalog_sky(
+        SkyCoord(agn["ra"], agn["dec"], unit="deg"))
+    close = d2d.deg <= match_milliquas.MATCH_RADIUS_DEG
+
+    expected = match_milliquas.match_with_milliquas(cand, agn, output_csv=str(tmp_path / "a.csv"))
+    catalog = match_milliquas.open_catalog(str(csv))
+    assert isinstance(catalog.xyz, np.memmap) and len(catalog) == len(agn)
+    # Only plain .npy columns and JSON metadata: nothing to unpickle
+    assert not any(f.endswith(".pkl") for f in os.listdir(str(csv) + ".catalog"))
+    result = match_milliquas.match_with_milliquas(cand, catalog, output_csv=str(tmp_path / "b.csv"))
+
+    for matched in (expected, result):
+        assert list(matched["oid"]) == list(cand["oid"][close])
+        assert list(matched["agn"]) == list(agn["name"].to_numpy()[idx[close]])
+        np.testing.assert_allclose(matched["z"], agn["z"].to_numpy()[idx[close]])
+        np.testing.assert_allclose(matched["agnsep"], d2d.deg[close], atol=1e-9)
+    # The candidates are left untouched
+    assert "agn" not in cand.columns
+
+
+def test_all_matches_flags_ambiguous_candidates(tmp_path):
+    agn = make_catalog(200)
+    # A close pair of AGN around the first candidate
+    pair = agn.iloc[:2].copy()
+    pair["ra"], pair["dec"] = [50.0, 50.0003], [10.0, 10.0]
+    pair["name"] = ["PAIR_A", "PAIR_B"]
+    agn = pd.concat([pair, agn.iloc[2:]], ignore_index=True)
+    cand = pd.DataFrame({"oid": ["amb", "single", "none"],
+                         "meanra": [50.0001, agn["ra"][10], 200.0],
+                         "meandec": [10.0, agn["dec"][10], -80.0]})
+
+    nearest = match_milliquas.match_with_milliquas(cand, agn, output_csv=str(tmp_path / "a.csv"))
+    assert list(nearest["oid"]) == ["amb", "single"]
+    assert list(nearest["agn"]) == ["PAIR_A", agn["name"][10]]
+    assert list(nearest["ambiguous"]) == [True, False]
+    assert list(nearest["n_agn"]) == [2, 1]
+
+    every = match_milliquas.match_with_milliquas(cand, agn, output_csv=str(tmp_path / "b.csv"),
+                                                 all_matches=True)
+    assert list(every["oid"]) == ["amb", "amb", "single"]
+    assert list(every["agn"]) == ["PAIR_A", "PAIR_B", agn["name"][10]]
+    assert every["agnsep"].iloc[0] < every["agnsep"].iloc[1]
+
+
+def test_open_catalog_reuses_and_rebuilds(tmp_path):
+    csv = tmp_path / "milliquas.csv"
+    make_catalog(100).to_csv(csv, index=False)
+    first = match_milliquas.open_catalog(str(csv))
+    assert match_milliquas.open_catalog(str(csv)) is first
+    assert match_milliquas.load_catalog(str(csv) + ".catalog") is first
+
+    # A changed CSV is rebuilt
+    make_catalog(50, seed=3).to_csv(csv, index=False)
+    os.utime(csv, ns=(1, 1))
+    assert len(match_milliquas.open_catalog(str(csv))) == 50
+
+
+def test_footprint_reads_only_credible_tiles(tmp_path):
+    path = write_multiorder(tmp_path / "skymap.multiorder.fits")
+    skymap = SkyMap(str(path))
+    agn = make_catalog(20000)
+    agn.to_csv(tmp_path / "milliquas.csv", index=False)
+    catalog = match_milliquas.open_catalog(str(tmp_path / "milliquas.csv"))
+
+    sub = catalog.footprint(skymap, credible_level=0.9)
+    assert 0 < len(sub) < len(catalog) / 2
+
+    # Every catalog source in the region is in the footprint
+    inside = credible_membership(agn.rename(columns={"ra": "meanra", "dec": "meandec"}),
+                                 skymap, credible_level=0.9)
+    assert set(inside["name"]) <= set(sub.name)
+
+    # Matching region candidates against the footprint gives the full-sky result
+    cand = credible_membership(make_candidates(agn), skymap, credible_level=0.9)
+    full = match_milliquas.match_with_milliquas(cand, catalog, output_csv=str(tmp_path / "a.csv"))
+    part = match_milliquas.match_with_milliquas(cand, sub, output_csv=str(tmp_path / "b.csv"))
+    assert len(full) > 0
+    assert list(part["agn"]) == list(full["agn"])
+
+
+def test_crossmatch_registered_catalogs(tmp_path, monkeypatch):
+    monkeypatch.setattr(match_milliquas, "CATALOGS", {})
+    agn = make_catalog(3000)
+    agn.to_csv(tmp_path / "milliquas.csv", index=False)
+    galaxies = pd.DataFrame({"ra": agn["ra"][:20] + 1e-3, "dec": agn["dec"][:20],
+                             "objname": [f"GAL{i}" for i in range(20)],
+                             "redshift": 0.1, "morph": "E"})
+    match_milliquas.register_catalog("milliquas", str(tmp_path / "milliquas.csv"))
+    match_milliquas.register_catalog("galaxies", galaxies, radius=5 / 3600, name_col="objname",
+                                     z_col="redshift", type_col="morph")
+    assert match_milliquas.get_catalog("galaxies") is match_milliquas.get_catalog("galaxies")
+
+    cand = pd.DataFrame({"oid": ["both", "agn_only", "none"],
+                         "meanra": [agn["ra"][0] + 5e-4, agn["ra"][100], 0.0],
+                         "meandec": [agn["dec"][0], agn["dec"][100], -89.0]})
+    table = match_milliquas.crossmatch(cand)
+
+    assert list(table["oid"]) == ["both", "both", "agn_only"]
+    assert list(table["catalog"]) == ["milliquas", "galaxies", "milliquas"]
+    assert list(table["agn"]) == [agn["name"][0], "GAL0", agn["name"][100]]
+    assert list(table["type"])[1] == "E"
+    assert (table["agnsep"] <= 5 / 3600).all()
+    assert "catalog" not in cand.columns
+
+    # A single catalog gives the match_with_milliquas result
+    only = match_milliquas.crossmatch(cand, catalogs=["milliquas"])
+    direct = match_milliquas.match_with_milliquas(cand, agn, output_csv=str(tmp_path / "m.csv"))
+    assert list(only["agn"]) == list(direct["agn"])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+from gw_agn_watcher import planner
+from gw_agn_watcher.polygons import healpix_polygon
+from helpers import disc_uniq
+
+
+def square(ra, dec, size):
+    return Polygon([(ra, dec), (ra + size, dec), (ra + size, dec + size), (ra, dec + size)])
+
+
+def test_spherical_area_of_traced_disc():
+    polygon = healpix_polygon(disc_uniq(30.0, 20.0, 4.0))
+    assert planner.spherical_area(polygon) == pytest.approx(planner.cone_area(4.0), rel=0.05)
+
+
+def test_split_polygon_preserves_area():
+    strip = Polygon([(10, 0), (60, 0), (60, 3), (10, 3)])
+    pieces = planner.split_polygon(strip, 3)
+    assert len(pieces) == 3
+    assert sum(map(planner.spherical_area, pieces)) == pytest.approx(planner.spherical_area(strip))
+
+
+def test_plan_queries_splits_merges_and_covers():
+    polygons = {
+        0: Polygon([(10, 0), (60, 0), (60, 3), (10, 3)]),   # elongated
+        1: square(200.0, 10.0, 0.3),                       # tiny
+        2: square(200.5, 10.0, 0.3),                       # tiny neighbour
+    }
+    plans = planner.plan_queries(polygons)
+
+    strip_plans = [p for p in plans if p["labels"] == [0]]
+    assert len(strip_plans) > 1
+    assert all(planner.elongation(p["polygon"]) <= 4 for p in strip_plans)
+
+    merged = [p for p in plans if sorted(p["labels"]) == [1, 2]]
+    assert len(merged) == 1
+    outline = merged[0]["polygon"].buffer(1e-9)
+    assert outline.covers(polygons[1]) and outline.covers(polygons[2])
+
+    for p in plans:
+        condition = planner.region_condition(p)
+        assert condition.startswith("q3c_poly_query") or condition.startswith("(q3c_radial_query")
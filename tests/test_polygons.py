@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Polygon
+
+from gw_agn_watcher.polygons import (healpix_polygon, healpix_polygons, pixel_boundaries,
+                                     simplify_polygon)
+from gw_agn_watcher.sphere import gnomonic, mean_direction, radec_to_xyz
+from helpers import disc_uniq
+
+
+def covers_pixels(polygon, uniq):
+    coords = np.array(polygon.exterior.coords)
+    vertices = radec_to_xyz(coords[:, 0], coords[:, 1])
+    center = mean_direction(vertices)
+    outline = Polygon(gnomonic(vertices, center)).buffer(1e-9)
+    corners = np.concatenate(pixel_boundaries(uniq))
+    return outline.contains(shapely.points(gnomonic(corners, center))).all()
+
+
+@pytest.mark.parametrize("ra, dec", [(30.0, 20.0), (0.0, -10.0), (250.0, 89.0)])
+def test_healpix_polygon_covers_all_pixels(ra, dec):
+    uniq = disc_uniq(ra, dec, 4.0)
+    polygon = healpix_polygon(uniq, max_vertices=60)
+
+    assert polygon.geom_type == "Polygon"
+    assert len(polygon.exterior.coords) - 1 <= 60
+    assert covers_pixels(polygon, uniq)
+
+
+def test_healpix_polygon_disconnected_pixels_still_single_polygon():
+    uniq = np.concatenate([disc_uniq(40.0, 0.0, 1.0), disc_uniq(46.0, 0.0, 1.0)])
+    polygon = healpix_polygon(uniq)
+
+    assert polygon.geom_type == "Polygon"
+    assert covers_pixels(polygon, uniq)
+
+
+@pytest.mark.parametrize("max_vertices", [32, 12, 4])
+def test_simplify_polygon_hits_target_and_keeps_coverage(max_vertices):
+    uniq = disc_uniq(120.0, -30.0, 6.0)
+    full = healpix_polygon(uniq, max_vertices=10000)
+    assert len(full.exterior.coords) - 1 > 32
+
+    simplified = simplify_polygon(full, max_vertices=max_vertices)
+    assert len(simplified.exterior.coords) - 1 <= max_vertices
+    assert covers_pixels(simplified, uniq)
+
+
+def test_healpix_polygons_split_antipodal_lobes():
+    lobes = [disc_uniq(10.0, 0.0, 3.0, level=6), disc_uniq(190.0, 0.0, 3.0, level=6)]
+    uniq = np.concatenate(lobes)
+    with pytest.raises(ValueError):
+        healpix_polygon(uniq)
+
+    pieces = healpix_polygons(uniq)
+    assert len(pieces) == 2
+    for lobe in lobes:
+        assert any(covers_pixels(piece, lobe) for piece in pieces)
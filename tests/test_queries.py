@@ -0,0 +1,92 @@
+import time
+
+import pandas as pd
+
+from gw_agn_watcher import classifiers, db, detections
+from helpers import RecordingConnection
+
+
+def test_detections_send_oids_as_array_batches():
+    conn = RecordingConnection()
+    oids = [f"ZTF{i:08d}" for i in range(25)]
+    detections.query_detections(pd.DataFrame({"oid": oids}), conn, batch_size=10)
+
+    prepares = [sql for sql, _ in conn.statements if sql.startswith("PREPARE")]
+    executes = [(sql, params) for sql, params in conn.statements if sql.startswith("EXECUTE")]
+    # Prepared once, executed once per batch with the oids as one parameter
+    assert len(prepares) == 1 and "ANY($1)" in prepares[0]
+    # One row per oid is selected on the server, with only the needed columns
+    assert "DISTINCT ON (det.oid)" in prepares[0] and "SELECT *" not in prepares[0]
+    assert [len(params[0]) for _, params in executes] == [10, 10, 5]
+    assert all("ZTF" not in sql for sql, _ in conn.statements)
+
+
+def test_classifiers_reuse_prepared_statements():
+    oids = pd.DataFrame({"oid": [f"ZTF{i:08d}" for i in range(6)]})
+
+    # One statement per batch in the combined mode, two otherwise
+    for combined, n_statements in ((True, 1), (False, 2)):
+        conn = RecordingConnection()
+        result = classifiers.query_classifiers(conn, oids, batch_size=2, combined=combined)
+        prepares = [sql for sql, _ in conn.statements if sql.startswith("PREPARE")]
+        executes = [sql for sql, _ in conn.statements if sql.startswith("EXECUTE")]
+        assert len(prepares) == n_statements
+        assert len(executes) == 3 * n_statements
+        assert list(result.columns) == list(classifiers.CLASSIFIER_COLUMNS)
+
+
+def test_combined_classifiers_keep_stamp_rows_first(monkeypatch):
+    rows = pd.DataFrame({
+        "oid": ["a", "b", "c"], "meanra": [1.0, 2.0, 3.0], "meandec": [0.0, 0.0, 0.0],
+        "firstmjd": [60000.0] * 3, "ndet": [3, 4, 5], "probability": [0.6, 0.7, 0.8],
+        "class_name": ["QSO", "SN", "AGN"],
+        "classifier_name": ["lc_classifier", "stamp_classifier", "stamp_classifier"],
+    })
+    monkeypatch.setattr(classifiers, "read_prepared", lambda conn, name, sql, params, bulk=False: rows)
+    result = classifiers.query_classifiers(object(), pd.DataFrame({"oid": ["a", "b", "c"]}))
+
+    assert list(result["oid"]) == ["b", "c", "a"]
+    assert result["ndet"].dtype == "int64"
+
+
+def test_batch_size_adapts_to_target_latency():
+    # Fake query taking 1 ms per oid: a 0.05 s target means ~50 oids per batch
+    def fetch(batch_oids):
+        time.sleep(0.001 * len(batch_oids))
+        return len(batch_oids)
+
+    oids = list(range(600))
+    sizes = [len(batch) for batch, _, _ in
+             classifiers._run_batches(oids, fetch, 10, target_latency=0.05, min_batch=5, max_batch=200)]
+    assert sum(sizes) == len(oids)
+    assert sizes[:3] == [10, 20, 40]
+    assert 25 <= sizes[-2] <= 80
+
+
+def test_parallel_classifier_batches_use_pooled_connections(monkeypatch):
+    borrowed = set()
+
+    def read_prepared(conn, name, sql, params, bulk=False):
+        borrowed.add(conn)
+        time.sleep(0.05)
+        batch = params[0]
+        return pd.DataFrame({
+            "oid": batch, "meanra": 1.0, "meandec": 0.0, "firstmjd": 60000.0, "ndet": 3,
+            "probability": 0.9, "class_name": "SN", "classifier_name": "stamp_classifier",
+        })
+
+    monkeypatch.setattr(classifiers, "read_prepared", read_prepared)
+    class Connection:
+        def rollback(self):
+            pass
+
+    pool = db.ConnectionPool(maxsize=3, connect=Connection)
+    oids = [f"ZTF{i:08d}" for i in range(30)]
+    result = classifiers.query_classifiers(None, pd.DataFrame({"oid": oids[::-1]}),
+                                           batch_size=5, workers=3, pool=pool)
+
+    # Same rows and order as a sequential run, with the batches spread over the pool
+    assert list(result["oid"]) == oids
+    assert len(borrowed) == 3
+    timings = result.attrs["batch_timings"]
+    assert len(timings) == 6 and all(t["oids"] == 5 and t["seconds"] > 0 for t in timings)
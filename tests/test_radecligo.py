@@ -1,45 +1,34 @@
+import astropy.units as u
+import astropy_healpix as ah
 import numpy as np
 import pandas as pd
 import pytest
 from astropy.table import QTable
 
-from gw_agn_watcher.radecligo import radecligo
+from gw_agn_watcher import skymap as skymap_module
+from gw_agn_watcher.radecligo import coarsen_pixels, credible_membership, credible_regions, radecligo
+from gw_agn_watcher.redshift import compute_distance_redshift
+from gw_agn_watcher.skymap import SkyMap, load_skymap
+from helpers import write_multiorder
 
 
-def test_radecligo_basic(monkeypatch, tmp_path):
-    # --- Create a dummy FITS file path ---
-    dummy_file = tmp_path / "dummy_skymap.fits"
+@pytest.fixture
+def skymap_url(monkeypatch, tmp_path):
+    path = write_multiorder(tmp_path / "dummy_skymap.multiorder.fits")
+    calls = []
 
-    # --- Mock: download_file simply returns dummy file path ---
-    monkeypatch.setattr(
-        "gw_agn_watcher.radecligo.download_file", lambda url, cache=True: str(dummy_file)
-    )
+    def fake_download(url, cache=True):
+        calls.append(url)
+        return str(path)
 
-    # --- Mock: FITS header reading ---
-    class DummyHeader:
-        header = {"MJD-OBS": 60000.0}
+    monkeypatch.setattr(skymap_module, "download_file", fake_download)
+    load_skymap.cache_clear()
+    yield "https://gracedb.ligo.org/api/superevents/S999999x/files/Bilby.multiorder.fits", calls
+    load_skymap.cache_clear()
 
-    monkeypatch.setattr(
-        "gw_agn_watcher.radecligo.fits.open", lambda path: [None, DummyHeader()]
-    )
 
-    # --- Mock: QTable.read returns minimal fake data ---
-    dummy_qtable = QTable({
-        "UNIQ": np.array([1, 2, 3, 4], dtype=np.int64),
-        "PROBDENSITY": np.array([0.4, 0.3, 0.2, 0.1])
-    })
-    monkeypatch.setattr("gw_agn_watcher.radecligo.QTable.read", lambda path: dummy_qtable)
-
-    # --- Mock: healpix conversions ---
-    monkeypatch.setattr("gw_agn_watcher.radecligo.ah.uniq_to_level_ipix",
-                        lambda uniq: (np.array([12, 12, 12, 12]), np.arange(len(uniq))))
-    monkeypatch.setattr("gw_agn_watcher.radecligo.ah.level_to_nside", lambda lvl: 8)
-    monkeypatch.setattr("gw_agn_watcher.radecligo.ah.nside_to_pixel_area", lambda ns: 1.0)
-    monkeypatch.setattr("gw_agn_watcher.radecligo.ah.healpix_to_lonlat",
-                        lambda ipix, nside, order="nested": (np.linspace(0,1,len(ipix))*u.rad, np.linspace(0,1,len(ipix))*u.rad))
-
-    # --- Run the function ---
-    url = "https://gracedb.ligo.org/api/superevents/S999999x/files/bayestar.fits.gz"
+def test_radecligo_basic(skymap_url):
+    url, _ = skymap_url
     skymap, df, ra, dec, mjd, event = radecligo(url, credible_level=0.9, plot=False)
 
     # --- Verify output types ---
@@ -54,9 +43,98 @@ def test_radecligo_basic(monkeypatch, tmp_path):
     for col in ["meanra", "meandec", "pixel_no", "prob_contour"]:
         assert col in df.columns
 
-    # --- Check event name extraction ---
+    # --- Check event name and header extraction ---
     assert event == "S999999x"
+    assert mjd == 60000.0
 
     # --- Probability and shape sanity checks ---
-    assert len(df) <= len(skymap)
+    assert 0 < len(df) < 48
+    assert df["prob_contour"].max() < 0.9
+    assert np.all(np.diff(df["pixel_no"]) > 0)
     assert np.all((ra >= 0) & (ra <= 360))
+
+
+def test_skymap_shared_between_modules(skymap_url):
+    url, calls = skymap_url
+    radecligo(url)
+    result = compute_distance_redshift(url)
+
+    # One download and one open for both consumers
+    assert len(calls) == 1
+    assert load_skymap(url) is load_skymap(url)
+    assert result["event_name"] == "S999999x"
+    assert result["distmean_Mpc"] == pytest.approx(100.0, rel=0.05)
+
+    # Only the latest event stays loaded
+    other = url.replace("S999999x", "S999998y")
+    assert load_skymap(other) is not load_skymap(url)
+    assert load_skymap.cache_info().currsize == 1
+
+
+def test_skymap_columns_native(tmp_path):
+    path = write_multiorder(tmp_path / "map.multiorder.fits")
+    with SkyMap(str(path)) as sm:
+        assert sm.is_multiorder
+        assert sm.uniq.dtype == np.int64
+        assert sm.probdensity.dtype.isnative
+        assert sm.prob.sum() == pytest.approx(1.0)
+        assert sm.to_table().colnames == ["UNIQ", "PROBDENSITY", "DISTMU", "DISTSIGMA", "DISTNORM"]
+
+
+def test_credible_regions_nested(tmp_path):
+    path = write_multiorder(tmp_path / "map.multiorder.fits")
+    rings = credible_regions(SkyMap(str(path)), levels=(0.9, 0.5, 0.95))
+
+    assert sorted(rings["credible_level"].unique()) == [0.5, 0.9, 0.95]
+    for level in (0.5, 0.9, 0.95):
+        region = rings[rings["credible_level"] <= level]
+        assert region["prob"].sum() < level
+        assert region["prob_contour"].max() < level
+
+    # The 90% region matches radecligo's own cut
+    _, df, _, _, _, _ = radecligo(SkyMap(str(path)), credible_level=0.9)
+    inner = rings[rings["credible_level"] <= 0.9]
+    assert np.array_equal(df["pixel_no"].to_numpy(), inner["pixel_no"].to_numpy())
+
+
+def test_coarsen_pixels_preserves_mass_and_coverage():
+    level = 8
+    ipix = np.arange(4**4 * 3)  # three complete level-4 parents
+    df = pd.DataFrame({
+        "pixel_no": 4 * 4**level + ipix,
+        "prob": np.full(len(ipix), 1.0 / len(ipix)),
+    })
+    tiles = coarsen_pixels(df, max_level=6, min_level=3)
+
+    assert tiles["prob"].sum() == pytest.approx(1.0)
+    assert tiles["npix"].sum() == len(df)
+    # Complete siblings are merged all the way up to level 4
+    assert list(tiles["pixel_no"]) == [4 * 4**4 + 0, 4 * 4**4 + 1, 4 * 4**4 + 2]
+
+
+def test_coarsen_pixels_empty_region():
+    empty = pd.DataFrame({"pixel_no": pd.Series(dtype=np.int64), "prob": pd.Series(dtype=float),
+                          "probdensity": pd.Series(dtype=float)})
+    tiles = coarsen_pixels(empty)
+    assert tiles.empty
+    assert list(tiles.columns) == ["meanra", "meandec", "pixel_no", "prob", "npix"]
+
+
+def test_credible_membership_matches_pixels(tmp_path):
+    path = write_multiorder(tmp_path / "map.multiorder.fits")
+    sm = SkyMap(str(path))
+    _, region, _, _, _, _ = radecligo(sm, credible_level=0.9)
+
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(0, 360, 2000)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, 2000)))
+    objects = pd.DataFrame({"oid": np.arange(2000), "meanra": ra, "meandec": dec})
+    kept = credible_membership(objects, sm, credible_level=0.9)
+
+    # Same answer as a direct HEALPix lookup at the map's (single) level
+    ipix = ah.lonlat_to_healpix(ra * u.deg, dec * u.deg, 2, order="nested")
+    expected = np.isin(4 * 4 + ipix, region["pixel_no"])
+    assert np.array_equal(kept["oid"].to_numpy(), np.flatnonzero(expected))
+    assert np.allclose(kept["probdensity"], sm.probdensity[ipix[expected]])
+    assert (kept["prob_contour"] < 0.9).all()
+    assert "probdensity" not in objects.columns
@@ -0,0 +1,43 @@
+import matplotlib
+import pandas as pd
+from shapely.geometry import Polygon
+
+matplotlib.use("Agg")
+
+from gw_agn_watcher import backends, mainquery, watch
+
+
+def test_poll_windows_and_state_roundtrip(tmp_path):
+    state = watch.load_state("S230518h", str(tmp_path))
+    assert watch.poll_window(state, 60000.3, now=60010.5) == (60000, 60010.5)
+
+    found = pd.DataFrame({"oid": ["a", "b"]})
+    watch.record(state, found, 60010.5)
+    watch.save_state(state, str(tmp_path))
+
+    state = watch.load_state("S230518h", str(tmp_path))
+    assert state["seen"] == {"a", "b"} and state["runs"] == 1
+    # The next poll only covers the new slice (plus the overlap day)
+    assert watch.poll_window(state, 60000.3, now=60012.0) == (60009.5, 60012.0)
+    assert list(watch.new_objects(state, pd.DataFrame({"oid": ["b", "c"]}))["oid"]) == ["c"]
+    # Nothing left once the full window has been queried
+    watch.record(state, found, 60200)
+    assert watch.poll_window(state, 60000.3, now=60300) is None
+
+
+def test_query_window_honours_ndays_and_overrides(tmp_path):
+    path = str(tmp_path / "alerce.sqlite")
+    backends.write_tables(path, **backends.synthetic_tables(n_objects=3000, seed=5))
+    backend = backends.LocalBackend(path)
+    df = pd.DataFrame({"meanra": [0.0], "meandec": [0.0], "cluster_label": [0]})
+    polygons = {0: Polygon([(0, -30), (90, -30), (90, 30), (0, 30)])}
+
+    short = mainquery.query_alerce_clusters(backend, df, 60000.7, 0, 0, ndays=50,
+                                            polygons=polygons, plot=False)
+    assert short["firstmjd"].between(60000, 60050).all()
+    assert short["firstmjd"].max() > 60040
+
+    sliced = mainquery.query_alerce_clusters(backend, df, 60000.7, 0, 0, polygons=polygons,
+                                             plot=False, mjd_first=60100, mjd_last=60110)
+    assert len(sliced) and sliced["firstmjd"].between(60100, 60110).all()
+    backend.close()